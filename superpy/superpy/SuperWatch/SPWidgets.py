@@ -594,9 +594,15 @@ class ServerPage(HelperPage):
         
         """
         result = self.scheduler.ShowQueue(host, port)
+        health = SuperInfo.DescribeHostHealth(self.scheduler, [(host, port)])
+        if (result is None):
+            return """
+        Unable to get queue for %s:%s. Health is:\n%s\n
+        """ % (host, port, health)
         msg = """
         Queue for %s:%s is:\n%s\n
-        """ % (host, port, '\n'.join(map(str, result)))
+        Health is:\n%s\n
+        """ % (host, port, '\n'.join(map(str, result)), health)
         return msg
 
     def SubmitTask(self, task, server):
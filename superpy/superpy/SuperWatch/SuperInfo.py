@@ -225,6 +225,46 @@ def CleanTasks(scheduler, hostRE, portRE, taskRE, threshold):
            len(left), '\n'.join(t.Name() for t in left), msg)
     return msg    
 
+def DescribeHostHealth(scheduler, hosts=None):
+    """Describe health of superpy servers as seen by the scheduler.
+
+    INPUTS:
+
+    -- scheduler:     Instance of a superpy scheduler holding info on
+                      which host/port superpy servers are running on.  
+
+    -- hosts=None:    Optional list of (host, port) pairs to describe. If
+                      None, we describe all servers the scheduler has
+                      health info for.
+
+    -------------------------------------------------------
+
+    RETURNS:        String with one line per server.
+
+    -------------------------------------------------------
+
+    PURPOSE:        Show which servers the scheduler considers down (and
+                    hence skips) and when it will retry them.
+
+    """
+    healthInfo = scheduler.HostHealthInfo()
+    if (hosts is None):
+        hosts = sorted(healthInfo.keys())
+    lines = []
+    for (host, port) in hosts:
+        info = healthInfo.get((host, port), None)
+        if (info is None):
+            lines.append('%s:%s : not contacted yet' % (host, port))
+            continue
+        line = '%s:%s : %s' % (host, port, info['state'])
+        if (info['failures']):
+            line += ' (%i failures, last error: %s)' % (
+                info['failures'], info['lastError'])
+        if (info['retryIn'] is not None):
+            line += ' retry in %.0f seconds' % info['retryIn']
+        lines.append(line)
+    return '\n'.join(lines)
+
 def RefreshInfo(scheduler, info, timeout=3, cache=None, idle=None):
     """Show status of task.
 
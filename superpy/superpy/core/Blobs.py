@@ -0,0 +1,530 @@
+"""Provides content-addressed storage for large parts of pickled objects.
+
+Tasks submitted together often share large state such as configuration
+objects or ignore lists. Pickling each task on its own means sending
+and storing that state again for every task. SplitDumps instead pickles
+each large part of an object as a separate blob named by a hash of its
+contents, and leaves only a persistent id for the blob in the main
+pickle (the skeleton). A server keeps blobs in a BlobStore so clients
+only need to send the blobs the server does not have yet (see
+SubmitShared and Servers.BasicRPCServer.SubmitShared).
+
+Blob keys start with 's:' for strings, which are stored as they are,
+and with 'p:' for pickles of anything else. Different objects with the
+same contents share a blob but still load as different objects, while
+an object referred to from several places loads as one object:
+
+>>> import Blobs
+>>> config = {'ignore' : ['file%i' % i for i in range(2000)]}
+>>> tasks = [{'name' : 't%i' % i, 'config' : config} for i in range(3)]
+>>> tasks.append({'name' : 'copy', 'config' : {
+...     'ignore' : list(config['ignore'])}})
+>>> skeleton, refs, blobs = Blobs.SplitDumps(tasks, minBytes=1000)
+>>> len(blobs), len(skeleton) < 1000
+(1, True)
+>>> store = Blobs.BlobStore(maxBytes=1<<20)
+>>> store.Missing(refs) == refs
+True
+>>> for (key, (data, blobRefs)) in blobs.items():
+...     store.Add(key, data, blobRefs)
+...
+>>> store.Missing(refs)
+[]
+>>> loaded = Blobs.Loads(skeleton, store.Get)
+>>> loaded == tasks
+True
+>>> loaded[0]['config'] is loaded[2]['config']
+True
+>>> loaded[0]['config']['ignore'] is loaded[3]['config']['ignore']
+False
+"""
+
+import cPickle, hashlib, threading, types, collections, logging
+from cStringIO import StringIO
+
+# Parts of an object which pickle to at least MIN_BLOB_BYTES are split out
+# as blobs by default.
+MIN_BLOB_BYTES = 64 << 10
+PROTOCOL = cPickle.HIGHEST_PROTOCOL
+_MAX_SPLIT_TRIES = 4
+_LEAF_TYPES = frozenset([int, long, float, bool, complex, types.NoneType])
+_NEVER_SPLIT = (type, types.ClassType, types.FunctionType, types.ModuleType,
+                types.BuiltinFunctionType, types.MethodType)
+
+class MissingBlob(KeyError):
+    "Raised when a blob we need is not available."
+
+class _Cycle(Exception):
+    "Raised to give up splitting an object which is part of a cycle."
+
+def Key(data, kind='p'):
+    """Return key for blob holding string data of the given kind.
+
+    The kind is 's' if data is a string we split out and 'p' if data
+    is the pickle of some other object.
+    """
+    return '%s:%s' % (kind, hashlib.sha1(data).hexdigest())
+
+def _Splittable(obj):
+    "Return True if obj is a container or instance we may make a blob of."
+
+    if (isinstance(obj, (dict, list, set))):
+        return True
+    return hasattr(obj, '__dict__') and not isinstance(obj, _NEVER_SPLIT)
+
+def _Children(obj):
+    "Return list of objects obj refers to or None if we cannot tell."
+
+    if (isinstance(obj, dict)):
+        return obj.keys() + obj.values()
+    if (isinstance(obj, (list, tuple, set, frozenset))):
+        return list(obj)
+    if (hasattr(obj, '__dict__') and not isinstance(obj, _NEVER_SPLIT)):
+        state = vars(obj)
+        return state.keys() + state.values()
+    return None
+
+def _EstimateSizes(obj):
+    """Return dictionary mapping ids of parts of obj to estimated sizes.
+
+    Pickling each part on its own to see how big it is costs time for
+    every level of nesting and recursion for every level of depth, so
+    we instead walk obj once without recursion and add up the lengths
+    of strings plus a few bytes for everything else. Parts we cannot
+    look inside are pickled to see how big they are. Strings and other
+    leaves are not in the dictionary. The second item returned is a
+    list of the parts so their ids stay valid.
+    """
+    sizes, keep, pending = {}, [], {}
+    todo = [obj]
+    while (todo):
+        item = todo.pop()
+        key = id(item)
+        if (key in pending):
+            total, others = pending.pop(key)
+            for child in others:
+                total += sizes.get(id(child), 8)
+            sizes[key] = total
+            continue
+        if (key in sizes):
+            continue
+        keep.append(item)
+        children = _Children(item)
+        if (children is None):
+            try:
+                sizes[key] = len(cPickle.dumps(item, PROTOCOL))
+            except Exception: # leave it for pickling obj to complain
+                sizes[key] = 8
+            continue
+        total, others = 8, []
+        for child in children:
+            kind = type(child)
+            if (kind is str or kind is unicode):
+                total += len(child)
+            elif (kind in _LEAF_TYPES):
+                total += 8
+            else:
+                others.append(child)
+        sizes[key] = total # replaced once others are done unless a cycle
+        if (others):
+            pending[key] = (total, others)
+            todo.append(item)
+            todo.extend(others)
+    return sizes, keep
+
+class _Splitter:
+    """Pickles objects with large parts split out as blobs.
+
+    See SplitDumps for how this is used. Every object pickled inline
+    (i.e., not as a blob) is noted so we can tell if a mutable object
+    would be copied into more than one pickle and so lose its identity
+    when loaded.
+    """
+
+    def __init__(self, minBytes, force, sizes):
+        self.minBytes = minBytes
+        self.force = force          # ids of objects which must be blobs
+        self.sizes = sizes          # id(obj) -> estimated size in bytes
+        self.blobs = {}             # key -> (data, refs)
+        self._pids = {}             # id(obj) -> persistent id or None
+        self._keep = []             # objects in self._pids so ids stay unique
+        self._copies = {}           # key -> number of objects with that key
+        self._roots = set()         # ids of objects we are pickling
+        self._inlined = []          # sets of ids pickled inline in each blob
+
+    def Dump(self, obj):
+        """Pickle obj with large parts split out.
+
+        RETURNS:        Tuple (data, refs, inline) where data is the
+                        pickle of obj, refs is a set of keys of blobs
+                        data refers to, and inline is a set of ids of
+                        splittable objects pickled inline.
+        """
+        refs, inline = set(), set()
+        stream = StringIO()
+        pickler = cPickle.Pickler(stream, PROTOCOL)
+        pickler.persistent_id = lambda item : self._PersistentId(
+            item, obj, refs, inline)
+        self._roots.add(id(obj))
+        try:
+            pickler.dump(obj)
+        finally:
+            self._roots.discard(id(obj))
+        return stream.getvalue(), refs, inline
+
+    def SharedInline(self, inline):
+        """Return set of ids of objects pickled inline in more than one pickle.
+
+        The inline input is what Dump returned for the skeleton.
+        """
+        seen, shared = set(), set()
+        for ids in [inline] + self._inlined:
+            shared |= seen & ids
+            seen |= ids
+        return shared
+
+    def _PersistentId(self, item, root, refs, inline):
+        "Return persistent id of item if it is a blob or else None."
+
+        kind = type(item)
+        if (kind in _LEAF_TYPES or item is root):
+            return None
+        if (kind is str or kind is unicode):
+            if (len(item) < self.minBytes):
+                return None
+        elif (not _Splittable(item)):
+            return None
+        elif (self.sizes.get(id(item), 0) < self.minBytes
+              and id(item) not in self.force):
+            inline.add(id(item))
+            return None
+        pid = self._pids.get(id(item), False)
+        if (pid is False):
+            pid = self._MakeBlob(item)
+        if (pid is None):
+            inline.add(id(item))
+        else:
+            refs.add(pid.split('#')[0])
+        return pid
+
+    def _MakeBlob(self, item):
+        "Make blob for item if it is big enough and return its persistent id."
+
+        if (id(item) in self._roots):
+            raise _Cycle()
+        pid = None
+        if (isinstance(item, str)):
+            pid = Key(item, 's')
+            self.blobs[pid] = (item, [])
+        else:
+            try:
+                data, refs, inline = self.Dump(item)
+            except _Cycle:
+                data = None
+            if (data is not None and (len(data) >= self.minBytes
+                                      or id(item) in self.force)):
+                key = Key(data)
+                self.blobs[key] = (data, sorted(refs))
+                self._inlined.append(inline)
+                copies = self._copies.get(key, 0)
+                self._copies[key] = copies + 1
+                pid = key if not copies else '%s#%i' % (key, copies)
+        self._pids[id(item)] = pid
+        self._keep.append(item)
+        return pid
+
+def SplitDumps(obj, minBytes=None):
+    """Pickle obj with its large parts split out as separate blobs.
+
+    INPUTS:
+
+    -- obj:             Object to pickle.
+
+    -- minBytes=None:   Strings, containers, and instances which pickle
+                        to at least this many bytes become blobs. If
+                        None, we use MIN_BLOB_BYTES.
+
+    -------------------------------------------------------
+
+    RETURNS:        Tuple (skeleton, refs, blobs) where skeleton is the
+                    pickle of obj with persistent ids for blobs, refs
+                    is a sorted list of keys of blobs skeleton refers
+                    to, and blobs is a dictionary mapping each key to a
+                    pair (data, refs) with the blob contents and the
+                    keys of blobs that blob refers to.
+
+    -------------------------------------------------------
+
+    PURPOSE:        Lets similar objects share storage for their large
+                    parts (see module docs). Use Loads to unpickle.
+
+                    An object pickled into more than one blob would be
+                    loaded as several copies. If that would happen to
+                    a container or instance, we try again with that
+                    object as a blob of its own. If that does not help
+                    (e.g., due to reference cycles or blobs nested too
+                    deeply to pickle one inside another), we return a
+                    plain pickle of obj and no blobs:
+
+>>> import Blobs
+>>> deep = {'data' : 'x' * 100}
+>>> for i in range(300):
+...     deep = {'next' : deep, 'row' : [i]}
+...
+>>> skeleton, refs, blobs = Blobs.SplitDumps(deep, minBytes=50)
+>>> refs, blobs
+([], {})
+>>> Blobs.Loads(skeleton, {}.__getitem__) == deep
+True
+>>> skeleton, refs, blobs = Blobs.SplitDumps([deep, 'y' * 20000],
+...                                          minBytes=20000)
+>>> len(blobs), Blobs.Loads(skeleton, lambda key : blobs[key][0]) == [
+...     deep, 'y' * 20000]
+(1, True)
+
+    """
+    minBytes = MIN_BLOB_BYTES if minBytes is None else minBytes
+    whole = cPickle.dumps(obj, PROTOCOL)
+    if (len(whole) < minBytes):
+        return whole, [], {}
+    sizes, _keep = _EstimateSizes(obj)
+    if (not [1 for (key, size) in sizes.iteritems()
+             if size >= minBytes and key != id(obj)] and not [
+                 1 for child in (_Children(obj) or []) if type(child) in (
+                     str, unicode) and len(child) >= minBytes]):
+        return whole, [], {} # no part other than obj itself is big
+    force, splitter = set(), None
+    try:
+        for _attempt in range(_MAX_SPLIT_TRIES):
+            # Keep previous splitter until here so ids in force stay valid.
+            splitter = _Splitter(minBytes, force, sizes)
+            skeleton, refs, inline = splitter.Dump(obj)
+            shared = splitter.SharedInline(inline)
+            if (not shared):
+                return skeleton, sorted(refs), splitter.blobs
+            force = force | shared
+    except RuntimeError, e: # too deep to pickle blobs inside blobs
+        logging.debug('Got %s splitting %s' % (e, type(obj)))
+    logging.debug('Unable to split %s; pickling it whole' % type(obj))
+    return whole, [], {}
+
+def Loads(skeleton, getBlob):
+    """Unpickle skeleton from SplitDumps.
+
+    INPUTS:
+
+    -- skeleton:        Skeleton pickle returned by SplitDumps.
+
+    -- getBlob:         Callable taking a blob key and returning the data
+                        for the blob (e.g., BlobStore.Get). It should
+                        raise a KeyError if it does not have the blob.
+
+    -------------------------------------------------------
+
+    RETURNS:        Unpickled object.
+
+    """
+    loaded = {} # persistent id -> object
+    def PersistentLoad(pid):
+        "Return object for persistent id, loading its blob if necessary."
+        if (pid not in loaded):
+            key = pid.split('#')[0]
+            data = getBlob(key)
+            loaded[pid] = data if key.startswith('s:') else Load(data)
+        return loaded[pid]
+    def Load(data):
+        "Unpickle data using PersistentLoad for blobs."
+        unpickler = cPickle.Unpickler(StringIO(data))
+        unpickler.persistent_load = PersistentLoad
+        return unpickler.load()
+    return Load(skeleton)
+
+def Descendants(keys, blobs):
+    """Return sorted list of keys and keys of all blobs they refer to.
+
+    INPUTS:
+
+    -- keys:        List of blob keys.
+
+    -- blobs:       Dictionary of blobs as returned by SplitDumps.
+    """
+    result, todo = set(), list(keys)
+    while (todo):
+        key = todo.pop()
+        if (key not in result):
+            result.add(key)
+            todo.extend(blobs[key][1])
+    return sorted(result)
+
+def SubmitShared(connection, tasks, args=(), minBytes=None, maxTries=3):
+    """Submit tasks sending only the blobs the server does not have.
+
+    INPUTS:
+
+    -- connection:      PicklingServerProxy for a server which has the
+                        SubmitShared method (see Servers.BasicRPCServer).
+
+    -- tasks:           List of tasks to submit.
+
+    -- args=():         Further arguments for SubmitShared on the server
+                        (e.g., emailList and callbacks).
+
+    -- minBytes=None:   Passed to SplitDumps.
+
+    -- maxTries=3:      How many times to try before giving up if the
+                        server keeps forgetting blobs before we submit.
+
+    -------------------------------------------------------
+
+    RETURNS:        List of handles for the tasks or None if no part of
+                    the tasks is big enough to be a blob. In that case,
+                    the caller should submit the tasks as usual.
+
+    -------------------------------------------------------
+
+    PURPOSE:        We first send only the skeleton. If the server has
+                    all the blobs it refers to, the tasks are queued
+                    with a single call. Otherwise the server tells us
+                    which blobs it is missing and we send the skeleton
+                    again together with those blobs.
+
+                    Tasks which keep parts of themselves pickled (e.g.,
+                    Tasks.ImpersonatingTask with wrapTask=True) can
+                    have a SplitForSharing method taking minBytes and
+                    returning a copy with those parts split out. We
+                    submit what that returns instead of the task.
+
+    """
+    tasks = [getattr(task, 'SplitForSharing', lambda minBytes : task)(
+        minBytes) for task in tasks]
+    skeleton, refs, blobs = SplitDumps(tasks, minBytes)
+    if (not blobs):
+        return None
+    send = {}
+    for _attempt in range(maxTries):
+        handles, missing = connection.SubmitShared(
+            skeleton, refs, send, *args)
+        if (handles is not None):
+            return handles
+        logging.debug('Sending %i missing blobs' % len(missing))
+        send = dict([(key, blobs[key])
+                     for key in Descendants(missing, blobs)])
+    raise MissingBlob('Server still missing blobs %s after %i tries' % (
+        missing, maxTries))
+
+class BlobStore:
+    """Keeps blobs by key and forgets the least recently used past maxBytes.
+
+    Blobs are checked against their key when added. Getting or adding a
+    blob marks it as recently used.
+
+>>> import Blobs
+>>> store = Blobs.BlobStore(maxBytes=10)
+>>> keys = [Blobs.Key(data, 's') for data in ['aaaa', 'bbbb', 'cccc']]
+>>> store.Add(keys[0], 'aaaa'); store.Add(keys[1], 'bbbb')
+>>> store.Get(keys[0])
+'aaaa'
+>>> store.Add(keys[2], 'cccc')
+>>> store.Missing(keys) == [keys[1]]
+True
+>>> sorted(store.Info().items())
+[('blobs', 2), ('bytes', 8), ('maxBytes', 10)]
+>>> store.Add(keys[1], 'cccc')
+Traceback (most recent call last):
+ValueError: Data does not match blob key s:8aed1322e5450badb078e1fb60a817a1df25a2ca.
+    """
+
+    def __init__(self, maxBytes=256 << 20):
+        self.maxBytes = maxBytes
+        self._blobs = collections.OrderedDict() # key -> (data, refs)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def Add(self, key, data, refs=()):
+        """Add blob with given key, data string, and keys it refers to.
+
+        Blobs bigger than self.maxBytes are not kept.
+        """
+        if (Key(data, key[0:1]) != key):
+            raise ValueError('Data does not match blob key %s.' % key)
+        self._lock.acquire()
+        try:
+            entry = self._blobs.pop(key, None)
+            if (entry is None):
+                if (len(data) > self.maxBytes):
+                    return
+                entry = (data, list(refs))
+                self._bytes += len(data)
+            self._blobs[key] = entry
+            while (self._bytes > self.maxBytes):
+                (_oldKey, (oldData, _oldRefs)) = self._blobs.popitem(False)
+                self._bytes -= len(oldData)
+        finally:
+            self._lock.release()
+
+    def Get(self, key):
+        "Return data for blob with given key or raise MissingBlob."
+
+        self._lock.acquire()
+        try:
+            entry = self._blobs.pop(key, None)
+            if (entry is None):
+                raise MissingBlob(key)
+            self._blobs[key] = entry
+            return entry[0]
+        finally:
+            self._lock.release()
+
+    def Missing(self, refs, extra=None):
+        """Return sorted list of keys of blobs needed to load something.
+
+        INPUTS:
+
+        -- refs:        List of keys of blobs the thing refers to.
+
+        -- extra=None:  Optional dictionary of blobs (as returned by
+                        SplitDumps) to use along with the ones we have.
+
+        -------------------------------------------------------
+
+        RETURNS:        Sorted list of keys in refs, or referred to by
+                        blobs we have, which are not in this store or
+                        in extra.
+
+        """
+        extra = {} if extra is None else extra
+        missing, seen, todo = set(), set(), list(refs)
+        self._lock.acquire()
+        try:
+            while (todo):
+                key = todo.pop()
+                if (key in seen):
+                    continue
+                seen.add(key)
+                entry = extra.get(key, self._blobs.get(key, None))
+                if (entry is None):
+                    missing.add(key)
+                else:
+                    todo.extend(entry[1])
+        finally:
+            self._lock.release()
+        return sorted(missing)
+
+    def Info(self):
+        "Return dictionary with number and total size of blobs we have."
+
+        self._lock.acquire()
+        try:
+            return {'blobs' : len(self._blobs), 'bytes' : self._bytes,
+                    'maxBytes' : self.maxBytes}
+        finally:
+            self._lock.release()
+
+def _test():
+    "Test docstrings in module."
+    import doctest
+    doctest.testmod()
+
+if __name__ == '__main__':
+    _test()
+    print 'Test finished.'
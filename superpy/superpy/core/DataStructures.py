@@ -1,16 +1,69 @@
 """Module containing various data structures used in superpy
 """
 
+import heapq, itertools, bisect, math, os, cPickle, logging
+import threading, tempfile, shutil, collections
+
+class _OrderedNames:
+    """A set of names which remembers insertion order.
+
+    Names are kept in a doubly linked list (each link is a list of the
+    form [prev, next, name]) along with a dictionary mapping names to
+    links so that adding and removing names takes O(1) time.
+    """
+
+    def __init__(self):
+
+        self._root = []
+        self._root[:] = [self._root, self._root, None]
+        self._links = {}
+
+    def Add(self, name):
+        "Add name to the end of the ordering."
+
+        root = self._root
+        last = root[0]
+        link = [last, root, name]
+        last[1] = root[0] = link
+        self._links[name] = link
+
+    def Discard(self, name):
+        "Remove name from the ordering."
+
+        prevLink, nextLink, _name = self._links.pop(name)
+        prevLink[1] = nextLink
+        nextLink[0] = prevLink
+
+    def __iter__(self):
+        root = self._root
+        link = root[1]
+        while (link is not root):
+            yield link[2]
+            link = link[1]
+
+    def __len__(self):
+        return len(self._links)
+
 class NamedQueue:
     """A queue to track named elements.
+
+    Items are kept in the order they were pushed. Push, PopItem, lookup,
+    and changing the state of an item all take O(1) time.
+
+    Each item may also have a state (e.g., 'queued', 'running',
+    'finished'). The queue keeps a separate ordering for each state so
+    that callers can go through the items in one state without looking
+    at the rest of the queue. 
     """
 
     def __init__(self):
 
-        self._itemList = []
         self._itemDict = {}
+        self._order = _OrderedNames()
+        self._states = {}
+        self._stateOf = {}
 
-    def Push(self, name, item):
+    def Push(self, name, item, state=None):
         """Push a new named item in to the queue.
         
         INPUTS:
@@ -18,6 +71,8 @@ class NamedQueue:
         -- name:        String name of new item.
         
         -- item:        Object representing the item.
+
+        -- state=None:  Optional state for the item. See SetState.
         """
 
         if (item is None):
@@ -27,8 +82,9 @@ class NamedQueue:
             raise Exception(
                 "Can't add item %s when item with that name is in queue."%name)
         else:
-            self._itemList.append(name)            
+            self._order.Add(name)
             self._itemDict[name] = item
+            self.SetState(name, state)
 
     def PopItem(self, name):
         """Remove the named item from the queue.
@@ -53,27 +109,101 @@ class NamedQueue:
                 'No item named %s exists in this queue.\nContents:\n%s' % (
                 str(name), '\n'.join(self._itemDict.keys())))
 
-        # Currently we do a linear search for the index of the item to remove.
-        # This could be sped up by having self._itemList contain the name
-        # and insertion time for each item and doing a binary search based
-        # on insertion time.
-        itemIndex = self._itemList.index(name)
-        
-        self._itemList.pop(itemIndex)
+        self.SetState(name, None)
+        self._order.Discard(name)
         del self._itemDict[name]
 
         return item
 
+    def SetState(self, name, state):
+        """Set the state of the named item.
+        
+        INPUTS:
+        
+        -- name:        String name of item in the queue.
+        
+        -- state:       Hashable object (usually a string) representing
+                        the new state or None for no state.
+        
+        -------------------------------------------------------
+        
+        PURPOSE:        Move the item to the end of the ordering for the
+                        given state so that ShowItems(state) and
+                        IterItems(state) can find it quickly.
+        
+        """
+
+        if (name not in self._itemDict):
+            raise KeyError('No item named %s exists in this queue.' % name)
+        oldState = self._stateOf.pop(name, None)
+        if (oldState is not None):
+            self._states[oldState].Discard(name)
+        if (state is not None):
+            if (state not in self._states):
+                self._states[state] = _OrderedNames()
+            self._states[state].Add(name)
+            self._stateOf[name] = state
+
+    def State(self, name):
+        "Return the state of the named item (or None if it has no state)."
+
+        if (name not in self._itemDict):
+            raise KeyError('No item named %s exists in this queue.' % name)
+        return self._stateOf.get(name, None)
+
     def __getitem__(self, name):
         return self._itemDict[name]
 
-    def ShowItems(self):
+    def __contains__(self, name):
+        return name in self._itemDict
+
+    def __len__(self):
+        return len(self._itemDict)
+
+    def Count(self, state):
+        "Return number of items in the given state."
+
+        names = self._states.get(state, None)
+        return 0 if names is None else len(names)
+
+    def IterItems(self, state=None):
+        """Iterate over (name, item) pairs without copying the queue.
+        
+        INPUTS:
+        
+        -- state=None:  If this is None, go through all items. Otherwise,
+                        only go through items in the given state.
+        
+        -------------------------------------------------------
+        
+        RETURNS:        Generator of (name, item) pairs in the order
+                        items were pushed (or put into the given state).
+        
+        -------------------------------------------------------
+        
+        PURPOSE:        Look at items without building a list. Do not
+                        push, pop, or change states of items while the
+                        generator is in use; use ShowItems for that.
+        
+        """
+
+        if (state is None):
+            names = self._order
+        else:
+            names = self._states.get(state, ())
+        itemDict = self._itemDict
+        for name in names:
+            yield (name, itemDict[name])
+
+    def ShowItems(self, state=None):
         """Return sequence representing (name, item) for all items in queue.
 
-        Items are returned in order they were put into the queue.
+        Items are returned in order they were put into the queue. If
+        state is not None, only items in that state are returned in the
+        order they were put into that state.
         """
 
-        return [(name, self._itemDict[name]) for name in self._itemList]
+        return list(self.IterItems(state))
 
     @staticmethod
     def _regr_test():
@@ -91,6 +221,689 @@ class NamedQueue:
 [('1', 1), ('3', 3)]
         """
 
+    @staticmethod
+    def _regr_test_states():
+        """
+>>> import DataStructures
+>>> q = DataStructures.NamedQueue()
+>>> for name in 'abcd':
+...     q.Push(name, name.upper(), 'queued')
+... 
+>>> q.SetState('c', 'running')
+>>> q.SetState('a', 'running')
+>>> q.ShowItems('running'), q.Count('queued'), q.State('a')
+([('c', 'C'), ('a', 'A')], 2, 'running')
+>>> q.PopItem('c')
+'C'
+>>> list(q.IterItems('running')), 'c' in q, len(q)
+([('a', 'A')], False, 3)
+>>> q.ShowItems()
+[('a', 'A'), ('b', 'B'), ('d', 'D')]
+        """
+
+class NamedPriorityQueue:
+    """A priority queue of named elements with FIFO tie-breaking.
+
+    Items with larger priority come out first. Items with equal priority
+    come out in the order they were pushed. Push, Pop, Remove, and
+    ChangePriority all take O(log n) time. Removed entries are only
+    marked as invalid and are discarded when they reach the top of the
+    heap or when invalid entries make up most of the heap.
+    """
+
+    def __init__(self):
+
+        self._heap = []
+        self._entries = {}
+        self._counter = itertools.count()
+        self._numInvalid = 0
+
+    def Push(self, name, item, priority):
+        """Push a new named item with the given priority into the queue.
+        
+        INPUTS:
+        
+        -- name:        String name of new item.
+        
+        -- item:        Object representing the item.
+
+        -- priority:    Number where larger means the item comes out sooner.
+        """
+
+        if (name in self._entries):
+            raise Exception(
+                "Can't add item %s when item with that name is in queue."%name)
+        self._AddEntry([-priority, self._counter.next(), name, item, True])
+
+    def _AddEntry(self, entry):
+        "Helper to put entry of [-priority, order, name, item, valid] in heap."
+
+        self._entries[entry[2]] = entry
+        heapq.heappush(self._heap, entry)
+
+    def _Invalidate(self, name):
+        "Helper to remove entry for name and return it."
+        
+        entry = self._entries.pop(name)
+        entry[-1] = False
+        self._numInvalid += 1
+        if (self._numInvalid > 32 and self._numInvalid > len(self._heap)/2):
+            self._heap = [e for e in self._heap if e[-1]]
+            heapq.heapify(self._heap)
+            self._numInvalid = 0
+        return entry
+
+    def Remove(self, name):
+        """Remove the named item from the queue and return it.
+
+        Raises KeyError if there is no item with the given name.
+        """
+
+        return self._Invalidate(name)[3]
+
+    def ChangePriority(self, name, priority):
+        """Change priority of named item.
+
+        The item keeps its original place among items of equal priority.
+        """
+
+        entry = self._Invalidate(name)
+        self._AddEntry([-priority, entry[1], name, entry[3], True])
+
+    def Peek(self):
+        """Return (name, item) pair which would be popped next or None.
+        """
+
+        while (self._heap and not self._heap[0][-1]):
+            heapq.heappop(self._heap)
+            self._numInvalid -= 1
+        if (self._heap):
+            return (self._heap[0][2], self._heap[0][3])
+        return None
+
+    def Pop(self):
+        """Remove and return (name, item) pair with highest priority.
+
+        Raises KeyError if the queue is empty.
+        """
+
+        top = self.Peek()
+        if (top is None):
+            raise KeyError('Cannot pop from empty queue.')
+        self._entries.pop(top[0])
+        heapq.heappop(self._heap)
+        return top
+
+    def Tail(self, count):
+        """Return list of up to count (name, item) pairs which would be
+        popped last, in the order they would be popped.
+
+        This takes O(n log count) time so it is meant for occasional use.
+        """
+        if (count <= 0):
+            return []
+        entries = heapq.nlargest(count, self._entries.values())
+        entries.reverse()
+        return [(entry[2], entry[3]) for entry in entries]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, name):
+        return name in self._entries
+
+    @staticmethod
+    def _regr_test():
+        """
+>>> import DataStructures
+>>> q = DataStructures.NamedPriorityQueue()
+>>> for (name, priority) in [('a', 1), ('b', 5), ('c', 1), ('d', 5)]:
+...     q.Push(name, name.upper(), priority)
+... 
+>>> q.Peek()
+('b', 'B')
+>>> q.Remove('b')
+'B'
+>>> q.ChangePriority('c', 10)
+>>> 'c' in q, len(q)
+(True, 3)
+>>> q.Tail(2), q.Tail(0)
+([('d', 'D'), ('a', 'A')], [])
+>>> [q.Pop() for _i in range(len(q))]
+[('c', 'C'), ('d', 'D'), ('a', 'A')]
+>>> q.Peek() is None
+True
+        """
+
+class PrioritySums:
+    """Running sums of amounts keyed by priority.
+
+    This keeps the total amount added at each priority so that the
+    total amount at or above a given priority can be found quickly.
+    Priorities are kept in a sorted list with a Fenwick (binary indexed)
+    tree over their positions. Add, Remove, and SumAtLeast take
+    O(log k) time where k is the number of distinct priorities seen.
+    Seeing a new priority rebuilds the tree in O(k) time but that is
+    rare since there are usually only a few distinct priorities.
+    """
+
+    def __init__(self):
+
+        self._keys = []    # sorted list of distinct priorities
+        self._values = []  # amount at each priority in self._keys
+        self._counts = []  # number of amounts added at each priority
+        self._tree = [0]   # Fenwick tree with 1-based indexes
+
+    def _Rebuild(self):
+        "Rebuild Fenwick tree from self._values."
+
+        self._tree = [0] + list(self._values)
+        for i in range(1, len(self._tree)):
+            parent = i + (i & -i)
+            if (parent < len(self._tree)):
+                self._tree[parent] += self._tree[i]
+
+    def _Update(self, index, delta):
+        "Add delta to the amount at position index of self._keys."
+
+        self._values[index] += delta
+        i = index + 1
+        while (i < len(self._tree)):
+            self._tree[i] += delta
+            i += i & -i
+
+    def _PrefixSum(self, count):
+        "Return sum of amounts at the first count positions of self._keys."
+
+        total = 0
+        while (count > 0):
+            total += self._tree[count]
+            count -= count & -count
+        return total
+
+    def Add(self, priority, amount):
+        "Add amount at the given priority."
+
+        index = bisect.bisect_left(self._keys, priority)
+        if (index == len(self._keys) or self._keys[index] != priority):
+            self._keys.insert(index, priority)
+            self._values.insert(index, 0)
+            self._counts.insert(index, 0)
+            self._Rebuild()
+        self._counts[index] += 1
+        self._Update(index, amount)
+
+    def Remove(self, priority, amount):
+        """Remove an amount previously added with Add at the given priority.
+
+        When the last amount at a priority is removed, the sum at that
+        priority is reset to exactly 0 so floating point errors do not
+        build up.
+        """
+
+        index = bisect.bisect_left(self._keys, priority)
+        if (index == len(self._keys) or self._keys[index] != priority
+            or self._counts[index] == 0):
+            raise KeyError('Nothing was added at priority %s.' % priority)
+        self._counts[index] -= 1
+        if (self._counts[index] == 0):
+            amount = self._values[index]
+        self._Update(index, -amount)
+
+    def SumAtLeast(self, priority):
+        "Return total amount at priorities greater than or equal to priority."
+
+        index = bisect.bisect_left(self._keys, priority)
+        return self._PrefixSum(len(self._keys)) - self._PrefixSum(index)
+
+    def Items(self):
+        "Return list of (priority, amount) pairs for priorities in use."
+
+        return [(k, v) for (k, v, c) in zip(
+            self._keys, self._values, self._counts) if c]
+
+    @staticmethod
+    def _regr_test():
+        """
+>>> import DataStructures
+>>> sums = DataStructures.PrioritySums()
+>>> for (priority, amount) in [(5, 10), (-1000, 7), (5, 3), (2.5, 1)]:
+...     sums.Add(priority, amount)
+... 
+>>> [sums.SumAtLeast(p) for p in [6, 5, 3, 0, -1000, -2000]]
+[0, 13, 13, 14, 21, 21]
+>>> sums.Remove(5, 10)
+>>> sums.Add(7, 100)
+>>> [sums.SumAtLeast(p) for p in [8, 7, 5, 2.5, -1000]]
+[0, 100, 103, 104, 111]
+>>> sums.Remove(7, 100)
+>>> sums.SumAtLeast(7)
+0
+>>> sums.Items()
+[(-1000, 7), (2.5, 1), (5, 3)]
+        """
+
+class RuntimeHistory:
+    """Exponentially weighted statistics of run times for families of tasks.
+
+    For each family (a string like those from Tasks.BasicTask.Family) we
+    keep the number of run times seen and an exponentially weighted mean
+    and variance of them where each new run time gets weight alpha. So
+    the estimates follow changes in how long a family takes to run.
+    """
+
+    def __init__(self, alpha=0.3):
+
+        self.alpha = alpha
+        self._stats = {} # family -> [count, mean, variance]
+
+    def Record(self, family, runTime):
+        "Record that a task in the given family ran for runTime seconds."
+
+        stats = self._stats.get(family, None)
+        if (stats is None):
+            self._stats[family] = [1, float(runTime), 0.0]
+            return
+        diff = runTime - stats[1]
+        increment = self.alpha * diff
+        stats[0] += 1
+        stats[1] += increment
+        stats[2] = (1 - self.alpha) * (stats[2] + diff * increment)
+
+    def Estimate(self, family, stddevs=0):
+        """Return mean plus stddevs standard deviations of run time.
+
+        If we have never seen a run time for family, return None.
+        """
+        stats = self._stats.get(family, None)
+        if (stats is None):
+            return None
+        return stats[1] + stddevs * math.sqrt(stats[2])
+
+    def Stats(self):
+        "Return dictionary mapping family to (count, mean, stddev)."
+
+        return dict([(family, (count, mean, math.sqrt(variance)))
+                     for (family, (count, mean, variance))
+                     in self._stats.items()])
+
+    def Save(self, path):
+        "Save history to path (replacing the file at once)."
+
+        tmpPath = path + '.tmp'
+        tmpFile = open(tmpPath, 'wb')
+        try:
+            cPickle.dump((self.alpha, self._stats), tmpFile, 2)
+        finally:
+            tmpFile.close()
+        if (os.path.exists(path) and os.name == 'nt'):
+            os.remove(path) # windows can not rename over existing file
+        os.rename(tmpPath, path)
+
+    @classmethod
+    def Load(cls, path):
+        "Return history saved at path or an empty history if none saved."
+
+        result = cls()
+        if (os.path.exists(path)):
+            historyFile = open(path, 'rb')
+            try:
+                result.alpha, result._stats = cPickle.load(historyFile)
+            finally:
+                historyFile.close()
+        return result
+
+    @staticmethod
+    def _regr_test():
+        """
+>>> import os, tempfile, DataStructures
+>>> history = DataStructures.RuntimeHistory(alpha=0.5)
+>>> print history.Estimate('sim')
+None
+>>> for runTime in [10, 30]:
+...     history.Record('sim', runTime)
+... 
+>>> history.Estimate('sim'), history.Estimate('sim', stddevs=1)
+(20.0, 30.0)
+>>> history.Stats()
+{'sim': (2, 20.0, 10.0)}
+>>> path = tempfile.mktemp()
+>>> history.Save(path)
+>>> DataStructures.RuntimeHistory.Load(path).Stats() == history.Stats()
+True
+>>> os.remove(path)
+>>> DataStructures.RuntimeHistory.Load(path).Stats()
+{}
+        """
+
+class _SizeLimitReached(Exception):
+    "Raised by _CountingFile once it has seen enough bytes."
+
+class _CountingFile:
+    "File-like object which only counts bytes written up to a limit."
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.bytes = 0
+
+    def write(self, data):
+        "Count data and raise _SizeLimitReached if we have seen enough."
+
+        self.bytes += len(data)
+        if (self.bytes >= self.limit):
+            raise _SizeLimitReached()
+
+def _PickledSize(obj, limit):
+    """Return length of pickle of obj or limit if it is at least limit.
+
+    We pickle obj to a _CountingFile so we do not keep the pickle in
+    memory and stop as soon as we know it is big enough.
+    """
+    counter = _CountingFile(limit)
+    try:
+        cPickle.dump(obj, counter, cPickle.HIGHEST_PROTOCOL)
+    except _SizeLimitReached:
+        return limit
+    return counter.bytes
+
+class ResultStore:
+    """Holds large task results within a memory budget, spilling to disk.
+
+    Results whose size is at least minBytes are taken by Put. They are
+    kept in memory until those in memory take more than maxMemoryBytes;
+    then the least recently used are written to files in spillDir.
+    Results of at least spillBytes are written to a file right away.
+    The size of a string is its length and the size of anything else
+    is the length of its pickle (found without keeping the pickle and
+    only up to spillBytes until we write it). Strings are written to
+    files as they are and anything else is pickled. Use Read to get a
+    spilled result a piece at a time.
+
+    Files are written and read without holding the lock so other calls
+    need not wait for the disk. Results being written to a file can
+    still be had from Get.
+
+    If spillDir is None, we make a temporary directory the first time
+    we need one and remove it in Close.
+    """
+
+    def __init__(self, minBytes=1 << 20, spillBytes=64 << 20,
+                 maxMemoryBytes=512 << 20, spillDir=None):
+
+        self.minBytes = minBytes
+        self.spillBytes = spillBytes
+        self.maxMemoryBytes = maxMemoryBytes
+        self.spillDir = spillDir
+        self._madeDir = None
+        self._memory = collections.OrderedDict() # name -> (result, size)
+        self._memoryBytes = 0
+        self._writing = {} # name -> (result, size) being spilled
+        self._spilled = {} # name -> (path, isString, size)
+        self._lock = threading.Lock()
+        self._dirLock = threading.Lock()
+
+    def Put(self, name, result):
+        """Take result of task with given name if it is large enough.
+
+        Returns size of result if we took it and None otherwise.
+        """
+        if (isinstance(result, str)):
+            size = len(result)
+        else:
+            size = _PickledSize(result, self.minBytes)
+            if (size >= self.minBytes):
+                size = _PickledSize(result, self.spillBytes)
+        if (size < self.minBytes):
+            return None
+        self.Remove(name)
+        if (size >= self.spillBytes):
+            path, isString, size = self._Write(result)
+            self._lock.acquire()
+            try:
+                self._spilled[name] = (path, isString, size)
+            finally:
+                self._lock.release()
+            return size
+        evicted = []
+        self._lock.acquire()
+        try:
+            self._memory[name] = (result, size)
+            self._memoryBytes += size
+            while (self._memoryBytes > self.maxMemoryBytes):
+                (oldName, entry) = self._memory.popitem(False)
+                self._memoryBytes -= entry[1]
+                self._writing[oldName] = entry
+                evicted.append((oldName, entry))
+        finally:
+            self._lock.release()
+        for (oldName, entry) in evicted:
+            self._Spill(oldName, entry)
+        return size
+
+    def _Spill(self, name, entry):
+        "Write entry evicted from memory for name to a file."
+
+        try:
+            spilled = self._Write(entry[0])
+        except Exception, e:
+            logging.error('Keeping result %s in memory since unable to '
+                          'write it: %s' % (name, e))
+            spilled = None
+        self._lock.acquire()
+        try:
+            current = self._writing.get(name)
+            if (current is entry):
+                del self._writing[name]
+                if (spilled is None):
+                    self._memory[name] = entry
+                    self._memoryBytes += entry[1]
+                else:
+                    self._spilled[name] = spilled
+                    spilled = None
+        finally:
+            self._lock.release()
+        if (spilled is not None): # removed while we were writing
+            self._RemoveFile(spilled[0])
+
+    def _SpillDir(self):
+        "Return self.spillDir making a temporary directory if necessary."
+
+        self._dirLock.acquire()
+        try:
+            if (self.spillDir is None):
+                self._madeDir = self.spillDir = tempfile.mkdtemp(
+                    prefix='superpy_results_')
+            return self.spillDir
+        finally:
+            self._dirLock.release()
+
+    def _Write(self, result):
+        """Write result to a new file in self.spillDir.
+
+        Returns tuple (path, isString, size).
+        """
+        isString = isinstance(result, str)
+        fd, path = tempfile.mkstemp(dir=self._SpillDir(), prefix='result_')
+        spillFile = os.fdopen(fd, 'wb')
+        try:
+            if (isString):
+                spillFile.write(result)
+            else:
+                cPickle.dump(result, spillFile, cPickle.HIGHEST_PROTOCOL)
+            size = spillFile.tell()
+        finally:
+            spillFile.close()
+        return path, isString, size
+
+    def _Open(self, name):
+        """Return result in memory for name or open file and info for it.
+
+        The result is a pair (result, None) if the result is in memory and
+        otherwise (spillFile, (path, isString, size)). We open the file
+        while holding the lock so Remove can not take it away first.
+        Raises KeyError if we do not have a result for name.
+        """
+        self._lock.acquire()
+        try:
+            entry = self._memory.pop(name, None)
+            if (entry is not None):
+                self._memory[name] = entry
+                return entry[0], None
+            entry = self._writing.get(name)
+            if (entry is not None):
+                return entry[0], None
+            spilled = self._spilled[name]
+            return open(spilled[0], 'rb'), spilled
+        finally:
+            self._lock.release()
+
+    def Get(self, name):
+        "Return result for task with given name or raise KeyError."
+
+        result, spilled = self._Open(name)
+        if (spilled is None):
+            return result
+        try:
+            if (spilled[1]):
+                return result.read()
+            return cPickle.load(result)
+        finally:
+            result.close()
+
+    def Read(self, name, offset, length):
+        """Return part of a spilled result for task with given name.
+        
+        INPUTS:
+        
+        -- name:        Name of task.
+        
+        -- offset:      Offset of first byte to read.
+        
+        -- length:      Maximum number of bytes to read.
+        
+        -------------------------------------------------------
+        
+        RETURNS:        Tuple (data, isString, size) with the bytes read
+                        from the file holding the result, whether the
+                        result is a string (or else a pickle), and the
+                        size of the file, or None if the result is in
+                        memory. Raises KeyError if we do not have it.
+        
+        -------------------------------------------------------
+        
+        PURPOSE:        Lets the server send a large result a piece at a
+                        time instead of loading all of it into memory.
+        
+        """
+        spillFile, spilled = self._Open(name)
+        if (spilled is None):
+            return None
+        try:
+            spillFile.seek(offset)
+            return spillFile.read(length), spilled[1], spilled[2]
+        finally:
+            spillFile.close()
+
+    def Remove(self, name):
+        "Forget result for task with given name if we have it."
+
+        self._lock.acquire()
+        try:
+            entry = self._memory.pop(name, None)
+            if (entry is not None):
+                self._memoryBytes -= entry[1]
+            self._writing.pop(name, None)
+            spilled = self._spilled.pop(name, None)
+        finally:
+            self._lock.release()
+        if (spilled is not None):
+            self._RemoveFile(spilled[0])
+
+    @staticmethod
+    def _RemoveFile(path):
+        "Remove file at path if we can."
+
+        try:
+            os.remove(path)
+        except OSError, e: # e.g., open on windows; Close cleans up
+            logging.debug('Unable to remove %s: %s' % (path, e))
+
+    def Info(self):
+        """Return dictionary with number and size of results we hold.
+
+        The 'memory' and 'spilled' entries are numbers of results and the
+        'memoryBytes' and 'spilledBytes' entries are their total sizes.
+        Results being written to a file count as spilled.
+        """
+        self._lock.acquire()
+        try:
+            return {'memory' : len(self._memory),
+                    'memoryBytes' : self._memoryBytes,
+                    'spilled' : len(self._spilled) + len(self._writing),
+                    'spilledBytes' : sum([size for (_path, _isString, size)
+                                          in self._spilled.values()]) + sum(
+                        [size for (_result, size) in self._writing.values()])}
+        finally:
+            self._lock.release()
+
+    def Close(self):
+        "Forget all results and remove spillDir if we made it."
+
+        self._lock.acquire()
+        try:
+            names = list(self._memory) + list(self._writing) + list(
+                self._spilled)
+        finally:
+            self._lock.release()
+        for name in names:
+            self.Remove(name)
+        if (self._madeDir is not None):
+            shutil.rmtree(self._madeDir, ignore_errors=True)
+            self._madeDir = self.spillDir = None
+
+    @staticmethod
+    def _regr_test():
+        """
+>>> import os, DataStructures
+>>> store = DataStructures.ResultStore(
+...     minBytes=10, spillBytes=100, maxMemoryBytes=50)
+>>> print store.Put('small', 'tiny')
+None
+>>> [store.Put(name, result) for (name, result) in [
+...     ('a', 'a' * 30), ('b', range(10)), ('c', 'c' * 200)]]
+[30, 28, 200]
+>>> sorted(store.Info().items()) # 'a' spilled to make room for 'b'
+[('memory', 1), ('memoryBytes', 28), ('spilled', 2), ('spilledBytes', 230)]
+>>> store.Get('a') == 'a' * 30, store.Get('b'), store.Get('c') == 'c' * 200
+(True, [0, 1, 2, 3, 4, 5, 6, 7, 8, 9], True)
+>>> spillDir = store.spillDir
+>>> len(os.listdir(spillDir))
+2
+>>> data, isString, size = store.Read('c', 190, 100)
+>>> data, isString, size
+('cccccccccc', True, 200)
+>>> print store.Read('b', 0, 100)
+None
+>>> spillFile, _info = store._Open('c') # e.g., Get reading while we remove
+>>> store.Remove('c'); len(os.listdir(spillDir))
+1
+>>> len(spillFile.read()); spillFile.close()
+200
+>>> [store.Put(name, range(20)) for name in 'def'] # each spills the last
+[48, 48, 48]
+>>> import cPickle
+>>> cPickle.loads(''.join([store.Read('d', offset, 20)[0] for offset in [
+...     0, 20, 40]])) == range(20)
+True
+>>> store.Get('d') == range(20), sorted(store._spilled), store._writing
+(True, ['a', 'b', 'd', 'e'], {})
+>>> store.Get('c')
+Traceback (most recent call last):
+KeyError: 'c'
+>>> store.Close(); os.path.exists(spillDir)
+False
+        """
+
 def _test():
     "Test docstrings in module."
     import doctest
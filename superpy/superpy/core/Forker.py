@@ -10,6 +10,10 @@ address representing a peer that will control this process. The
 first action of this process is to make an XML-RPC call to that
 address to call the HandShake method. After that, this process
 will listen for XML-RPC requests from that peer.
+
+If <peer_host_name> is a FramedRPC address such as unix:@name (and
+<peer_port_number> is 0), we talk to the peer using FramedRPC over Unix
+domain sockets instead of XML-RPC over TCP.
 """
 
 
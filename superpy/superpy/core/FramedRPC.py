@@ -0,0 +1,448 @@
+"""Provides an RPC server and proxy using length-prefixed pickle frames.
+
+PicklingXMLRPC sends each call as XML over HTTP with every argument
+pickled (in text mode) and escaped into an XML string. That is fine
+between machines but wasteful between a RemoteProcess and the Forker
+children it starts on the same machine, especially when arguments or
+results are large. This module provides FramedRPCServer and
+FramedServerProxy which send each call and reply as a single frame
+holding a binary pickle preceded by its length. They listen and
+connect over Unix domain sockets when the platform supports them.
+
+Addresses are strings of the form 'unix:<path>'. On Linux, a path
+starting with '@' names a socket in the abstract namespace so there is
+no file to clean up. Use Available to check whether this transport can
+be used; otherwise callers should fall back to PicklingXMLRPC over TCP.
+
+FramedServerProxy can also talk to a Servers.BasicRPCServer using an
+address of the form 'tcp:<host>:<port>'. Such servers accept both
+XML-RPC and frames on the same port: the proxy starts each connection
+by sending PREAMBLE and the server replies with PREAMBLE if it speaks
+frames. Since PREAMBLE is not a valid HTTP request line, an older
+server replies with an HTTP error instead and the proxy falls back to
+PicklingXMLRPC for the rest of its calls.
+
+The proxy and server follow the interface of PicklingServerProxy and
+PicklingXMLRPCServer closely enough that RemoteProcess can use either:
+
+>>> import FramedRPC, threading
+>>> class Echo:
+...     def _dispatch(self, method, params):
+...         if (method == 'Fail'): raise Exception('failed as requested')
+...         return (method, params)
+...
+>>> server = FramedRPC.FramedRPCServer(FramedRPC.MakeAddress())
+>>> server.register_instance(Echo())
+>>> server.timeout = 5
+>>> def Serve(count):
+...     for _i in range(count): server.handle_request()
+...
+>>> thread = threading.Thread(target=Serve, args=(3,)); thread.start()
+>>> proxy = FramedRPC.FramedServerProxy(server.Address())
+>>> proxy.Hello(1, [2])
+('Hello', (1, [2]))
+>>> len(proxy.Big('x' * (3*1024*1024))[1][0])
+3145728
+>>> try:
+...     proxy.Fail()
+... except Exception, e:
+...     print 'failed as requested' in str(e)
+...
+True
+>>> thread.join()
+>>> proxy.close()
+>>> server.server_close()
+"""
+
+import sys, os, socket, struct, select, threading, logging, traceback
+import random, cPickle
+from SuperExceptions import RemoteException
+import PicklingXMLRPC
+from PicklingXMLRPC import DEFAULT_TIMEOUT
+
+# Prefix for addresses of Unix domain sockets.
+UNIX_PREFIX = 'unix:'
+
+# Prefix for addresses of TCP servers which accept frames.
+TCP_PREFIX = 'tcp:'
+
+# Sent by clients when connecting over TCP to ask for frames (and echoed
+# back by servers which support them). This must not look like HTTP.
+PREAMBLE = '\x00superpy-framed/1\n'
+
+# Each frame starts with its length packed in this format.
+_HEADER = struct.Struct('!Q')
+
+# Largest chunk to ask recv for when reading a frame.
+_CHUNK = 1 << 20
+
+def Available():
+    "Return True if this platform supports Unix domain sockets."
+
+    return hasattr(socket, 'AF_UNIX')
+
+def IsAddress(host):
+    "Return True if host is a Unix domain socket address (e.g., 'unix:@x')."
+
+    return isinstance(host, str) and host.startswith(UNIX_PREFIX)
+
+def TCPAddress(host, port):
+    "Return address for FramedServerProxy to talk to a server over TCP."
+
+    return '%s%s:%i' % (TCP_PREFIX, host, port)
+
+def MakeAddress():
+    """Make a new address to listen on.
+
+    RETURNS:        String address using the abstract namespace on
+                    Linux or a path in the temporary directory otherwise.
+    """
+    name = 'superpy_%i_%x' % (os.getpid(), random.getrandbits(64))
+    if (sys.platform.startswith('linux')):
+        return UNIX_PREFIX + '@' + name
+    else:
+        import tempfile
+        return UNIX_PREFIX + os.path.join(tempfile.gettempdir(), name)
+
+def _SocketPath(address):
+    "Return path for socket.bind/connect from address made by MakeAddress."
+
+    if (not IsAddress(address)):
+        raise ValueError('Invalid address %s' % repr(address))
+    path = address[len(UNIX_PREFIX):]
+    if (path.startswith('@')):
+        path = '\0' + path[1:]
+    return path
+
+def _ParseAddress(address):
+    "Return (family, address for socket.connect) from address string."
+
+    if (isinstance(address, str) and address.startswith(TCP_PREFIX)):
+        host, port = address[len(TCP_PREFIX):].rsplit(':', 1)
+        return (socket.AF_INET, (host, int(port)))
+    return (socket.AF_UNIX, _SocketPath(address))
+
+def AcceptPreamble(sock):
+    """Read PREAMBLE from a client on sock and echo it back.
+
+    RETURNS:        True if the client sent PREAMBLE and False otherwise.
+    """
+    try:
+        data = _RecvAll(sock, len(PREAMBLE), True)
+    except EOFError:
+        return False
+    if (data != PREAMBLE):
+        return False
+    sock.sendall(PREAMBLE)
+    return True
+
+class FrameTooLarge(ValueError):
+    "Raised by RecvFrame when a frame is larger than allowed."
+
+def SendFrame(sock, data):
+    "Send string data on sock as one frame."
+
+    sock.sendall(_HEADER.pack(len(data)))
+    sock.sendall(data)
+
+def RecvFrame(sock, maxSize=None):
+    """Receive one frame from sock.
+
+    INPUTS:
+
+    -- sock:           Socket to read from.
+
+    -- maxSize=None:   If not None, raise FrameTooLarge instead of
+                       reading a frame larger than this many bytes.
+
+    -------------------------------------------------------
+
+    RETURNS:        String data in the frame or None if sock was closed
+                    before a frame started.
+    """
+    header = _RecvAll(sock, _HEADER.size, True)
+    if (header is None):
+        return None
+    size = _HEADER.unpack(header)[0]
+    if (maxSize is not None and size > maxSize):
+        raise FrameTooLarge('Frame of %i bytes is larger than limit of %i' % (
+            size, maxSize))
+    return _RecvAll(sock, size)
+
+def _RecvAll(sock, size, eofOK=False):
+    "Receive exactly size bytes from sock (or None if eofOK and closed)."
+
+    data = bytearray(size)
+    view = memoryview(data)
+    got = 0
+    while (got < size):
+        count = sock.recv_into(view[got:], min(size - got, _CHUNK))
+        if (count == 0):
+            if (eofOK and got == 0):
+                return None
+            raise EOFError('Connection closed after %i of %i bytes' % (
+                got, size))
+        got += count
+    return str(data)
+
+class _NotSupported(Exception):
+    "Raised when a TCP server does not reply to PREAMBLE."
+
+class _FramedMethod:
+    "Callable for calling a method through a FramedServerProxy."
+
+    def __init__(self, proxy, name):
+        self._proxy = proxy
+        self._name = name
+
+    def __getattr__(self, name):
+        return _FramedMethod(self._proxy, '%s.%s' % (self._name, name))
+
+    def __call__(self, *args, **kw):
+        if (len(kw)):
+            raise Exception('''
+            Cannot use keyword arguments for framed server proxies.\nGot kw=%s.
+            ''' % kw)
+        return self._proxy._Request(self._name, args)
+
+class FramedServerProxy:
+    """Proxy to call methods on a FramedRPCServer.
+
+    Like PicklingServerProxy, calling proxy.Method(*args) calls Method
+    on the server and returns the result (or raises the RemoteException
+    reported by the server). Each thread using the proxy gets its own
+    connection which is kept open between calls.
+    """
+
+    def __init__(self, address, timeout=DEFAULT_TIMEOUT):
+        """Initializer.
+
+        INPUTS:
+
+        -- address:        Address of server as made by MakeAddress.
+
+        -- timeout=DEFAULT_TIMEOUT:  Socket timeout in seconds or None for
+                                     no timeout. If DEFAULT_TIMEOUT, we use
+                                     socket.getdefaulttimeout() at the time
+                                     of each request.
+        """
+        self._address = address
+        self._family, self._sockAddress = _ParseAddress(address)
+        self.timeout = timeout
+        self._local = threading.local()
+        self._fallback = None
+
+    def __repr__(self):
+        return '<FramedServerProxy for %s>' % self._address
+
+    def __getattr__(self, name):
+        if (name.startswith('_')):
+            raise AttributeError(name)
+        return _FramedMethod(self, name)
+
+    def _Socket(self):
+        "Return (sock, reused) with connected socket for this thread."
+
+        timeout = self.timeout
+        if (timeout is DEFAULT_TIMEOUT):
+            timeout = socket.getdefaulttimeout()
+        sock = getattr(self._local, 'sock', None)
+        reused = sock is not None
+        if (sock is None):
+            sock = socket.socket(self._family, socket.SOCK_STREAM)
+            try:
+                sock.settimeout(timeout)
+                sock.connect(self._sockAddress)
+                if (self._family != socket.AF_UNIX):
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    self._Negotiate(sock)
+            except:
+                sock.close()
+                raise
+            self._local.sock = sock
+        sock.settimeout(timeout)
+        return sock, reused
+
+    def _Negotiate(self, sock):
+        "Ask server on sock for frames or raise _NotSupported."
+
+        sock.sendall(PREAMBLE)
+        try:
+            reply = _RecvAll(sock, len(PREAMBLE), True)
+        except EOFError:
+            reply = None
+        if (reply != PREAMBLE):
+            raise _NotSupported('Server at %s did not accept frames' % (
+                self._address))
+
+    def _Request(self, name, args):
+        "Send request for method name with args and return the result."
+
+        if (self._fallback is not None):
+            return getattr(self._fallback, name)(*args)
+        request = cPickle.dumps((name, args), cPickle.HIGHEST_PROTOCOL)
+        try:
+            reply = self._Exchange(request)
+        except _NotSupported, e:
+            logging.info('%s; falling back to XML-RPC' % str(e))
+            self._fallback = PicklingXMLRPC.PicklingServerProxy(
+                'http://%s:%i' % self._sockAddress, timeout=self.timeout)
+            return getattr(self._fallback, name)(*args)
+        except (socket.error, EOFError), e:
+            self.close()
+            if (not getattr(e, 'reused', False)):
+                raise
+            # the server may have dropped a kept connection so retry once
+            try:
+                reply = self._Exchange(request)
+            except:
+                self.close()
+                raise
+        result = cPickle.loads(reply)
+        if (isinstance(result, RemoteException)): raise result
+        else: return result
+
+    def _Exchange(self, request):
+        """Send request and return reply.
+
+        If sending fails or the server closes the connection before
+        replying on a connection kept from an earlier call, the
+        exception raised has a reused attribute set to True.
+        """
+        sock, reused = self._Socket()
+        try:
+            SendFrame(sock, request)
+            reply = RecvFrame(sock)
+        except socket.error, e:
+            e.reused = reused and not isinstance(e, socket.timeout)
+            raise
+        if (reply is None):
+            e = EOFError('Server at %s closed connection' % self._address)
+            e.reused = reused
+            raise e
+        return reply
+
+    def close(self):
+        "Close the connection for this thread (if any)."
+
+        sock = getattr(self._local, 'sock', None)
+        self._local.sock = None
+        if (sock is not None):
+            sock.close()
+
+class FramedRPCServer:
+    """Server for requests from FramedServerProxy.
+
+    This has the parts of the SimpleXMLRPCServer interface which
+    RemoteProcess uses: register_instance, handle_request, timeout,
+    socket, and server_close. Each call to handle_request handles at
+    most one request even if several clients are connected.
+    """
+
+    def __init__(self, address, backlog=16):
+        """Initializer.
+
+        INPUTS:
+
+        -- address:        Address to listen on as made by MakeAddress.
+
+        -- backlog=16:     Argument for socket.listen.
+        """
+        self._address = address
+        self._path = _SocketPath(address) # only Unix domain sockets here
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.bind(self._path)
+        self.socket.listen(backlog)
+        self.timeout = None
+        self.instance = None
+        self._clients = []
+
+    def Address(self):
+        "Return address clients should connect to."
+        return self._address
+
+    def register_instance(self, instance):
+        "Dispatch requests to instance._dispatch(method, params)."
+        self.instance = instance
+
+    def register_introspection_functions(self):
+        "Provided for compatibility with SimpleXMLRPCServer; does nothing."
+        pass
+
+    def handle_request(self):
+        """Wait for and handle one request.
+
+        Waits up to self.timeout seconds (forever if None) for a request
+        from any connected client while accepting new connections and
+        dropping closed ones.
+        """
+        while True:
+            try:
+                ready = select.select(
+                    [self.socket] + self._clients, [], [], self.timeout)[0]
+            except select.error, e:
+                if (e.args[0] == 4): continue # EINTR
+                raise
+            if (not ready):
+                return
+            for sock in ready:
+                if (sock is self.socket):
+                    self._clients.append(self.socket.accept()[0])
+                elif (self._Handle(sock)):
+                    return
+
+    def _Handle(self, sock):
+        "Handle request on sock and return True or drop sock and return False."
+
+        try:
+            request = RecvFrame(sock)
+        except (socket.error, EOFError), e:
+            logging.debug('Dropping client after error: %s' % str(e))
+            request = None
+        if (request is None):
+            self._Drop(sock)
+            return False
+        try:
+            method, params = cPickle.loads(request)
+            result = self.instance._dispatch(method, params)
+            reply = cPickle.dumps(result, cPickle.HIGHEST_PROTOCOL)
+        except Exception, e:
+            errTrace = 'Exception of type %s: %s\n\n\n%s' % (
+                type(e).__name__, str(e), traceback.format_exc())
+            logging.debug('Got exception in FramedRPC:\n%s\n' % errTrace)
+            reply = cPickle.dumps(RemoteException(errTrace),
+                                  cPickle.HIGHEST_PROTOCOL)
+        try:
+            SendFrame(sock, reply)
+        except socket.error, e:
+            logging.debug('Unable to reply to client: %s' % str(e))
+            self._Drop(sock)
+        return True
+
+    def _Drop(self, sock):
+        "Close and forget client sock."
+
+        if (sock in self._clients):
+            self._clients.remove(sock)
+        sock.close()
+
+    def server_close(self):
+        "Close listening socket and any client connections."
+
+        for sock in list(self._clients):
+            self._Drop(sock)
+        self.socket.close()
+        if (not self._path.startswith('\0')):
+            try:
+                os.remove(self._path)
+            except OSError:
+                pass
+
+def _test():
+    "Test docstrings in module."
+    import doctest
+    doctest.testmod()
+
+if __name__ == '__main__':
+    _test()
+    print 'Test finished.'
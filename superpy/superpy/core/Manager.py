@@ -1,8 +1,8 @@
 """Module providing a client manager to help distribute tasks over superpy.
 """
 
-import datetime, socket, logging, math, cPickle
-import TaskInfo, Process, Tasks
+import datetime, socket, logging, math, cPickle, threading, Queue, time, copy
+import TaskInfo, Process, Tasks, PicklingXMLRPC
 
 class GenericElement:
     """Abstract class representing a generic element we can process in parallel.
@@ -28,6 +28,15 @@ class GenericElement:
         """
         raise NotImplementedError
 
+    def Idempotent(self):
+        """Return True if it is safe to run this element more than once.
+
+        Only idempotent elements are run speculatively (see ProcParams).
+        Sub-classes whose Run method has no side effects other than
+        computing the result can override this to return True.
+        """
+        return False
+
 class SimpleElementProcessor:
     """Class to handle processing a list of elements in parallel.
 
@@ -84,7 +93,8 @@ Entering service loop forever or until killed...
 ... scheduler, myElements, workingDir='c:/')
 >>> processor.Process() #doctest: +ELLIPSIS
 >>> print ','.join([
-... '%.4f'%result for (_name, result) in sorted(processor.results)])
+... '%.4f'%result for (_name, result) in sorted(
+...     processor.results, key=lambda pair: pair[0].target)])
 0.0000,1.0000,1.4142,1.7321
     """
 
@@ -131,11 +141,13 @@ Entering service loop forever or until killed...
                         of all elements in self.elementList. It works by
                         calling the ProcessElements function and passing
                         in self._DecorateElement, self._DispatchElement,
-                        self._HandleResult and procArgs.
+                        self._HandleResult, procArgs, and
+                        self._SpeculateElement.
         
         """
         ProcessElements(self.elementList, self._DecorateElement,
-                        self._DispatchElement, self._HandleResult, procParams)
+                        self._DispatchElement, self._HandleResult, procParams,
+                        self._SpeculateElement)
 
     def _DecorateElement(self, element):
         """Decoreate element in preparation for dispatch it to be processed.
@@ -205,13 +217,8 @@ Entering service loop forever or until killed...
         
         """
         if (self.scheduler):
-            logging.debug('Creating impersonating task for element %s' %
-                          element.Name())
-            impTask = Tasks.ImpersonatingTask(
-                element, workingDir=self.workingDir, prependPaths=None,
-                wrapTask=True, mode='createProcess', name=element.Name(),
-                **self.credentials)
-            handle = self.scheduler.SubmitTaskToBestServer(impTask)
+            handle = self.scheduler.SubmitTaskToBestServer(
+                self._MakeTask(element, element.Name()))
             return handle
         else:
             logging.debug('Locally running element for %s' % element.Name())
@@ -219,6 +226,43 @@ Entering service loop forever or until killed...
             return TaskInfo.StaticHandle(element.Name(), {
                 'result' : cPickle.dumps(result)})
 
+    def _SpeculateElement(self, element, handle):
+        """Dispatch a second copy of an element which is taking too long.
+        
+        INPUTS:
+        
+        -- element:        A decorated element we already dispatched.
+        
+        -- handle:         Handle for the dispatched copy.
+        
+        -------------------------------------------------------
+        
+        RETURNS:        Handle for a copy of element running on a server
+                        other than the one handle is on or None if that
+                        is not possible.
+        
+        -------------------------------------------------------
+        
+        PURPOSE:        Used by ProcessElements when speculation is turned
+                        on in ProcParams. Sub-classes which override
+                        _DispatchElement may want to override this too.
+        
+        """
+        if (not self.scheduler or not hasattr(handle, 'host')):
+            return None
+        return self.scheduler.SubmitTaskElsewhere(
+            self._MakeTask(element, element.Name() + '_speculative'),
+            [(handle.host, handle.port)])
+
+    def _MakeTask(self, element, name):
+        "Return ImpersonatingTask with given name to run element remotely."
+
+        logging.debug('Creating impersonating task for element %s' % name)
+        return Tasks.ImpersonatingTask(
+            element, workingDir=self.workingDir, prependPaths=None,
+            wrapTask=True, mode='createProcess', name=name,
+            **self.credentials)
+
 class ExampleElement(GenericElement):
     """Example of GenericElement useful in doctests.
     """
@@ -261,7 +305,8 @@ class ProcParams:
     """Class containing parameters on how to do processing for ProcessElements.
     """
 
-    def __init__(self, maxTime=0, maxUnfinished=4):
+    def __init__(self, maxTime=0, maxUnfinished=4, speculatePercentile=None,
+                 speculateMinFinished=5):
         """Initializer
 
         INPUTS:
@@ -275,13 +320,25 @@ class ProcParams:
                         time. If this many elements have been spawned, we
                         wait for at least one to finish before spawning more.
 
+        -- speculatePercentile=None:  Optional number between 0 and 1. If
+                        given, an element which has been out longer than
+                        this percentile of how long finished elements took
+                        gets a second copy dispatched to a different server
+                        (see ProcessElements). Only elements whose
+                        Idempotent method returns True are copied.
+
+        -- speculateMinFinished=5:  Number of elements which must finish
+                        before we start copying slow ones.
+
         """
         self.maxTime = maxTime
         self.maxUnfinished = maxUnfinished
+        self.speculatePercentile = speculatePercentile
+        self.speculateMinFinished = speculateMinFinished
 
 
 def ProcessElements(elements, decorateElement, dispatchElement, handleResult,
-                    procParams=None):
+                    procParams=None, speculateElement=None):
     """Process elements in parallel.
     
     INPUTS:
@@ -306,6 +363,12 @@ def ProcessElements(elements, decorateElement, dispatchElement, handleResult,
 
     -- procParams=None: Instance of ProcParams class describing how to
                         do the processing.
+
+    -- speculateElement=None:  Optional callable object that can be given
+                        a decorated element and the handle for it and
+                        dispatches another copy somewhere else, returning
+                        the new handle (or None if it cannot). This is only
+                        used if procParams.speculatePercentile is set.
         
     -------------------------------------------------------
     
@@ -313,9 +376,19 @@ def ProcessElements(elements, decorateElement, dispatchElement, handleResult,
                 and process them with whatever superpy servers you have
                 available. This function handles issues like spawning each
                 element in a new task, waiting for them to finish, etc.
+
+                If speculation is turned on, idempotent elements which
+                are much slower than the rest (e.g., because they landed
+                on a slow host) get a second copy dispatched. Whichever
+                copy finishes first gives the result and the other is
+                killed. See _Speculator for details.
     
     """
     if (procParams is None): procParams = ProcParams()
+    speculator = None
+    if (procParams.speculatePercentile is not None and
+        speculateElement is not None):
+        speculator = _Speculator(procParams, speculateElement)
     unfinishedHandles = []
     numElements = len(elements)
     elementNum = 0
@@ -323,21 +396,50 @@ def ProcessElements(elements, decorateElement, dispatchElement, handleResult,
         element = elements[elementNum]
         decoratedElement = decorateElement(element)
         handle = dispatchElement(decoratedElement)
+        if (speculator is not None):
+            speculator.Dispatched(element, decoratedElement)
         unfinishedHandles.append((handle, decoratedElement))
         elementNum += 1
         untilFinished = None if (len(unfinishedHandles) <
                                  procParams.maxUnfinished) else 1
-        finishedHandles, unfinishedHandles = WaitForTasks(
-            unfinishedHandles, untilFinished=untilFinished,
-            maxTime=procParams.maxTime)
+        unfinishedHandles = _WaitForElements(
+            unfinishedHandles, untilFinished, procParams.maxTime,
+            handleResult, speculator)
+    _WaitForElements(unfinishedHandles, len(unfinishedHandles), 0,
+                     handleResult, speculator)
+
+def _WaitForElements(handles, untilFinished, maxTime, handleResult,
+                     speculator):
+    """Wait for elements, handle results, and return unfinished handles.
+
+    This is like calling WaitForTasks and then CleanupFinishedHandles
+    except that if speculator is not None, we also wake up when the next
+    element may become a straggler so it can be copied.
+    """
+    if (speculator is None):
+        finishedHandles, handles = WaitForTasks(
+            handles, untilFinished=untilFinished, maxTime=maxTime)
         CleanupFinishedHandles(finishedHandles, handleResult)
-    finishedHandles, unfinishedHandles = WaitForTasks(
-        unfinishedHandles, untilFinished=len(unfinishedHandles))
-    CleanupFinishedHandles(finishedHandles, handleResult)
+        return handles
+    numFinished = 0
+    while True:
+        finishedHandles, handles = WaitForTasks(
+            handles, untilFinished=None if untilFinished is None else (
+                untilFinished - numFinished), maxTime=maxTime,
+            maxWait=speculator.MaxWait(handles))
+        finishedHandles, handles = speculator.Finished(
+            finishedHandles, handles)
+        CleanupFinishedHandles(finishedHandles, handleResult)
+        numFinished += len(finishedHandles)
+        handles = handles + speculator.Stragglers(handles)
+        if (untilFinished is None or numFinished >= untilFinished or
+            not handles):
+            return handles
 
 
 
-def WaitForTasks(handles, untilFinished=None, maxTime=0, handleException=None):
+def WaitForTasks(handles, untilFinished=None, maxTime=0, handleException=None,
+                 serverWait=10, maxWait=None):
     """Wait for tasks to finish.
 
     INPUTS:
@@ -357,6 +459,13 @@ def WaitForTasks(handles, untilFinished=None, maxTime=0, handleException=None):
                                 This will be called whenever we get an
                                 exception waiting for a task.
 
+    -- serverWait=10:  Maximum seconds a server holds a request open while
+                       waiting for one of our tasks to finish.
+
+    -- maxWait=None:   Optional maximum seconds to wait. If given, we
+                       return after about this long even if fewer than
+                       untilFinished tasks have finished.
+
     -------------------------------------------------------
 
     RETURNS:        The pair of lists (finishedHandles, unfinishedHandles)
@@ -366,10 +475,14 @@ def WaitForTasks(handles, untilFinished=None, maxTime=0, handleException=None):
 
     -------------------------------------------------------
 
-    PURPOSE:        Takes a list of taskHandles, periodically checking if
-                    some or all are finished. When all tasks are
-                    done, return a list of handles to the finished
-                    tasks. 
+    PURPOSE:        Takes a list of taskHandles, checking if some or all
+                    are finished. When all tasks are done, return a
+                    list of handles to the finished tasks. 
+
+                    If untilFinished is not None, we wait for handles
+                    on superpy servers by asking each server to tell us
+                    as soon as any of our tasks there finishes (see
+                    _TaskWaiter) rather than polling each task.
     """
     numHandles = len(handles)    
     if (handleException is None):
@@ -377,15 +490,23 @@ def WaitForTasks(handles, untilFinished=None, maxTime=0, handleException=None):
             'Ignoring exception %s' % str(exc))
         
     threshold = datetime.datetime.now() + datetime.timedelta(maxTime)
+    if (maxWait is not None):
+        stopTime = time.time() + maxWait
+        serverWait = min(serverWait, maxWait)
     finishedHandles, tempHandles = [], []
+    waiter = _TaskWaiter(serverWait)
     keepGoing = True
     while(keepGoing):
         tempHandles = []
-        for (handle, element) in handles:
-            newHandle = None
+        updates = waiter.Updates([h for (h, _e) in handles],
+                                 block=(untilFinished is not None))
+        for ((handle, element), update) in zip(handles, updates):
+            newHandle, oldInfo = None, {}
             try:
                 oldInfo = handle.StatusInfo()                
-                newHandle = handle.UpdatedHandle(timeout = 3)
+                if (isinstance(update, Exception)):
+                    raise update
+                newHandle = handle if update is None else update
                 info = newHandle.StatusInfo()
                 if (info['mode'] == 'finished'):
                     finishedHandles.append((newHandle, element))
@@ -422,10 +543,329 @@ def WaitForTasks(handles, untilFinished=None, maxTime=0, handleException=None):
         handles = tempHandles
         keepGoing = (len(handles) > 0 and (
             untilFinished is not None and len(finishedHandles) < untilFinished))
+        if (maxWait is not None and time.time() >= stopTime):
+            keepGoing = False
     assert len(finishedHandles)+len(tempHandles) == numHandles
         
     return finishedHandles, tempHandles
 
+class _TaskWaiter:
+    """Helper for WaitForTasks to find out when tasks finish.
+
+    Handles for tasks on superpy servers are grouped by server and each
+    server gets a single WaitForAny request for all of our tasks on it.
+    When blocking, each server is asked in its own thread and we return
+    as soon as any of them replies. Servers still thinking about an
+    earlier request are not asked again until they reply. Other kinds of
+    handles, and servers without WaitForAny, are updated one at a time
+    with UpdatedHandle.
+
+    A busy server may answer WaitForAny right away with no news instead
+    of holding the request open; we then pause up to busyPause seconds
+    before asking again so we do not flood it with requests.
+    """
+
+    busyPause = 1.0
+
+    def __init__(self, serverWait):
+        self.serverWait = serverWait
+        self.replies = Queue.Queue()
+        self.outstanding = set()
+
+    @staticmethod
+    def _ServerKey(handle):
+        "Return (host, port) for handle on a superpy server or None."
+
+        if (isinstance(handle, TaskInfo.TaskHandle) and
+            not getattr(handle, '_tokens', [])):
+            return (handle.host, handle.port)
+        return None
+
+    @staticmethod
+    def _UpdateEach(handles):
+        """Return dict mapping names to updated handles or exceptions.
+
+        We update copies since UpdatedHandle makes the handle it is
+        called on stale and a thread asking a server may still be running
+        after WaitForTasks has returned the original handles.
+        """
+
+        result = {}
+        for handle in handles:
+            try:
+                result[handle.Name()] = copy.copy(handle).UpdatedHandle(
+                    timeout = 3)
+            except Exception, e:
+                result[handle.Name()] = e
+        return result
+
+    def _AskServer(self, key, handles, wait):
+        "Return dict mapping names to handles of finished tasks on server."
+
+        try:
+            connection = PicklingXMLRPC.PicklingServerProxy(
+                'http://%s:%i' % key)
+            finished = connection.WaitForAny(
+                [h.Name() for h in handles], wait)
+            return dict([(h.Name(), h) for h in finished])
+        except Exception, e:
+            logging.debug('WaitForAny failed for %s:%s (%s); updating each'
+                          % (key[0], key[1], str(e)))
+            return self._UpdateEach(handles)
+
+    def _AskServerInThread(self, key, handles):
+        "Ask server for finished tasks and put reply in self.replies."
+
+        start = time.time()
+        reply = self._AskServer(key, handles, self.serverWait)
+        if (not reply):
+            time.sleep(max(0, min(self.busyPause, start + self.serverWait
+                                  - time.time())))
+        self.replies.put((key, reply))
+
+    def Updates(self, handles, block):
+        """Find out which handles have new information.
+        
+        INPUTS:
+        
+        -- handles:        List of handles we are waiting for.
+        
+        -- block:          Whether to wait until something finishes.
+        
+        -------------------------------------------------------
+        
+        RETURNS:        List with one item per handle which is either an
+                        updated handle, an exception raised while trying
+                        to update it, or None if there is no news.
+        
+        """
+        byServer, others = {}, []
+        for handle in handles:
+            key = self._ServerKey(handle)
+            if (key is None):
+                others.append(handle)
+            else:
+                byServer.setdefault(key, []).append(handle)
+        news = self._UpdateEach(others)
+        anyFinished = [1 for update in news.values() if not isinstance(
+            update, Exception) and update.StatusInfo()['mode'] == 'finished']
+        if (not block or anyFinished or not byServer):
+            for (key, serverHandles) in byServer.items():
+                if (key not in self.outstanding):
+                    news.update(self._AskServer(key, serverHandles, 0))
+        else:
+            for (key, serverHandles) in byServer.items():
+                if (key not in self.outstanding):
+                    self.outstanding.add(key)
+                    thread = threading.Thread(
+                        target=self._AskServerInThread,
+                        args=(key, serverHandles))
+                    thread.setDaemon(True)
+                    thread.start()
+            key, reply = self.replies.get()
+            self.outstanding.discard(key)
+            news.update(reply)
+        while True: # collect anything else which has come in
+            try:
+                key, reply = self.replies.get_nowait()
+            except Queue.Empty:
+                break
+            self.outstanding.discard(key)
+            news.update(reply)
+        return [news.get(handle.Name()) for handle in handles]
+
+class _Speculator:
+    """Helper for ProcessElements to copy elements which are much too slow.
+
+    We remember when each element was dispatched and how long finished
+    elements took. Once procParams.speculateMinFinished elements have
+    finished, an idempotent element which has been out for longer than
+    the procParams.speculatePercentile percentile of those times gets a
+    second copy dispatched via speculateElement. The first copy to
+    finish gives the result and we kill the other with RemoveFromQueue
+    (via handle.Kill) in a separate thread since that can take a few
+    seconds. Each element is copied at most once.
+
+>>> from superpy.core import Manager, TaskInfo
+>>> class FakeElement(Manager.GenericElement):
+...     def __init__(self, name): self.name = name
+...     def Name(self): return self.name
+...     def Idempotent(self): return self.name != 'unsafe'
+... 
+>>> class Handle(TaskInfo.StaticHandle):
+...     def __init__(self, name, finished):
+...         TaskInfo.StaticHandle.__init__(self, name, {'result' : name,
+...             'mode' : 'finished' if finished else 'running'})
+...     def Kill(self): print 'killed', self.Name()
+...     def Cleanup(self): print 'cleaned', self.Name()
+... 
+>>> copied = []
+>>> def Copy(element, handle):
+...     copied.append(element.Name())
+...     return Handle(element.Name() + '_copy', False)
+... 
+>>> speculator = Manager._Speculator(Manager.ProcParams(
+...     speculatePercentile=0.5, speculateMinFinished=2), Copy)
+>>> elements = [FakeElement(n) for n in ['a', 'b', 'slow', 'unsafe']]
+>>> for element in elements:
+...     speculator.Dispatched(element, element)
+... 
+>>> pairs = [(Handle(e.Name(), False), e) for e in elements]
+>>> print speculator.MaxWait(pairs), speculator.Stragglers(pairs)
+None []
+>>> time.sleep(0.2)
+>>> finished, pairs = speculator.Finished([(Handle('a', True), elements[0])],
+...                                       pairs[1:])
+>>> speculator.Stragglers(pairs), copied # only one finished so far
+([], [])
+>>> finished, pairs = speculator.Finished([(Handle('b', True), elements[1])],
+...                                       pairs[1:])
+>>> 0 < speculator.MaxWait(pairs) <= 1
+True
+>>> pairs += speculator.Stragglers(pairs)
+>>> [(h.Name(), e.Name()) for (h, e) in pairs]
+[('slow', 'slow'), ('unsafe', 'unsafe'), ('slow_copy', 'slow')]
+>>> speculator.Stragglers(pairs), copied # at most one copy
+([], ['slow'])
+>>> finished, pairs = speculator.Finished(
+...     [(Handle('slow_copy', True), elements[2])], pairs[0:2])
+>>> speculator.discarding.pop().join()
+killed slow
+>>> [h.Name() for (h, e) in finished], [h.Name() for (h, e) in pairs]
+(['slow_copy'], ['unsafe'])
+>>> finished, pairs = speculator.Finished(
+...     [(Handle('slow', True), elements[2])], pairs)
+>>> speculator.discarding.pop().join()
+cleaned slow
+>>> finished, [h.Name() for (h, e) in pairs]
+([], ['unsafe'])
+    """
+
+    def __init__(self, procParams, speculateElement):
+        self.percentile = procParams.speculatePercentile
+        self.minFinished = procParams.speculateMinFinished
+        self.speculateElement = speculateElement
+        # The following are keyed by id of decorated element
+        self.dispatched = {}     # time element was dispatched
+        self.idempotent = set()  # elements we may copy
+        self.copied = set()      # elements we have copied
+        self.done = set()        # elements which gave a result
+        self.runTimes = []
+        self.discarding = []     # threads getting rid of extra copies
+
+    def Dispatched(self, element, decoratedElement):
+        "Note that element (decorated as decoratedElement) was dispatched."
+
+        key = id(decoratedElement)
+        self.dispatched[key] = time.time()
+        if (getattr(element, 'Idempotent', lambda : False)()):
+            self.idempotent.add(key)
+
+    def Threshold(self):
+        "Return seconds after which an element is a straggler or None."
+
+        if (len(self.runTimes) < max(1, self.minFinished)):
+            return None
+        runTimes = sorted(self.runTimes)
+        return runTimes[min(len(runTimes) - 1,
+                            int(self.percentile * len(runTimes)))]
+
+    def _Candidates(self, handles):
+        "Return (handle, element, seconds out) for elements we may copy."
+
+        now = time.time()
+        return [(h, e, now - self.dispatched[id(e)]) for (h, e) in handles
+                if id(e) in self.idempotent and id(e) not in self.copied]
+
+    def MaxWait(self, handles):
+        "Return seconds until an element in handles may be a straggler."
+
+        threshold = self.Threshold()
+        candidates = self._Candidates(handles)
+        if (threshold is None or not candidates):
+            return None
+        return max(1, threshold - max([out for (_h, _e, out) in candidates]))
+
+    def Stragglers(self, handles):
+        """Copy stragglers in handles.
+        
+        INPUTS:
+        
+        -- handles:        List of (handle, element) pairs not yet finished.
+        
+        -------------------------------------------------------
+        
+        RETURNS:        List of (handle, element) pairs for new copies.
+        
+        """
+        threshold = self.Threshold()
+        if (threshold is None):
+            return []
+        copies = []
+        for (handle, element, out) in self._Candidates(handles):
+            if (out <= threshold):
+                continue
+            self.copied.add(id(element))
+            logging.info('Element %s out for %.1fs (threshold %.1fs); copying'
+                         % (element.Name(), out, threshold))
+            try:
+                newHandle = self.speculateElement(element, handle)
+            except Exception, e:
+                logging.warning('Unable to copy %s: %s' % (element.Name(), e))
+                continue
+            if (newHandle is not None):
+                copies.append((newHandle, element))
+        return copies
+
+    def Finished(self, finishedHandles, handles):
+        """Keep first copy of each element to finish and kill the rest.
+        
+        INPUTS:
+        
+        -- finishedHandles:  List of (handle, element) pairs which finished.
+        
+        -- handles:          List of (handle, element) pairs not finished.
+        
+        -------------------------------------------------------
+        
+        RETURNS:        The pair (finishedHandles, handles) with copies of
+                        elements which already gave a result removed.
+        
+        """
+        winners = []
+        for (handle, element) in finishedHandles:
+            key = id(element)
+            if (key in self.done):
+                self._Discard(handle, element, handle.Cleanup)
+                continue
+            self.done.add(key)
+            self.runTimes.append(time.time() - self.dispatched[key])
+            winners.append((handle, element))
+        remaining = []
+        for (handle, element) in handles:
+            if (id(element) in self.done):
+                self._Discard(handle, element, handle.Kill)
+            else:
+                remaining.append((handle, element))
+        return winners, remaining
+
+    def _Discard(self, handle, element, method):
+        "Call method in a thread to get rid of copy of element we don't need."
+
+        logging.info('Discarding extra copy %s of element %s' % (
+            handle.Name(), element.Name()))
+        def Discard():
+            try:
+                method()
+            except Exception, e:
+                logging.warning('Unable to discard %s: %s' % (
+                    handle.Name(), e))
+        self.discarding = [t for t in self.discarding if t.isAlive()]
+        thread = threading.Thread(target=Discard)
+        thread.setDaemon(True)
+        thread.start()
+        self.discarding.append(thread)
+
 def CleanupFinishedHandles(finishedHandles, handleResult):
     """Cleanup handles that have finished running.
 
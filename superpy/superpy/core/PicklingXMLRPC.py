@@ -12,12 +12,33 @@ to solve these problems. Basically, you can just use PicklingServerProxy
 as a drop-in replacement for xmlrpclib.Server/ServerProxy and use
 PicklingXMLRPCServer as a drop-in replacement for SimpleXMLRPCServer. See
 documentation for those classes for details.
+
+PicklingServerProxy uses KeepAliveTransport by default so that repeated
+calls from the same thread reuse one HTTP/1.1 connection instead of
+opening a new TCP connection per call. The socket timeout is a property
+of each transport so you should pass a timeout to PicklingServerProxy
+instead of changing socket.setdefaulttimeout (which affects every
+thread in the process).
+
+KeepAliveTransport also compresses large requests and responses with
+zlib when the other side supports it. It asks for compressed responses
+with an Accept-Encoding: deflate header. It only compresses requests
+after the server says (with an Accept-Encoding header on a response)
+that it accepts them, so old servers keep working. Bodies smaller than
+a threshold, or which do not look compressible, are sent as they are.
+Servers.NewRequestHandler implements the server side. See
+CompressionStats for the bytes and CPU time involved.
 """
 
-import xmlrpclib, cPickle, sys, logging, traceback
+import xmlrpclib, cPickle, sys, logging, traceback, threading, socket, httplib
+import zlib, time, copy
 from SimpleXMLRPCServer import SimpleXMLRPCServer
 from SuperExceptions import RemoteException
 
+# Pass as a timeout to use socket.getdefaulttimeout() at the time of each
+# request (as opposed to None which means no timeout).
+DEFAULT_TIMEOUT = socket._GLOBAL_DEFAULT_TIMEOUT
+
 class _PicklingMethod(xmlrpclib._Method):
     """Modifies xmlrpclib._Method to pickle params and report remote exceptions.
     """
@@ -42,12 +63,334 @@ class _PicklingMethod(xmlrpclib._Method):
         if (isinstance(result,RemoteException)): raise result
         else: return result
 
+# Default zlib level and size in bytes below which bodies are not
+# compressed. A level of 0 turns compression off.
+COMPRESS_LEVEL = 6
+COMPRESS_THRESHOLD = 64 << 10
+
+# Compress a sample of this many bytes to guess whether compressing a
+# whole body is worth it and skip compression if the sample shrinks by
+# less than COMPRESS_MIN_SAVING (e.g., data which is already compressed).
+_COMPRESS_SAMPLE = 64 << 10
+COMPRESS_MIN_SAVING = 0.1
+
+class CompressionStats:
+    """Thread safe counts of bytes before and after compression.
+
+    The counts (see Info) are:
+
+      sentBytes, sentWireBytes:          Bodies we sent before and after
+                                         compression.
+      receivedBytes, receivedWireBytes:  Bodies we received after and
+                                         before decompression.
+      compressed, skipped:               Bodies we compressed or sent as
+                                         they were (too small, not
+                                         compressible, or not accepted).
+      compressSeconds, decompressSeconds:  Time spent in zlib (which is
+                                           CPU bound so about the same
+                                           as CPU time).
+
+>>> import PicklingXMLRPC
+>>> stats = PicklingXMLRPC.CompressionStats()
+>>> body = 'word count ' * 10000
+>>> wire, encoded = PicklingXMLRPC.Compress(body, 6, 1000, stats)
+>>> encoded, len(wire) < len(body) / 10
+(True, True)
+>>> reader = PicklingXMLRPC.InflatingReader([wire], stats=stats)
+>>> ''.join(iter(lambda : reader.read(4096), '')) == body
+True
+>>> PicklingXMLRPC.Compress('short', 6, 1000, stats)
+('short', False)
+>>> import os; random = os.urandom(5000)
+>>> PicklingXMLRPC.Compress(random, 6, 1000, stats) == (random, False)
+True
+>>> info = stats.Info()
+>>> [info[k] for k in ['sentBytes', 'compressed', 'skipped', 'receivedBytes']]
+[115005, 1, 2, 110000]
+>>> info['sentWireBytes'] == len(wire) + 5005, info['compressSeconds'] > 0
+(True, True)
+    """
+
+    _names = ['sentBytes', 'sentWireBytes', 'receivedBytes',
+              'receivedWireBytes', 'compressed', 'skipped',
+              'compressSeconds', 'decompressSeconds']
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = dict([(n, 0) for n in self._names])
+
+    def Add(self, **counts):
+        "Add the given amounts to the named counts."
+
+        self._lock.acquire()
+        try:
+            for (name, amount) in counts.items():
+                self._counts[name] += amount
+        finally:
+            self._lock.release()
+
+    def Info(self):
+        "Return dictionary with a copy of the counts."
+
+        self._lock.acquire()
+        try:
+            return dict(self._counts)
+        finally:
+            self._lock.release()
+
+def Compress(data, level=COMPRESS_LEVEL, threshold=COMPRESS_THRESHOLD,
+             stats=None):
+    """Compress data with zlib if it is large and compressible.
+    
+    INPUTS:
+    
+    -- data:        String body to send.
+    
+    -- level=COMPRESS_LEVEL:  Level for zlib.compress (0 means never
+                              compress).
+    
+    -- threshold=COMPRESS_THRESHOLD:  Do not compress data shorter than
+                                      this.
+    
+    -- stats=None:  Optional CompressionStats to update.
+    
+    -------------------------------------------------------
+    
+    RETURNS:        The pair (body, compressed) where body is what to
+                    send and compressed is True if body is compressed.
+    
+    """
+    body, compressed = data, False
+    start = time.time()
+    if (level and len(data) >= threshold):
+        sample = data[:_COMPRESS_SAMPLE]
+        if (len(zlib.compress(sample, 1)) < (
+            1 - COMPRESS_MIN_SAVING) * len(sample)):
+            body = zlib.compress(data, level)
+            compressed = len(body) < len(data)
+            if (not compressed):
+                body = data
+    if (stats is not None):
+        stats.Add(sentBytes=len(data), sentWireBytes=len(body),
+                  compressed=int(compressed), skipped=int(not compressed),
+                  compressSeconds=time.time() - start)
+    return body, compressed
+
+class InflatingReader:
+    """File-like object which decompresses pieces of a compressed body.
+
+    This lets us parse a compressed body without holding all of it
+    decompressed at once (and refuse to decompress too much of it).
+    """
+
+    def __init__(self, pieces, wbits=zlib.MAX_WBITS, maxBytes=None,
+                 stats=None):
+        """Initializer.
+        
+        INPUTS:
+        
+        -- pieces:         Iterable of pieces of compressed body or a
+                           file-like object to read compressed body from.
+        
+        -- wbits=zlib.MAX_WBITS:  As for zlib.decompressobj (add 16 for
+                                  gzip format).
+        
+        -- maxBytes=None:  If not None, raise ValueError if the body
+                           decompresses to more than this many bytes.
+        
+        -- stats=None:     Optional CompressionStats to update.
+        
+        """
+        if (hasattr(pieces, 'read')):
+            stream = pieces
+            pieces = iter(lambda : stream.read(1 << 16), '')
+        self._pieces = iter(pieces)
+        self._inflater = zlib.decompressobj(wbits)
+        self._maxBytes = maxBytes
+        self._stats = stats
+        self._total = 0
+        self._done = False
+
+    def read(self, size):
+        "Return up to size decompressed bytes ('' at the end)."
+
+        result = ''
+        while (not result and not self._done):
+            start = time.time()
+            tail = self._inflater.unconsumed_tail
+            if (tail):
+                wire, result = 0, self._inflater.decompress(tail, size)
+            else:
+                piece = next(self._pieces, None)
+                if (piece is None):
+                    wire, result = 0, self._inflater.flush()
+                    self._done = True
+                else:
+                    wire = len(piece)
+                    result = self._inflater.decompress(piece, size)
+            self._total += len(result)
+            if (self._stats is not None):
+                self._stats.Add(receivedBytes=len(result),
+                                receivedWireBytes=wire,
+                                decompressSeconds=time.time() - start)
+            if (self._maxBytes is not None and self._total > self._maxBytes):
+                raise ValueError('Body decompresses to more than %i bytes' % (
+                    self._maxBytes))
+        return result
+
+class KeepAliveTransport(xmlrpclib.Transport):
+    """Transport which keeps one persistent HTTP connection per thread.
+
+    The stock xmlrpclib.Transport keeps a single connection which is not
+    safe to share between threads. This version keeps a separate
+    connection for each thread using the transport so a proxy can be
+    shared by many threads. If the server closed a kept connection, the
+    retry in xmlrpclib.Transport.request reconnects and sends the
+    request again.
+    """
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, *args, **kw):
+        """Initializer.
+        
+        INPUTS:
+        
+        -- timeout=DEFAULT_TIMEOUT:  Socket timeout in seconds or None for
+                                     no timeout. If DEFAULT_TIMEOUT, we use
+                                     socket.getdefaulttimeout() at the time
+                                     of each request.
+        
+        -- compressLevel=COMPRESS_LEVEL:  Keyword argument with zlib level
+                                          for requests (0 to never
+                                          compress them).
+        
+        -- compressThreshold=COMPRESS_THRESHOLD:  Keyword argument giving
+                                                  smallest request to
+                                                  compress.
+        
+        -- *args, **kw:    Passed to xmlrpclib.Transport.__init__.
+        """
+        self.compressLevel = kw.pop('compressLevel', COMPRESS_LEVEL)
+        self.compressThreshold = kw.pop(
+            'compressThreshold', COMPRESS_THRESHOLD)
+        xmlrpclib.Transport.__init__(self, *args, **kw)
+        self.timeout = timeout
+        self._local = threading.local()
+        self.stats = CompressionStats()
+        self._serverInflates = False # True once server says it accepts deflate
+
+    def WithTimeout(self, timeout):
+        """Return transport like self but with the given socket timeout.
+
+        The new transport shares our connections and stats, so making one
+        for each call with its own timeout opens no new sockets.
+        """
+        result = copy.copy(self)
+        result.timeout = timeout
+        return result
+
+    def send_request(self, connection, handler, request_body):
+        "Start request and ask for a compressed response."
+
+        connection.putrequest("POST", handler, skip_accept_encoding=True)
+        connection.putheader("Accept-Encoding", "deflate, gzip")
+
+    def send_content(self, connection, request_body):
+        "Send request body (compressed if the server accepts that)."
+
+        connection.putheader("Content-Type", "text/xml")
+        if (self._serverInflates):
+            request_body, compressed = Compress(
+                request_body, self.compressLevel, self.compressThreshold,
+                self.stats)
+            if (compressed):
+                connection.putheader("Content-Encoding", "deflate")
+        else:
+            self.stats.Add(sentBytes=len(request_body), skipped=1,
+                           sentWireBytes=len(request_body))
+        connection.putheader("Content-Length", str(len(request_body)))
+        connection.endheaders(request_body)
+
+    def parse_response(self, response):
+        "Parse response, decompressing it if necessary."
+
+        if ('deflate' in response.getheader('Accept-Encoding', '')):
+            self._serverInflates = True
+        if (response.getheader('Content-Encoding', '') != 'deflate'):
+            size = response.getheader('Content-Length')
+            if (size is not None and size.isdigit()):
+                self.stats.Add(receivedBytes=int(size),
+                               receivedWireBytes=int(size))
+            return xmlrpclib.Transport.parse_response(self, response)
+        stream = InflatingReader(response, stats=self.stats)
+        parser, unmarshaller = self.getparser()
+        while True:
+            data = stream.read(1 << 16)
+            if (not data):
+                break
+            parser.feed(data)
+        parser.close()
+        return unmarshaller.close()
+
+    def make_connection(self, host):
+        "Return connection to host for this thread, reusing it if possible."
+
+        connection = getattr(self._local, 'connection', None)
+        if (connection is None or connection[0] != host):
+            self.close()
+            chost, self._extra_headers, _x509 = self.get_host_info(host)
+            connection = (host, httplib.HTTPConnection(chost))
+            self._local.connection = connection
+        timeout = self.timeout
+        if (timeout is DEFAULT_TIMEOUT):
+            timeout = socket.getdefaulttimeout()
+        connection[1].timeout = timeout
+        if (connection[1].sock is not None):
+            connection[1].sock.settimeout(timeout)
+        return connection[1]
+
+    def close(self):
+        "Close the connection for this thread (if any)."
+
+        connection = getattr(self._local, 'connection', None)
+        self._local.connection = None
+        if (connection is not None):
+            connection[1].close()
+
 class PicklingServerProxy(xmlrpclib.ServerProxy):
     """Overrides xmlrpclib.Server/ServerProxy to pickle params.
 
     You can use this as a drop-in replacement to xmlrpclib.ServerProxy
     to automatically pickle arguments you send to a PicklingXMLRPCServer.
     """
+
+    def __init__(self, uri, transport=None, timeout=DEFAULT_TIMEOUT,
+                 *args, **kw):
+        """Initializer.
+        
+        INPUTS:
+        
+        -- uri:             URI of server to connect to.
+        
+        -- transport=None:  Optional transport. If None and uri is http,
+                            we use a KeepAliveTransport.
+        
+        -- timeout=DEFAULT_TIMEOUT:  Socket timeout for KeepAliveTransport
+                                     (see KeepAliveTransport.__init__).
+        
+        -- compressLevel, compressThreshold:  Optional keyword arguments
+                                              for KeepAliveTransport.
+        
+        -- *args, **kw:     Passed to xmlrpclib.ServerProxy.__init__.
+        
+        If we make the transport, self.compressionStats is its
+        CompressionStats (and None otherwise).
+        """
+        compression = dict([(k, kw.pop(k)) for k in [
+            'compressLevel', 'compressThreshold'] if k in kw])
+        if (transport is None and uri.lower().startswith('http:')):
+            transport = KeepAliveTransport(timeout=timeout, **compression)
+        self.compressionStats = getattr(transport, 'stats', None)
+        xmlrpclib.ServerProxy.__init__(self, uri, transport, *args, **kw)
     def __getattr__(self, name):
         "Override xmlrpclib.__getattr__ to do pickling/unpickling."
         return _PicklingMethod(self._ServerProxy__request, name)
@@ -63,24 +406,56 @@ class PicklingXMLRPCServer(SimpleXMLRPCServer):
     def _dispatch(self, method, params):
         try:
             unpickledParams = [cPickle.loads(p) for p in params]
-            result = SimpleXMLRPCServer._dispatch(
-                self,method,unpickledParams)
         except Exception, e:
-            (exc_info,exc_type) = (sys.exc_info(),sys.exc_type)
-            logging.debug('In except block...')
-            strParams = str(params)
-            if (len(strParams) > 2048):
-                strParams = strParams[0:(2048-1-3)] + '...'
-            errTrace = ('Exception of type \'' + `exc_type` + '\':  \'' + 
-                        e.__str__() + '\'.\n\n\n' +
-                        ''.join(traceback.format_tb(exc_info[2])) +
-                        `exc_info` + ('\nmethod=%s\nparams=%s\nsys.path=%s' % (
-                str(method), strParams, sys.path)))
-            logging.debug('''Got exception in PicklingXMLRPC:
-            \n%s\n
-            method=%s\nparams=%s\n''' % (errTrace, str(method), strParams))
-            result = RemoteException(errTrace)
+            result = self._ErrorResult(e, method, params)
+        else:
+            result = self.DispatchUnpickled(method, unpickledParams)
         return cPickle.dumps(result)
 
+    def DispatchUnpickled(self, method, params):
+        """Call method with params which are already unpickled.
+        
+        INPUTS:
+        
+        -- method:        String name of method to call.
+        
+        -- params:        Sequence of parameters for method.
+        
+        -------------------------------------------------------
+        
+        RETURNS:        Result of method or a RemoteException describing
+                        the exception it raised.
+        
+        -------------------------------------------------------
+        
+        PURPOSE:        This is what _dispatch does after unpickling. It
+                        is separate so transports which unpickle the
+                        whole request at once (see FramedRPC) can use it.
+        
+        """
+        try:
+            return SimpleXMLRPCServer._dispatch(self,method,params)
+        except Exception, e:
+            return self._ErrorResult(e, method, params)
+
+    @staticmethod
+    def _ErrorResult(e, method, params):
+        "Make RemoteException for exception e being handled in an except."
+        
+        (exc_info,exc_type) = (sys.exc_info(),sys.exc_type)
+        logging.debug('In except block...')
+        strParams = str(params)
+        if (len(strParams) > 2048):
+            strParams = strParams[0:(2048-1-3)] + '...'
+        errTrace = ('Exception of type \'' + `exc_type` + '\':  \'' + 
+                    e.__str__() + '\'.\n\n\n' +
+                    ''.join(traceback.format_tb(exc_info[2])) +
+                    `exc_info` + ('\nmethod=%s\nparams=%s\nsys.path=%s' % (
+            str(method), strParams, sys.path)))
+        logging.debug('''Got exception in PicklingXMLRPC:
+        \n%s\n
+        method=%s\nparams=%s\n''' % (errTrace, str(method), strParams))
+        return RemoteException(errTrace)
+
 
     
@@ -12,7 +12,7 @@ for how to setup a server to listen and how to send it tasks.
 import sys, os, random, subprocess, logging, re, copy, time, threading, cPickle
 import traceback, socket
 
-import PicklingXMLRPC, Forker, TaskInfo
+import PicklingXMLRPC, FramedRPC, Forker, TaskInfo, Blobs
 
 try:
     from superpy.utils import WindowsUtils, WindowsSubprocess, winprocess
@@ -22,6 +22,28 @@ except ImportError, importException:
     This is not a problem if you are not running on windows.
     ''' % str(importException))
 
+def MakeProxy(host, port, timeout=PicklingXMLRPC.DEFAULT_TIMEOUT):
+    """Make a proxy to talk to a RemoteProcess.
+    
+    INPUTS:
+    
+    -- host, port:      As returned by RemoteProcess.SockName or stored
+                        in a PeerRelationship.
+    
+    -- timeout=PicklingXMLRPC.DEFAULT_TIMEOUT:  Socket timeout for proxy.
+    
+    -------------------------------------------------------
+    
+    RETURNS:        A FramedRPC.FramedServerProxy if host is a FramedRPC
+                    address and a PicklingXMLRPC.PicklingServerProxy
+                    otherwise.
+    
+    """
+    if (FramedRPC.IsAddress(host)):
+        return FramedRPC.FramedServerProxy(host, timeout=timeout)
+    return PicklingXMLRPC.PicklingServerProxy(
+        'http://%s:%i' % (host, port), timeout=timeout)
+
 def ChangeUser(domain, user, password):
     """Impersonate a different user.
 
@@ -152,10 +174,41 @@ class RemoteProcess:
     # List of methods a master may call on a student
     _masterMethods = ['ShowPath','SetCWD','ExtendSysPath','ProcessObject',
                       'Die','PrependSysPath','SetUser','Wait','Result',
-                      'CleanFromQueue', 'SetEnv']
+                      'CleanFromQueue', 'SetEnv', 'Bootstrap']
+
+    # While waiting for requests in Run, check every orphanCheck seconds
+    # whether the process which started us has exited and quit if so.
+    # Otherwise idle children (e.g., in a WarmPool) outlive their server.
+    orphanCheck = 30
 
-    def __init__(self):
+    # A child which has not connected back within connectTimeout seconds
+    # of being started (or which exits first) is killed and we raise an
+    # exception instead of waiting forever.
+    connectTimeout = 60
 
+    # Transport to use if none is given to __init__. Talking to children
+    # over 'unix' sockets avoids XML encoding and TCP ports. Use 'tcp'
+    # where Unix domain sockets are not available.
+    defaultTransport = 'unix' if FramedRPC.Available() else 'tcp'
+
+    def __init__(self, transport=None):
+        """Initializer.
+        
+        INPUTS:
+        
+        -- transport=None:  Either 'unix' to listen for requests using
+                            FramedRPC over a Unix domain socket or 'tcp'
+                            to use PicklingXMLRPC over TCP. If None, we
+                            use self.defaultTransport. Children use the
+                            same transport as the master which started
+                            them.
+        
+        """
+        if (transport is None):
+            transport = self.defaultTransport
+        if (transport not in ('unix', 'tcp')):
+            raise ValueError('Invalid transport %s' % repr(transport))
+        self.transport = transport
         self.quit = False
 
         self._peers = {}
@@ -163,6 +216,7 @@ class RemoteProcess:
         self._w32Handle = None
         self._result = None
         self._pipePid = None
+        self._savedState = None
 
     @staticmethod
     def ShowPath():
@@ -320,6 +374,135 @@ class RemoteProcess:
         result = CallIt(obj)
         return result
 
+    def Bootstrap(self, setup, target=None, quitAfter=False):
+        """Set up this process and optionally run a target in one request.
+        
+        INPUTS:
+        
+        -- setup:           Dictionary as made by MakeSetup saying which
+                            user to become, paths to add, working directory
+                            and env vars to set. If setup['restore'] is
+                            True, we put our working directory, env,
+                            sys.path, and sys.modules back the way they
+                            were before our first such Bootstrap once
+                            target finishes so the next task does not
+                            see changes made by this one.
+        
+        -- target=None:     Optional object to run as in ProcessObject
+                            once we are set up.
+        
+        -- quitAfter=False: If True, quit once target finishes without
+                            an exception as if Die were called.
+        
+        -------------------------------------------------------
+        
+        RETURNS:        Result of running target (or None if no target).
+        
+        -------------------------------------------------------
+        
+        PURPOSE:        Calling SetUser, SetEnv, PrependSysPath,
+                        ExtendSysPath, SetCWD, ProcessObject, and Die
+                        separately takes a round trip each. This does
+                        the same things, in the same order, in one.
+        
+        """
+        if (setup.get('restore') and self._savedState is None):
+            self._savedState = (os.getcwd(), dict(os.environ),
+                                list(sys.path), set(sys.modules))
+        try:
+            return self._Bootstrap(setup, target, quitAfter)
+        finally:
+            if (setup.get('restore')):
+                self._RestoreState()
+
+    def _Bootstrap(self, setup, target, quitAfter):
+        "Do the work for Bootstrap."
+
+        user = setup.get('user', None)
+        if (user is not None):
+            logging.info('Change user result = %s' % str(self.SetUser(*user)))
+        if (setup.get('userEnv')):
+            self.SetEnv(setup['userEnv'])
+        if (setup.get('prependPaths')):
+            self.PrependSysPath(setup['prependPaths'])
+        if (setup.get('appendPaths')):
+            self.ExtendSysPath(setup['appendPaths'])
+        if (setup.get('cwd') is not None):
+            self.SetCWD(setup['cwd'])
+        if (setup.get('env')):
+            self.SetEnv(setup['env'])
+        if (setup.get('debug')):
+            logging.info('path of child is:\n\n%s\n\n' % self.ShowPath())
+            logging.info('cwd of child is: %s' % os.getcwd())
+        result = None
+        if (target is not None):
+            result = self.ProcessObject(target)
+        if (quitAfter):
+            self.Die()
+        return result
+
+    def _RestoreState(self):
+        "Restore working directory, env, sys.path, sys.modules saved earlier."
+
+        cwd, environ, path, modules = self._savedState
+        for name in [n for n in sys.modules if n not in modules]:
+            del sys.modules[name]
+        sys.path[:] = path
+        for name in [n for n in os.environ if n not in environ]:
+            del os.environ[name]
+        for (name, value) in environ.items():
+            if (os.environ.get(name) != value):
+                os.environ[name] = value
+        os.chdir(cwd)
+
+    @staticmethod
+    def MakeSetup(fileInfo, mode, credentials, env, debug=False):
+        """Make dictionary describing how to set up a child for Bootstrap.
+        
+        INPUTS:
+        
+        -- fileInfo, mode, credentials, env, debug:  As for SpawnTask.
+        
+        -------------------------------------------------------
+        
+        RETURNS:        Dictionary to pass to Bootstrap.
+        
+        -------------------------------------------------------
+        
+        PURPOSE:        In 'subprocess' mode we ask the child to change
+                        user. In other modes the child was started as
+                        the right user and we only set its USER and
+                        USERNAME env vars.
+
+>>> import Process
+>>> fileInfo = Process.RemoteFileInfo(None, None, None, prependPaths=['a'],
+...                                   workingDir='/tmp')
+>>> setup = Process.RemoteProcess.MakeSetup(fileInfo, 'logonW', {
+...     'domain' : 'd', 'user' : 'u', 'password' : 'p'}, {'X' : '1'})
+>>> [(k, setup[k]) for k in sorted(setup)] # doctest: +NORMALIZE_WHITESPACE
+[('appendPaths', ('.',)), ('cwd', '/tmp'), ('debug', False),
+ ('env', [('X', '1')]), ('prependPaths', ['a']), ('user', None),
+ ('userEnv', [('USERNAME', 'u'), ('USER', 'u')])]
+        """
+        setup = {'prependPaths' : fileInfo.prependPaths,
+                 'appendPaths' : fileInfo.appendPaths,
+                 'cwd' : fileInfo.workingDir, 'env' : (env or {}).items(),
+                 'user' : None, 'userEnv' : None, 'debug' : debug}
+        if (credentials is not None and len(credentials)==3):
+            if (mode == 'subprocess'):
+                logging.info('Requestig change user to %s' %
+                             credentials['user'])
+                setup['user'] = (credentials['domain'], credentials['user'],
+                                 credentials['password'])
+            else:
+                setup['userEnv'] = [('USERNAME',credentials['user']),
+                                    ('USER', credentials['user'])]
+                logging.info('Set child user env vars to: %s' % str(
+                    setup['userEnv']))
+        else:
+            logging.info('Not requestig change user.')                
+        return setup
+
     @staticmethod
     def MakeRandomToken(bits=1024):
         "Make random token with given number of bits."
@@ -357,12 +540,14 @@ class RemoteProcess:
         
         """
         
-        if (self._server is None): self.PrepareServer()
+        if (self._server is None):
+            self.transport = 'unix' if FramedRPC.IsAddress(host) else 'tcp'
+            self.PrepareServer()
         token = self.MakeRandomToken()
         uniqueID = self._GetNewUniqueID()
         newPeers = {token : PeerRelationship(
             host,port,self._masterMethods,uniqueID,'master')}
-        proxy = PicklingXMLRPC.PicklingServerProxy('http://%s:%i'%(host,port))
+        proxy = MakeProxy(host,port)
         myHost, myPort = self.SockName()
         proxy.AcceptStudent(None,myHost,myPort,token)
         self._peers = newPeers
@@ -423,17 +608,25 @@ class RemoteProcess:
         
         PURPOSE:        This sets up a server to listen for requests to
                         this process. This is how we do interprocess
-                        communication.
+                        communication. If self.transport is 'unix', we
+                        ignore host and port and listen on a new
+                        FramedRPC address instead.
         
         """
         
+        if (self.transport == 'unix'):
+            self._server = FramedRPC.FramedRPCServer(FramedRPC.MakeAddress())
+            self._server.register_instance(self)
+            return
         self._server = PicklingXMLRPC.PicklingXMLRPCServer((host,port))
         self._server.allow_reuse_address = 1
         self._server.register_instance(self)        
         self._server.register_introspection_functions()
 
     def SockName(self):
-        "Return socket name for current server."
+        "Return socket name for current server (address and 0 for unix)."
+        if (isinstance(self._server, FramedRPC.FramedRPCServer)):
+            return (self._server.Address(), 0)
         return self._server.socket.getsockname()
         
     def Run(self):
@@ -444,9 +637,15 @@ class RemoteProcess:
         """
         
         if (self._server is None): self.PrepareServer()
+        parent = os.getppid() if hasattr(os, 'getppid') else None
+        if (parent is not None):
+            self._server.timeout = self.orphanCheck
         while not self.quit:
             logging.debug('Waiting for request')
             self._server.handle_request()
+            if (parent is not None and os.getppid() != parent):
+                logging.warning('Parent process %i exited; quitting' % parent)
+                break
         logging.debug('Finished processing requests')            
 
     def SpawnTask(self,target,fileInfo,
@@ -513,73 +712,31 @@ class RemoteProcess:
         """
         if (self._server is None): self.PrepareServer()
 
-        host, port = self.SockName()
-                
-        forkArgs = Forker.MakeCommandLine(
-            fileInfo.exe,Forker.__file__,host,port)
-        
-        childProc, self._pipePid = self._CreateSubprocess(
-            forkArgs,fileInfo,mode,credentials)
+        pool = _warmPool
+        if (wait and pool is not None and pool.Accepts(
+            fileInfo, mode, priority)):
+            return pool.SpawnTask(self, target, fileInfo, credentials, env,
+                                  debug)
 
-        oldToken = self._GetTokenAndPeerWithMaxID()[0]
-        self._server.handle_request() # wait for student to connect back
-        newToken, newPeer = self._GetTokenAndPeerWithMaxID()
-        if (oldToken == newToken):
-            raise Exception('Expected student to connect, but it did not.')
+        childProc, newToken, newPeer = self._StartChild(
+            fileInfo, mode, credentials)
         try:
-            ### IMPORTANT: We must make sure to do SetUser before setting
-            ###            paths. Otherwise, python gets into a weird state
-            ###            where it sees paths it can't access and then
-            ###            never looks at those paths even if it can
-            ###            access them later.
-            connectionToChild = PicklingXMLRPC.PicklingServerProxy(
-                'http://%s:%i' % (newPeer.host,newPeer.port))
-            if (credentials is not None and len(credentials)==3):
-                if (mode == 'subprocess'):
-                    logging.info('Requestig change user to %s' %
-                                 credentials['user'])
-                    msg = connectionToChild.SetUser(
-                        newToken,credentials['domain'],credentials['user'],
-                        credentials['password'])
-                    logging.info('Change user result = %s' % str(msg))
-                else:
-                    newEnv = [('USERNAME',credentials['user']),
-                              ('USER', credentials['user'])]
-                    logging.info('Set child user env vars to: %s'%str(newEnv))
-                    connectionToChild.SetEnv(newToken, newEnv)
-            else:
-                logging.info('Not requestig change user.')                
-            if (len(fileInfo.prependPaths)): connectionToChild.PrependSysPath(
-                newToken,fileInfo.prependPaths)
-            if (len(fileInfo.appendPaths)): connectionToChild.ExtendSysPath(
-                newToken,fileInfo.appendPaths)        
-            if (priority is not None):
-                WindowsUtils.SetPriority(newToken,priority)
-            connectionToChild.SetCWD(newToken,fileInfo.workingDir)
-            if (env):
-                connectionToChild.SetEnv(newToken, env.items())
-            if (debug):
-                logging.info('path of child is:\n\n%s\n\n' %
-                             connectionToChild.ShowPath(newToken))
-                logging.info('cwd of child is: %s' % fileInfo.workingDir)
+            connectionToChild = MakeProxy(newPeer.host,newPeer.port)
             if (wait):
-                logging.debug('Asking child to process target...')
-                oldtimeout = socket.getdefaulttimeout()
-                sd = None # clear the timeout if wait is True
-                logging.debug('Making old timeout of %s to %s'%(oldtimeout,sd))
-                socket.setdefaulttimeout(sd) 
-                result = connectionToChild.ProcessObject(newToken,target)
+                if (priority is not None):
+                    WindowsUtils.SetPriority(newToken,priority)
+                logging.debug('Asking child to set up and process target...')
+                # no timeout if wait is True since target may take a while
+                waitingConnection = MakeProxy(
+                    newPeer.host,newPeer.port,timeout=None)
+                result = waitingConnection.Bootstrap(newToken, self.MakeSetup(
+                    fileInfo, mode, credentials, env, debug), target, True)
                 logging.debug('Waiting for child...')
-                try:
-                    connectionToChild.Die(newToken)
-                except Exception, myException:
-                    logging.error('Ignoring error %s when asking child to die.'
-                                  % str(myException))
-                finally:
-                    socket.setdefaulttimeout(oldtimeout)
                 if (hasattr(childProc, 'wait')):
                     childProc.wait()
             else:
+                self._SetupChild(connectionToChild, newToken, fileInfo, mode,
+                                 credentials, priority, env, debug)
                 result = TaskInfo.ThreadHandle(
                     newToken,target,connectionToChild,childProc,
                     newPeer.host,newPeer.port)
@@ -592,6 +749,112 @@ class RemoteProcess:
             
         return result
 
+    def _StartChild(self, fileInfo, mode, credentials):
+        """Start a child process and wait for it to connect back.
+        
+        INPUTS:
+        
+        -- fileInfo, mode, credentials:  As for SpawnTask.
+        
+        -------------------------------------------------------
+        
+        RETURNS:        The tuple (childProc, token, peer) where childProc
+                        is as returned by _CreateSubprocess, token is the
+                        token to use in calls to the child, and peer is
+                        the PeerRelationship for the child.
+        
+        -------------------------------------------------------
+        
+        PURPOSE:        If the child does not connect back within
+                        self.connectTimeout seconds or exits before it
+                        does, we kill it and raise an exception.
+
+>>> import sys, time, subprocess, Process
+>>> process = Process.RemoteProcess()
+>>> process.PrepareServer()
+>>> process.connectTimeout = 1
+>>> children = []
+>>> def Start(code):
+...     children.append(subprocess.Popen([sys.executable, '-c', code]))
+...     return children[-1], children[-1].pid
+...
+>>> fileInfo = Process.RemoteFileInfo(None, None, None, prependPaths=[])
+>>> for code in ['pass', 'import time; time.sleep(600)']:
+...     process._CreateSubprocess = lambda *args: Start(code)
+...     start = time.time()
+...     try:
+...         process._StartChild(fileInfo, 'subprocess', None)
+...     except Exception, e:
+...         print e, time.time() - start < 10, children[-1].poll() is None
+...
+Child process did not connect back; killed it. True False
+Child process did not connect back; killed it. True False
+>>> process._server.server_close()
+        
+        """
+        host, port = self.SockName()
+                
+        forkArgs = Forker.MakeCommandLine(
+            fileInfo.exe,Forker.__file__,host,port)
+        
+        childProc, self._pipePid = self._CreateSubprocess(
+            forkArgs,fileInfo,mode,credentials)
+
+        oldToken = self._GetTokenAndPeerWithMaxID()[0]
+        newToken, newPeer = oldToken, None
+        deadline = time.time() + self.connectTimeout
+        oldTimeout = self._server.timeout
+        try:
+            try:
+                while (newToken == oldToken and time.time() < deadline and not
+                       (hasattr(childProc, 'poll') and
+                        childProc.poll() is not None)):
+                    # wait for student to connect back checking on it
+                    self._server.timeout = max(0, min(
+                        1, deadline - time.time()))
+                    self._server.handle_request()
+                    newToken, newPeer = self._GetTokenAndPeerWithMaxID()
+            finally:
+                self._server.timeout = oldTimeout
+            if (oldToken == newToken):
+                raise Exception(
+                    'Child process did not connect back; killed it.')
+        except: #pylint:disable-msg=W0702
+            self._KillChild(childProc)
+            raise
+        return childProc, newToken, newPeer
+
+    @staticmethod
+    def _KillChild(childProc):
+        "Kill childProc from _CreateSubprocess if it is still running."
+
+        if (hasattr(childProc, 'kill') and childProc.poll() is None):
+            try:
+                childProc.kill()
+                childProc.wait()
+            except Exception, e:
+                logging.debug('Ignoring %s when killing child' % e)
+
+    @staticmethod
+    def _SetupChild(connectionToChild, newToken, fileInfo, mode, credentials,
+                    priority, env, debug):
+        """Set user, paths, working directory, and env for a child.
+        
+        INPUTS:
+        
+        -- connectionToChild:  PicklingServerProxy connected to child.
+        
+        -- newToken:           Token to use in calls to child.
+        
+        -- fileInfo, mode, credentials, priority, env, debug:  As for
+                               SpawnTask.
+        
+        """
+        if (priority is not None):
+            WindowsUtils.SetPriority(newToken,priority)
+        connectionToChild.Bootstrap(newToken, RemoteProcess.MakeSetup(
+            fileInfo, mode, credentials, env, debug))
+
     @staticmethod
     def _CreateSubprocess(cmdLine, fileInfo, mode, credentials):      
         """Create a subprocess.
@@ -702,6 +965,21 @@ False
 False
     """
 
+    @staticmethod
+    def _transportExample():
+        """Docstring showing that children use the transport of their master.
+
+>>> import Process
+>>> fileInfo = Process.RemoteFileInfo(None, None, None, prependPaths=[])
+>>> for transport in ['tcp', 'unix']:
+...     t = Process.RemoteProcess(transport)
+...     print transport, t.SpawnTask(Process._ExampleForTest(), fileInfo), (
+...         t.SockName()[0].startswith('unix:'))
+... 
+tcp 42 False
+unix 42 True
+    """
+
     @staticmethod
     def _picklingExample():
         """Docstring illustrating simple example with pickling wrapper.
@@ -829,6 +1107,326 @@ False
         else:
             return getattr(self,method)(*params[1:])
 
+class _WarmChild:
+    "Information about a child process in a WarmPool."
+
+    def __init__(self, proc, token, peer):
+        self.proc = proc
+        self.pid = proc.pid
+        self.token = token
+        self.host = peer.host
+        self.port = peer.port
+        self.config = None # set once the child is set up for a task
+        self.tasks = 0
+
+    def Connection(self, timeout=PicklingXMLRPC.DEFAULT_TIMEOUT):
+        "Return proxy connected to child."
+        return MakeProxy(self.host, self.port, timeout=timeout)
+
+    def Alive(self):
+        "Return True if the child process has not exited."
+        return self.proc.poll() is None
+
+class WarmPool:
+    """Pool of started child processes for RemoteProcess.SpawnTask to use.
+
+    Normally SpawnTask starts a new python process, waits for it to
+    connect back, and then makes separate XML-RPC calls to set its
+    user, paths, working directory, and env before the target can
+    run. For short tasks that is most of the time. A WarmPool keeps up
+    to size idle children which have already connected back. A task
+    takes a child which already ran a task with the same user, env,
+    paths, and working directory if there is one (and skips changing
+    user again), or else a fresh child. Either way a single Bootstrap
+    request sets up the child and runs the task, and the child puts its
+    working directory, env, sys.path, and sys.modules back the way they
+    were when it started once the task is done. Children
+    are recycled (asked to Die) after maxTasks tasks, after a task
+    raises an exception, or when there are more than size idle
+    children (oldest first, so children set up for a user or env no
+    longer in use go away).
+
+    Only SpawnTask calls with wait=True, mode='subprocess', no priority,
+    no stdin/stdout/stderr for the child, and the same exe as the pool
+    use the pool. Call SetWarmPool to install a pool for SpawnTask to
+    use (BasicRPCServer does this if given warmChildren).
+
+    Starting a child gives up after RemoteProcess.connectTimeout seconds
+    if it does not connect back, and Stop waits at most stopTimeout
+    seconds for the thread starting children to finish.
+
+>>> import Process, time, os
+>>> pool = Process.WarmPool(size=1, maxTasks=2)
+>>> previous = Process.SetWarmPool(pool)
+>>> for i in range(50):
+...     if (pool.Info()['idle']): break
+...     time.sleep(0.1)
+... 
+>>> fileInfo = Process.RemoteFileInfo(None, None, None, prependPaths=[])
+>>> [Process.RemoteProcess().SpawnTask(Process._ExampleForTest(
+...     args=((i,),)), fileInfo) for i in range(3)]
+[0, 1, 2]
+>>> info = pool.Info()
+>>> info['reused'], info['recycled'] >= 1, info['started'] >= 2
+(1, True, True)
+>>> pool.maxTasks = 4 # so the next two tasks reuse one child
+>>> leak = Process._ExampleForTest(func=eval, args=(
+...     "[__import__('os').chdir('/'), __import__('colorsys'), "
+...     "__import__('os').environ.update(LEAK='1'), "
+...     "__import__('sys').path.append('/leak')] and None",))
+>>> check = Process._ExampleForTest(func=eval, args=(
+...     "(__import__('os').getcwd(), __import__('os').environ.get('LEAK'), "
+...     "'/leak' in __import__('sys').path, "
+...     "'colorsys' in __import__('sys').modules)",))
+>>> results = [Process.RemoteProcess().SpawnTask(t, fileInfo)
+...            for t in [leak, check]]
+>>> results[1] == (os.getcwd(), None, False, False)
+True
+>>> pool.Info()['reused']
+3
+>>> Process.SetWarmPool(previous) is pool
+True
+>>> pool.Stop(); pool.Info()['idle']
+0
+    """
+
+    stopTimeout = 10
+
+    def __init__(self, size=2, maxTasks=100, exe=None):
+        """Initializer.
+        
+        INPUTS:
+        
+        -- size=2:        Number of idle children to keep.
+        
+        -- maxTasks=100:  Number of tasks a child runs before we recycle it.
+        
+        -- exe=None:      Python executable for children (defaults to
+                          sys.executable).
+        
+        """
+        self.size = size
+        self.maxTasks = maxTasks
+        self.exe = sys.executable if exe is None else exe
+        self._fileInfo = RemoteFileInfo(None, None, None, prependPaths=[],
+                                        appendPaths=[], exe=self.exe)
+        self._master = RemoteProcess()
+        self._master.PrepareServer()
+        self._lock = threading.Lock()
+        self._spawnLock = threading.Lock()
+        self._idle = [] # oldest first
+        self._counts = {'started' : 0, 'reused' : 0, 'recycled' : 0}
+        self._stopped = False
+        self._wake = threading.Event()
+        self._thread = threading.Thread(target=self._FillLoop,
+                                        name='WarmPool')
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def Accepts(self, fileInfo, mode, priority):
+        "Return True if SpawnTask with the given arguments can use the pool."
+
+        return (not self._stopped and mode == 'subprocess' and
+                priority is None and fileInfo.exe == self.exe and
+                fileInfo.remotePyPath is None and fileInfo.childStdin is None
+                and fileInfo.childStdout is None and
+                fileInfo.childStderr is None)
+
+    def SpawnTask(self, process, target, fileInfo, credentials, env, debug):
+        """Run target in a child from the pool and return the result.
+        
+        INPUTS:
+        
+        -- process:       RemoteProcess whose SpawnTask called us. We set
+                          its pid to the pid of the child so it can be
+                          killed.
+        
+        -- target, fileInfo, credentials, env, debug:  As for
+                          RemoteProcess.SpawnTask.
+        
+        """
+        config = self._Config(fileInfo, credentials, env)
+        child = self._Acquire(config)
+        ok = False
+        try:
+            process._pipePid = child.pid
+            # no timeout since target may take a while
+            connection = child.Connection(None)
+            setup = process.MakeSetup(
+                fileInfo, 'subprocess', credentials, env, debug)
+            setup['restore'] = True
+            if (child.config == config):
+                setup['user'] = None # already running as that user
+            child.config = None # in case setting up fails
+            result = connection.Bootstrap(child.token, setup, target)
+            child.config = config
+            ok = True
+        finally:
+            child.tasks += 1
+            self._Release(child, ok)
+        return result
+
+    def Info(self):
+        "Return dictionary with counts of children started, reused, etc."
+
+        self._lock.acquire()
+        try:
+            result = dict(self._counts)
+            result['idle'] = len(self._idle)
+            return result
+        finally:
+            self._lock.release()
+
+    def Stop(self):
+        "Recycle all idle children and stop starting new ones."
+
+        self._lock.acquire()
+        try:
+            self._stopped = True
+            idle, self._idle = self._idle, []
+        finally:
+            self._lock.release()
+        self._wake.set()
+        self._thread.join(self.stopTimeout)
+        if (self._thread.isAlive()):
+            logging.warning('WarmPool thread still starting a child after '
+                            '%s seconds; not waiting for it' % self.stopTimeout)
+        for child in idle:
+            self._Recycle(child)
+        self._master._server.server_close()
+
+    @staticmethod
+    def _Config(fileInfo, credentials, env):
+        "Return hashable description of how a child is set up for a task."
+
+        user = None
+        if (credentials is not None and len(credentials)==3):
+            user = (credentials['domain'], credentials['user'])
+        return (user, tuple(sorted((env or {}).items())),
+                tuple(fileInfo.prependPaths), tuple(fileInfo.appendPaths),
+                fileInfo.workingDir)
+
+    def _Acquire(self, config):
+        "Return a child for a task with the given config."
+
+        self._lock.acquire()
+        try:
+            alive = [c for c in self._idle if c.Alive()]
+            dead = [c for c in self._idle if not c.Alive()]
+            self._counts['recycled'] += len(dead)
+            matches = [c for c in alive if c.config == config]
+            fresh = [c for c in alive if c.config is None]
+            child = (matches or fresh or [None])[0]
+            if (child is not None):
+                alive.remove(child)
+                if (child.config is not None):
+                    self._counts['reused'] += 1
+            self._idle = alive
+        finally:
+            self._lock.release()
+        for c in dead:
+            self._Recycle(c)
+        self._wake.set()
+        if (child is None):
+            logging.debug('No warm child for %s; starting one' % str(config))
+            child = self._StartChild()
+        return child
+
+    def _Release(self, child, ok):
+        "Put child back in the pool if ok and still usable or recycle it."
+
+        extra = []
+        self._lock.acquire()
+        try:
+            if (ok and not self._stopped and child.tasks < self.maxTasks):
+                self._idle.append(child)
+                while (len(self._idle) > self.size):
+                    extra.append(self._idle.pop(0))
+            else:
+                extra.append(child)
+        finally:
+            self._lock.release()
+        for c in extra:
+            self._Recycle(c)
+
+    def _StartChild(self):
+        "Start a new child and return _WarmChild for it."
+
+        self._spawnLock.acquire()
+        try:
+            proc, token, peer = self._master._StartChild(
+                self._fileInfo, 'subprocess', None)
+        finally:
+            self._spawnLock.release()
+        self._lock.acquire()
+        try:
+            self._counts['started'] += 1
+        finally:
+            self._lock.release()
+        return _WarmChild(proc, token, peer)
+
+    def _Recycle(self, child):
+        "Ask child to Die (or kill it) and wait for it to exit."
+
+        self._lock.acquire()
+        try:
+            self._counts['recycled'] += 1
+            self._master._peers.pop(child.token, None)
+        finally:
+            self._lock.release()
+        if (child.Alive()):
+            try:
+                child.Connection(5).Die(child.token)
+            except Exception, e:
+                logging.debug('Killing child %s since Die failed: %s' % (
+                    child.pid, e))
+                try:
+                    child.proc.kill()
+                except Exception, e:
+                    logging.debug('Ignoring %s when killing child' % e)
+        child.proc.wait()
+
+    def _FillLoop(self):
+        "Keep size idle children until stopped."
+
+        while (not self._stopped):
+            self._lock.acquire()
+            try:
+                needed = self.size - len(self._idle)
+            finally:
+                self._lock.release()
+            if (needed <= 0):
+                self._wake.wait()
+                self._wake.clear()
+                continue
+            try:
+                child = self._StartChild()
+            except Exception, e:
+                logging.error('Unable to start warm child: %s' % e)
+                self._wake.wait(5)
+                self._wake.clear()
+                continue
+            self._lock.acquire()
+            try:
+                if (not self._stopped):
+                    self._idle.append(child)
+                    child = None
+            finally:
+                self._lock.release()
+            if (child is not None):
+                self._Recycle(child)
+
+_warmPool = None
+
+def SetWarmPool(pool):
+    """Set the WarmPool for RemoteProcess.SpawnTask to use (None for none).
+
+    Returns the previous pool.
+    """
+    global _warmPool
+    previous, _warmPool = _warmPool, pool
+    return previous
+
 class ThreadToRunTask(threading.Thread):
     """Simple class to run a given target task in a separate thread.
     """
@@ -984,6 +1582,12 @@ class PickledTaskWrapper:
     The idea is that sometimes you want to pass around a target task as
     a pickled string. This lets you keep the target task pickled but
     still provides an easy way to unpickle it and run it.
+
+    Blobs.SubmitShared calls SplitForSharing to get a copy with large
+    parts of the target kept as separate strings in self.targetBlobs
+    (see Blobs.SplitDumps). That way wrappers for targets sharing large
+    state (e.g., the same config object) hold equal strings which are
+    only sent to a server once.
     """
 
     def __init__(self, target, pickleResult=True, pickleMode='s'):
@@ -1006,17 +1610,58 @@ class PickledTaskWrapper:
         _callMethod = GetCallMethod(target) # make sure has call method
         self.reprTarget = repr(target)
         self.target = cPickle.dumps(target)
+        self.targetBlobs = {}
         self.pickleResult = pickleResult
         self.pickleMode = pickleMode
 
+    def SplitForSharing(self, minBytes=None):
+        """Return copy of self with large parts of target split out.
+
+        INPUTS:
+
+        -- minBytes=None:  Passed to Blobs.SplitDumps.
+
+        -------------------------------------------------------
+
+        RETURNS:        Copy of self (or self if target is too small to
+                        split) whose target refers to blobs kept in
+                        targetBlobs.
+
+>>> import Process
+>>> deep = {'data' : 'x' * 1000}
+>>> for i in range(300):
+...     deep = {'next' : deep, 'row' : [i]}
+...
+>>> wrapper = Process.PickledTaskWrapper(Process._ExampleForTest(
+...     func=len, args=(deep,)), pickleResult=False)
+>>> split = wrapper.SplitForSharing(minBytes=100)
+>>> split is not wrapper, split.targetBlobs, split.Run()
+(True, {}, 2)
+>>> wrapper.SplitForSharing(minBytes=1<<20) is wrapper
+True
+        """
+        minBytes = Blobs.MIN_BLOB_BYTES if minBytes is None else minBytes
+        if (len(self.target) < minBytes or getattr(
+                self, 'targetBlobs', None)): # small or already split
+            return self
+        result = copy.copy(self)
+        result.target, _refs, blobs = Blobs.SplitDumps(
+            cPickle.loads(self.target), minBytes)
+        result.targetBlobs = dict([(key, data) for (key, (data, _blobRefs))
+                                   in blobs.items()])
+        return result
+
     def Run(self):
         """Run the task and return the result.
         """
-        unpickled = cPickle.loads(self.target)
+        # Use getattr for wrappers from versions without targetBlobs.
+        unpickled = Blobs.Loads(
+            self.target, getattr(self, 'targetBlobs', {}).__getitem__)
         result = CallIt(unpickled)
         self.reprTarget = repr(unpickled)
         try:
             self.target = cPickle.dumps(unpickled)
+            self.targetBlobs = {}
         except Exception, myExc:
             msg = 'Got Exception when trying to pickle self.target:\n%s' % (
                 '\n'.join([str(self.target),'Exception info:',str(myExc),
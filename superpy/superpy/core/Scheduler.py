@@ -2,16 +2,234 @@
 Module containing code to represent a Scheduler class which is
 used to submit tasks to the best server in a group.
 """
-import os, socket, logging, time, pickle
-import PicklingXMLRPC
+import os, socket, logging, time, pickle, threading, Queue
+import random, itertools, json
+import PicklingXMLRPC, Blobs
 from Servers import BasicRPCServer
 
+class PlacementPolicy:
+    """Base class for policies deciding which server gets a task.
+
+    Scheduler.SubmitTaskToBestServer first calls Candidates with the
+    sorted list of (host, port) keys for all servers to find out which
+    ones it should get loads for. It then calls Choose with a list of
+    (key, connection, estWaitTime, methods) tuples sorted by
+    estWaitTime for the candidates which answered. If usesFreeSlots is
+    True, each tuple has a fifth element with the number of task slots
+    not used by running tasks on the server (from its LoadSummary) or
+    None if the server cannot tell us.
+    """
+
+    usesFreeSlots = False
+
+    def Candidates(self, keys):
+        "Return list of keys for servers whose loads we should get."
+        return keys
+
+    def Choose(self, estWaitTimes, task):
+        "Return the entry from estWaitTimes which should get task."
+        raise NotImplementedError
+
+class ExactMinPolicy(PlacementPolicy):
+    """Policy which gives each task to the server with the smallest wait.
+
+    This is the default. When many clients submit at once with the same
+    view of the loads, they all pick the same server.
+
+>>> entries = [('a', None, 5, None), ('b', None, 1, None)]
+>>> ExactMinPolicy().Choose(entries, None)[0]
+'b'
+    """
+
+    def Choose(self, estWaitTimes, task):
+        "Return the entry with smallest estWaitTime."
+        return min(estWaitTimes, key=lambda entry: entry[2])
+
+class PowerOfTwoPolicy(ExactMinPolicy):
+    """Policy which gets loads for two random servers and takes the better.
+
+    This needs only two probes per task and spreads concurrent submits
+    over the cluster while still avoiding heavily loaded servers.
+
+>>> policy = PowerOfTwoPolicy(seed=1)
+>>> len(policy.Candidates(range(50))), policy.Candidates([3])
+(2, [3])
+    """
+
+    def __init__(self, seed=None):
+        self._random = random.Random(seed)
+
+    def Candidates(self, keys):
+        "Return two keys picked at random (or all keys if fewer)."
+        if (len(keys) <= 2):
+            return keys
+        return self._random.sample(keys, 2)
+
+class WeightedRandomPolicy(PlacementPolicy):
+    """Policy which picks a random server weighted by its free capacity.
+
+    Each server is weighted by its number of free task slots, so a server
+    with 8 free slots is picked 4 times as often as one with 2 and
+    concurrent submits spread over the servers which can start the task
+    right away. A server which cannot tell us its free slots counts as
+    having one if its estimated wait is 0 and none otherwise.
+
+    If no server has a free slot, a server whose estimated wait is D
+    seconds more than the smallest estimated wait gets weight 1/(1+D)
+    instead. So servers about as free as the best one are about equally
+    likely, while busier servers are rarely picked.
+
+>>> entries = [('big', None, 0, None, 6), ('small', None, 0, None, 2),
+...            ('full', None, 0, None, 0)]
+>>> policy = WeightedRandomPolicy(seed=1)
+>>> picks = [policy.Choose(entries, None)[0] for i in range(400)]
+>>> picks.count('full'), 2.0 < picks.count('big')/float(picks.count('small'))
+(0, True)
+>>> entries = [('idle', None, 0, None, 0), ('busy', None, 1e9, None, 0)]
+>>> set([policy.Choose(entries, None)[0] for i in range(20)])
+set(['idle'])
+    """
+
+    usesFreeSlots = True
+
+    def __init__(self, seed=None):
+        self._random = random.Random(seed)
+
+    @staticmethod
+    def _FreeSlots(entry):
+        "Return free slots for entry as described in class docs."
+        freeSlots = entry[4] if len(entry) > 4 else None
+        if (freeSlots is None):
+            return 1 if entry[2] <= 0 else 0
+        return max(0, freeSlots)
+
+    def Choose(self, estWaitTimes, task):
+        "Return an entry picked at random weighted as described above."
+        weights = [self._FreeSlots(entry) for entry in estWaitTimes]
+        if (not sum(weights)):
+            best = min([entry[2] for entry in estWaitTimes])
+            weights = [1.0/(1.0 + entry[2] - best) for entry in estWaitTimes]
+        pick = self._random.random() * sum(weights)
+        for (entry, weight) in zip(estWaitTimes, weights):
+            pick -= weight
+            if (pick < 0):
+                return entry
+        return estWaitTimes[-1]
+
+class RoundRobinPolicy(PlacementPolicy):
+    """Policy which gives tasks to each server in turn ignoring loads.
+
+    Only the server whose turn it is gets asked for its load (so we know
+    it is up). If it does not answer, the scheduler asks all servers and
+    we take the next server after it in turn which answered, so the
+    rotation still covers every server which is up. Whose turn it was
+    is remembered per thread between Candidates and Choose so threads
+    sharing a Scheduler do not mix up each other's turns.
+
+>>> import threading
+>>> policy = RoundRobinPolicy()
+>>> [policy.Candidates(['a', 'b', 'c'])[0] for i in range(4)]
+['a', 'b', 'c', 'a']
+>>> entries = [('a', None, 0, None), ('c', None, 5, None)]
+>>> policy.Candidates(['a', 'b', 'c']), policy.Choose(entries, None)[0]
+(['b'], 'c')
+>>> policy.Candidates(['a', 'b', 'c'])
+['c']
+>>> other = threading.Thread(target=policy.Candidates, args=(['a', 'b', 'c'],))
+>>> other.start(); other.join() # takes a's turn in another thread
+>>> policy.Choose(entries, None)[0]
+'c'
+    """
+
+    def __init__(self):
+        self._counter = itertools.count()
+        self._turn = threading.local()
+
+    def Candidates(self, keys):
+        "Return list containing the key whose turn it is."
+        index = self._counter.next() % len(keys)
+        self._turn.value = (index, list(keys))
+        return [keys[index]]
+
+    def Choose(self, estWaitTimes, task):
+        "Return entry for the server whose turn it is or the next one."
+        index, keys = getattr(self._turn, 'value', (None, []))
+        positions = dict([(k, i) for (i, k) in enumerate(keys)])
+        if (index is None or len(estWaitTimes) == 1
+            or [e for e in estWaitTimes if e[0] not in positions]):
+            return estWaitTimes[0]
+        return min(estWaitTimes, key=lambda entry: (
+            positions[entry[0]] - index) % len(keys))
+
 class Scheduler:
     """
     Class representing a scheduler to balance tasks among multiple servers.
+
+    The scheduler keeps one connection per (host, port) which is reused
+    for every call to that server (see PicklingXMLRPC.KeepAliveTransport).
+    It also remembers which RPC methods each server has for up to
+    methodsTTL seconds so it does not need to ask before every submit.
+    The remembered methods for a server are forgotten when a call to it
+    fails.
+
+    Servers are asked for their load in parallel (see _EstWaitTimes).
+    We wait at most probeDeadline seconds for answers if at least one
+    server has answered, and otherwise up to probeTimeout seconds for
+    the first answer.
+
+    If created with gossip=True, the scheduler instead subscribes to load
+    summaries pushed by the servers (see BasicRPCServer.SubscribeLoad)
+    and picks servers from its own table of loads without any RPCs.
+    Summaries older than gossipMaxAge seconds are not used. Servers
+    which do not send summaries are only used when no server has sent a
+    recent one, in which case we fall back to asking for loads.
+
+    Which server gets a task from SubmitTaskToBestServer is decided by
+    the policy argument to __init__ (an instance of a sub-class of
+    PlacementPolicy). The default is ExactMinPolicy.
+
+    After failureThreshold failed calls in a row a server is marked down
+    and skipped without contacting it. A background thread retries down
+    servers after retryBackoff seconds (doubling each time the retry
+    fails up to retryBackoffMax) and marks them up again if they answer.
+    See HostHealthInfo.
+
+    Tasks are pickled with any parts bigger than minBlobBytes split out
+    as blobs (see Blobs.SplitDumps). If there are such parts and the
+    server has SubmitShared, we send only the blobs it does not have
+    yet so large state shared by many tasks is only sent once. Set
+    minBlobBytes to None to always send whole tasks.
+
+    Servers replace the default estRunTime of a task with what they
+    learned about its family (see BasicRPCServer.LearnedRunTimes). When
+    we estimate work ourselves (to split a batch in
+    SubmitManyToBestServers or to update the gossip load table), we do
+    the same using learned run times we fetch from each server at most
+    every learnedTTL seconds.
     """
 
-    def __init__(self,hostList):
+    methodsTTL = 600
+    probeDeadline = 0.5
+    probeTimeout = 30
+    gossipMaxAge = 15
+    subscribeInterval = 60
+    failureThreshold = 3
+    retryBackoff = 5
+    retryBackoffMax = 600
+    minBlobBytes = Blobs.MIN_BLOB_BYTES
+    learnedTTL = 300
+
+    def __init__(self,hostList,gossip=False,policy=None):
+        self.policy = ExactMinPolicy() if policy is None else policy
+        self._connections = {} # (host, port) -> (proxy, its transport)
+        self._methods = {} # (host, port) -> (time fetched, set of names)
+        self._learned = {} # (host, port) -> (time fetched, learned run times)
+        self._probers = {} # (host, port) -> _HostProber
+        self._poolLock = threading.Lock()
+        self._loads = None # _LoadTable if gossip is used
+        self._gossipThreads = []
+        self._health = _HostHealth(self.failureThreshold, self.retryBackoff,
+                                   self.retryBackoffMax)
         self.hosts = {} # this should only include remote servers
         for i in range(len(hostList)):
             entry = hostList[i]
@@ -27,6 +245,8 @@ class Scheduler:
             else:
                 logging.debug('Making connection to %s' % ([host,port]))
                 self.hosts[(host,port)] = self.Connection(host, port)
+        if (gossip):
+            self.StartLoadGossip()
 
     def __del__(self):
         """
@@ -34,6 +254,12 @@ class Scheduler:
         Usually called automatically by python.
         """
         logging.info('destroying scheduler')
+        for prober in getattr(self, '_probers', {}).values():
+            prober.requests.put(None)
+        for thread in getattr(self, '_gossipThreads', []):
+            thread.stop.set()
+        if (getattr(self, '_health', None) is not None):
+            self._health.Stop()
         localServer = self.Connection()
         if self.IsServerUp(localServer):
             logging.info(
@@ -43,16 +269,188 @@ class Scheduler:
             logging.info('Local server shutdown')
 
     def Connection(
-        self, host = 'localhost', port = BasicRPCServer.defaultPort):
+        self, host = 'localhost', port = BasicRPCServer.defaultPort,
+        timeout = PicklingXMLRPC.DEFAULT_TIMEOUT):
         """
         return a connection to a server, as an instance of ServerProxy.
         No guarantee the server is up or the connection is usable.
+        Calls on the connection use the given socket timeout (see
+        PicklingXMLRPC.KeepAliveTransport) so different threads can use
+        different timeouts at the same time. We keep one connection per
+        server and give a proxy sharing its sockets to callers asking
+        for another timeout, so varying timeouts open no new sockets.
+
+>>> import Scheduler, Servers, time
+>>> server = Servers.BasicRPCServer(cpus=1, port=0, logRequests=False)
+>>> server.serve_forever_as_thread(daemon=True); time.sleep(0.2)
+Entering service loop forever or until killed...
+>>> scheduler = Scheduler.Scheduler([(server.Host(), server.Port())])
+>>> socks = set()
+>>> for timeout in [5, 6, 7, 8.5, None]:
+...     connection = scheduler.Connection(server.Host(), server.Port(),
+...                                       timeout)
+...     connection.EstWaitTime(0) >= 0
+...     transport = connection._ServerProxy__transport
+...     socks.add(id(transport._local.connection[1].sock))
+...     transport._local.connection[1].sock.gettimeout() == timeout
+...
+True
+True
+True
+True
+True
+True
+True
+True
+True
+True
+>>> len(scheduler._connections), len(socks)
+(1, 1)
+>>> scheduler.Connection(server.Host(), server.Port()).Terminate()
         """
         if host == 'localhost':
             host = os.getenv('computername')
-        return self.hosts.get(
-            (host, port),
-            PicklingXMLRPC.PicklingServerProxy('http://%s:%i'%(host, port)))
+        uri = 'http://%s:%i'%(host, port)
+        self._poolLock.acquire()
+        try:
+            entry = self._connections.get((host, port), None)
+            if (entry is None):
+                transport = PicklingXMLRPC.KeepAliveTransport()
+                entry = (PicklingXMLRPC.PicklingServerProxy(
+                    uri, transport=transport), transport)
+                self._connections[(host, port)] = entry
+        finally:
+            self._poolLock.release()
+        connection, transport = entry
+        if (timeout is not PicklingXMLRPC.DEFAULT_TIMEOUT):
+            connection = PicklingXMLRPC.PicklingServerProxy(
+                uri, transport=transport.WithTimeout(timeout))
+        return connection
+
+    def ServerMethods(self, host, port):
+        """Return set of names of RPC methods server at host, port has.
+
+        Results are cached for self.methodsTTL seconds or until
+        self.ForgetMethods is called for the server.
+        """
+        methods = self._CachedMethods((host, port))
+        if (methods is None):
+            methods = set(pickle.loads(
+                self.Connection(host, port).system.listMethods()))
+            self._methods[(host, port)] = (time.time(), methods)
+        return methods
+
+    def _CachedMethods(self, key):
+        "Return cached methods for key=(host, port) or None if not fresh."
+
+        fetched, methods = self._methods.get(key, (None, None))
+        if (methods is None or time.time() - fetched > self.methodsTTL):
+            return None
+        return methods
+
+    def StartLoadGossip(self):
+        """Start listening for load summaries and subscribe to servers.
+
+        This is called by __init__ if gossip=True. See class docs.
+        """
+        if (self._loads is not None):
+            return
+        self._loads = _LoadTable()
+        listener = _LoadListener(self._loads, self.hosts.keys())
+        subscriber = _LoadSubscriber(
+            self.hosts.keys(), listener.Address(), self.subscribeInterval,
+            self._loads)
+        for thread in [listener, subscriber]:
+            thread.start()
+            self._gossipThreads.append(thread)
+
+    def _GossipEstWaitTimes(self, priority, keys=None, freeSlots=False):
+        """Return list like _EstWaitTimes using only our table of loads.
+
+        Servers without a summary newer than self.gossipMaxAge are left
+        out. If gossip is not being used, this returns an empty list.
+        """
+        if (self._loads is None):
+            return []
+        result = []
+        for k in (self.hosts if keys is None else keys):
+            if (not self._health.Available(k)):
+                continue
+            v = self.hosts[k]
+            estWaitTime = self._loads.EstWaitTime(k, priority, self.gossipMaxAge)
+            if (estWaitTime is None):
+                continue
+            entry = (k, v, estWaitTime, self._CachedMethods(k))
+            if (freeSlots):
+                entry += (self._loads.FreeSlots(k, self.gossipMaxAge),)
+            result.append(entry)
+        return result
+
+    def _NoteSubmitted(self, key, tasks, handles):
+        """Add work for tasks to our load table entry for server at key.
+
+        The handles the server returned for tasks have the estRunTime it
+        uses, so we use that rather than guess.
+        """
+        if (self._loads is not None):
+            for (task, handle) in zip(tasks, handles):
+                estRunTime = getattr(handle, 'estRunTime', None)
+                work = self._Work(task) if estRunTime is None else (
+                    float(estRunTime) * getattr(task, 'slots', 1))
+                self._loads.AddWork(key, task.priority, work,
+                                    getattr(task, 'slots', 1))
+
+    @staticmethod
+    def _Work(task, learned=None):
+        """Return estimated work (run time times slots) for task.
+
+        If task has the default estRunTime and learned (a result of
+        BasicRPCServer.LearnedRunTimes) knows its family, we use the
+        estimate the server would use (see _UseLearnedRunTime there).
+
+>>> import Tasks
+>>> learned = {'BasicTask:nap' : (3, 10.0, 2.0)}
+>>> Scheduler._Work(Tasks.BasicTask('nap_1')), Scheduler._Work(
+...     Tasks.BasicTask('nap_1'), learned)
+(28800.0, 11.0)
+>>> Scheduler._Work(Tasks.BasicTask('nap_2', estRunTime=5), learned)
+5.0
+        """
+        estRunTime = task.EstRunTime()
+        if (learned and getattr(task, 'estRunTimeIsDefault', False)):
+            stats = learned.get(task.Family(), None)
+            if (stats is not None):
+                _count, mean, stddev = stats
+                estRunTime = mean + BasicRPCServer.learnedStddevs * stddev
+        return float(estRunTime) * getattr(task, 'slots', 1)
+
+    def _LearnedRunTimes(self, key, methods):
+        """Return learned run times for server at key.
+
+        The result of LearnedRunTimes is cached for self.learnedTTL
+        seconds. If the server does not have it (according to methods,
+        which we look up if None) or does not answer, we return an
+        empty dictionary.
+        """
+        fetched, learned = self._learned.get(key, (None, None))
+        if (learned is not None and time.time() - fetched <= self.learnedTTL):
+            return learned
+        learned = {}
+        try:
+            if (methods is None):
+                methods = self.ServerMethods(*key)
+            if ('LearnedRunTimes' in methods):
+                learned = self.hosts[key].LearnedRunTimes()
+        except Exception, e:
+            logging.warning('Unable to get learned run times from %s: %s'
+                            % (str(key), str(e)))
+        self._learned[key] = (time.time(), learned)
+        return learned
+
+    def ForgetMethods(self, host, port):
+        "Forget cached methods for host, port so we ask again next time."
+
+        self._methods.pop((host, port), None)
     
     @staticmethod
     def IsServerUp(connection):
@@ -85,11 +483,34 @@ class Scheduler:
         """
         hosts = self.hosts.keys()
         # add local server if it's up
-        if self.IsServerUp(self.Connection()):
-            hosts.append(
-                (os.getenv('computername'), BasicRPCServer.defaultPort))
+        key = (os.getenv('computername'), BasicRPCServer.defaultPort)
+        if (self._health.Available(key)):
+            if self.IsServerUp(self.Connection()):
+                self._health.Success(key)
+                hosts.append(key)
+            else:
+                self._health.Failure(key, 'local server is not up')
         return sorted(list(set(hosts)))
 
+    def HostHealthInfo(self):
+        """Return dictionary describing health of servers we have contacted.
+        
+        -------------------------------------------------------
+        
+        RETURNS:        Dictionary whose keys are (host, port) pairs and
+                        values are dictionaries with the following keys:
+        
+           'state'     : 'up', 'down' (skipped until retried), or
+                         'retrying' (background retry in progress).
+           'failures'  : Number of failed calls in a row.
+           'lastError' : String for the last error or None.
+           'lastOk'    : Value of time.time() for the last successful
+                         call or None.
+           'retryIn'   : Seconds until we retry a down server or None.
+        
+        """
+        return self._health.Info()
+
     def SubmitTaskToBestServer(self,task,*args,**kw):
         """Submit a task to the best available server.
         
@@ -105,68 +526,950 @@ class Scheduler:
         
         -------------------------------------------------------
         
-        PURPOSE:        Submit a task to the best available server.
+        PURPOSE:        Submit a task to the best available server
+                        as decided by self.policy.
+        
+        """
+        assert None != task.Name(), 'Task must have a name!'
+        return self._SubmitToBest(sorted(self.hosts.keys()), task, args, kw)
+
+    def SubmitTaskElsewhere(self,task,avoid,*args,**kw):
+        """Submit a task to the best available server not in avoid.
+        
+        INPUTS:
+        
+        -- task:        Subclass of Tasks.BasicTask to submit.
+        
+        -- avoid:       List of (host, port) pairs for servers to skip.
+        
+        -- *args, **kw: Passed to Submit method of best server.
+        
+        -------------------------------------------------------
+        
+        RETURNS:        Handle for newly submitted task or None if there
+                        is no other server.
+        
+        -------------------------------------------------------
+        
+        PURPOSE:        Useful to run a second copy of a task which is
+                        taking too long on one server (e.g., see the
+                        speculation options in Manager.ProcParams).
         
         """
         assert None != task.Name(), 'Task must have a name!'
+        avoid = set([tuple(key) for key in avoid])
+        allowed = sorted([key for key in self.hosts if key not in avoid])
+        if (not allowed):
+            return None
+        return self._SubmitToBest(allowed, task, args, kw)
+
+    def _SubmitToBest(self, allowed, task, args, kw):
+        "Submit task to the best of the allowed servers as in the policy."
+
+        keys = self.policy.Candidates(allowed)
+        freeSlots = getattr(self.policy, 'usesFreeSlots', False)
+        estWaitTimes = self._GossipEstWaitTimes(task.priority, keys, freeSlots)
+        if (not estWaitTimes):
+            try:
+                estWaitTimes = self._EstWaitTimes(
+                    task.priority, keys=keys, freeSlots=freeSlots)
+            except Exception, e:
+                if (len(keys) == len(allowed)):
+                    raise
+                logging.warning('No candidate answered (%s); asking all' % e)
+                estWaitTimes = self._EstWaitTimes(
+                    task.priority, keys=allowed, freeSlots=freeSlots)
+        estWaitTimes.sort(key=lambda entry: entry[2])
+        logging.debug('Loads are %s' % str(estWaitTimes))
+        key, connection, _estWaitTime, methods = self.policy.Choose(
+            estWaitTimes, task)[0:4]
+        try:
+            handle = self._SendTasks(key, connection, methods, [task],
+                                     args, kw, 'Submit')[0]
+        except Exception, e:
+            self.ForgetMethods(*key)
+            self._health.Failure(key, e)
+            raise
+        self._NoteSubmitted(key, [task], [handle])
+        return handle
+
+    def SubmitManyToBestServers(self,tasks,*args,**kw):
+        """Submit a batch of tasks spread over the available servers.
+        
+        INPUTS:
+        
+        -- tasks:       List of subclasses of Tasks.BasicTask to submit.
+        
+        -- *args, **kw: Passed to SubmitMany (or Submit) method of servers.
+        
+        -------------------------------------------------------
+        
+        RETURNS:        List of handles for newly submitted tasks in the
+                        same order as tasks.
+        
+        -------------------------------------------------------
+        
+        PURPOSE:        Submitting tasks one at a time with
+                        SubmitTaskToBestServer asks every server for its
+                        wait time for every task. Instead, we ask each
+                        server once and then hand out tasks (highest
+                        priority first) to whichever server would finish
+                        its queue soonest given its current wait, the work
+                        we have already given it, and its number of CPUs.
+                        Each server then gets its share in one SubmitMany
+                        call. Servers without SubmitMany get one Submit
+                        call per task.
+        
+        """
+        tasks = list(tasks)
+        if (not tasks):
+            return []
+        for task in tasks:
+            assert None != task.Name(), 'Task must have a name!'
+        priority = min([t.priority for t in tasks])
+        useLearned = [t for t in tasks if getattr(
+            t, 'estRunTimeIsDefault', False)]
+        estWaitTimes = self._GossipEstWaitTimes(priority)
+        if (not estWaitTimes):
+            estWaitTimes = self._EstWaitTimes(priority)
+        loads = []
+        for (k, v, estWaitTime, methods) in estWaitTimes:
+            cpus = self._loads and self._loads.Cpus(k) or 1
+            if (cpus == 1 and 'NumCPUs' in (methods or [])):
+                try:
+                    cpus = max(1, int(v.NumCPUs()))
+                except Exception, e:
+                    logging.warning('Unable to get NumCPUs from %s: %s' % (
+                        str(k), str(e)))
+            learned = self._LearnedRunTimes(k, methods) if useLearned else {}
+            loads.append([estWaitTime, cpus, k, learned])
+        logging.debug('Loads are %s' % str([entry[0:3] for entry in loads]))
+        assignments = [[] for _entry in loads]
+        order = sorted(range(len(tasks)), key=lambda i: -tasks[i].priority)
+        for taskIndex in order:
+            work = [self._Work(tasks[taskIndex], entry[3]) for entry in loads]
+            bestIndex = min(range(len(loads)), key=lambda i: (
+                loads[i][0] + work[i]/loads[i][1]))
+            loads[bestIndex][0] += work[bestIndex]/loads[bestIndex][1]
+            assignments[bestIndex].append(taskIndex)
+        handles = [None]*len(tasks)
+        for (i, taskIndices) in enumerate(assignments):
+            if (not taskIndices):
+                continue
+            k, connection, _estWaitTime, methods = estWaitTimes[i]
+            batch = [tasks[t] for t in taskIndices]
+            logging.debug('Submitting %i tasks to %s' % (len(batch), str(k)))
+            try:
+                batchHandles = self._SendTasks(k, connection, methods, batch,
+                                               args, kw, 'SubmitMany')
+            except Exception, e:
+                self.ForgetMethods(*k)
+                self._health.Failure(k, e)
+                raise
+            self._NoteSubmitted(k, batch, batchHandles)
+            for (taskIndex, handle) in zip(taskIndices, batchHandles):
+                handles[taskIndex] = handle
+        return handles
+
+    def _SendTasks(self, key, connection, methods, tasks, args, kw, how):
+        """Send tasks to the server at key and return their handles.
+
+        If the server has SubmitShared and the tasks have parts bigger
+        than self.minBlobBytes, we use Blobs.SubmitShared. Otherwise we
+        use how (either 'Submit' or 'SubmitMany') falling back to a
+        Submit call per task if the server does not have SubmitMany.
+        The methods argument is the set of server methods or None if
+        we should look them up.
+        """
+        if (methods is None and (how != 'Submit'
+                                 or self.minBlobBytes is not None)):
+            methods = self.ServerMethods(*key)
+        if (self.minBlobBytes is not None and not kw
+            and 'SubmitShared' in methods):
+            handles = Blobs.SubmitShared(
+                connection, tasks, args, self.minBlobBytes)
+            if (handles is not None):
+                return handles
+        if (how == 'SubmitMany' and 'SubmitMany' in methods):
+            return connection.SubmitMany(tasks,*args,**kw)
+        return [connection.Submit(t,*args,**kw) for t in tasks]
+
+    def _EstWaitTimes(self, priority, newtimeout = None, deadline = None,
+                      keys = None, freeSlots = False):
+        """Ask each known server for its estimated wait time.
+        
+        INPUTS:
+        
+        -- priority:          Priority of task(s) we want to submit.
+        
+        -- newtimeout = None: Timeout in seconds for contacting a server.
+                              If None, we use self.probeTimeout.
+
+        -- deadline = None:   Seconds to wait for answers once at least
+                              one server has answered. If None, we use
+                              self.probeDeadline.
+
+        -- keys = None:       List of (host, port) keys for servers to ask.
+                              If None, we ask all servers.
+
+        -- freeSlots = False: Whether to also get the number of free task
+                              slots on each server (see RETURNS).
+        
+        -------------------------------------------------------
+        
+        RETURNS:        List of (key, connection, estWaitTime, methods)
+                        tuples for servers which answered in time where
+                        methods is the set of RPC names the server has.
+                        If freeSlots is True, each tuple has a fifth
+                        element with the free slots from the server's
+                        LoadSummary (or None if it does not have one).
+        
+        -------------------------------------------------------
+        
+        PURPOSE:        Each server has a _HostProber thread and we ask
+                        all of them at once. We return as soon as every
+                        server has answered, or when deadline seconds have
+                        passed and at least one server has answered. If no
+                        server answers by the deadline, we return the
+                        first answer to arrive within newtimeout seconds.
+                        Servers whose prober has been busy for more than
+                        deadline seconds (e.g., because they are dead and
+                        we are waiting for a timeout) or which are marked
+                        down are skipped. Otherwise, if another thread is
+                        waiting on the prober, our request is answered
+                        after (or together with) that one.
+        
+        """
+        if (newtimeout is None): newtimeout = self.probeTimeout
+        if (deadline is None): deadline = self.probeDeadline
         logging.debug('Requesting estWaitTimes from known servers.')
-        newtimeout = 30
+        start = time.time()
+        replies = Queue.Queue()
+        numAsked = 0
+        for k in (self.hosts if keys is None else keys):
+            if (not self._health.Available(k)):
+                logging.debug('Skipping %s:%s since it is down' % k)
+                continue
+            self._poolLock.acquire()
+            try:
+                prober = self._probers.get(k, None)
+                if (prober is None):
+                    prober = _HostProber(k, self._health)
+                    prober.start()
+                    self._probers[k] = prober
+            finally:
+                self._poolLock.release()
+            if (not prober.Ask((priority, self._CachedMethods(k), newtimeout,
+                                replies, freeSlots), deadline)):
+                logging.warning('Still waiting on %s:%s; skipping' % k)
+                continue
+            numAsked += 1
+
         estWaitTimes = []
-        for (k,v) in self.hosts.iteritems():
+        while (numAsked):
+            limit = start + (deadline if estWaitTimes else newtimeout)
             try:
-                oldtimeout = socket.getdefaulttimeout()
-                socket.setdefaulttimeout(
-                    newtimeout) # set timeout in case server dead
-                logging.debug('Contacting %s:%s...' % (str(k), str(v)))
-                
-                # maintain backward compatibility,
-                # old servers have CPULoad instead of EstWaitTime
-                methods = set(pickle.loads(v.system.listMethods()))
-                estWaitTime = None
-                if 'EstWaitTime' in methods:
-                    estWaitTime = v.EstWaitTime(task.priority)
-                elif 'CPULoad' in methods:
-                    estWaitTime = v.CPULoad()
-
-                if estWaitTime is None:
-                    raise Exception(
-                        'tried EstWaitTime and CPULoad with no useful result')
-                estWaitTimes.append((k, v, estWaitTime))
-                logging.debug(
-                    'Got estWaitTime of %s from %s:%s'%(estWaitTimes[-1],k,v))
-            except socket.error, e:
-                logging.warning('Unable to contact %s:%s because %s;skipping'% (
-                    str(k),str(v),str(e)))
-            except Exception, e:
+                k, reply = replies.get(timeout=max(0, limit - time.time()))
+            except Queue.Empty:
+                break
+            numAsked -= 1
+            if (isinstance(reply, Exception)):
                 logging.warning('Unable to contact %s:%s because %s;skipping'% (
-                    str(k),str(v),str(e)))
-            finally:
-                socket.setdefaulttimeout(oldtimeout)
+                    str(k[0]),str(k[1]),str(reply)))
+                self.ForgetMethods(*k)
+                continue
+            estWaitTime, methods, fetched, slots = reply
+            if (fetched):
+                self._methods[k] = (time.time(), methods)
+            entry = (k, self.hosts[k], estWaitTime, methods)
+            estWaitTimes.append(entry + (slots,) if freeSlots else entry)
+            logging.debug('Got estWaitTime of %s from %s:%s'%(
+                estWaitTime, k[0], k[1]))
+        if (numAsked):
+            logging.debug('Skipping %i servers which did not answer in time'
+                          % numAsked)
                 
         if len(estWaitTimes) < 1:
             raise Exception(
                 'No server can be reached in %s seconds, re-try later'
                 %newtimeout)
-        estWaitTimes.sort(key=lambda entry: entry[2])
-        logging.debug('Loads are %s' % str(estWaitTimes))
-        handle = estWaitTimes[0][1].Submit(task,*args,**kw)
-        return handle
+        return estWaitTimes
+
+    @staticmethod
+    def _regr_test_method_cache():
+        """Check that we only ask for methods once per server.
+
+>>> import Servers, Scheduler, Tasks
+>>> server = Servers.BasicRPCServer(cpus=1, port=0, logRequests=False)
+>>> server.UpdateActives = lambda: None # keep everything queued
+>>> server.serve_forever_as_thread(daemon=True); time.sleep(0.2)
+Entering service loop forever or until killed...
+>>> calls = []
+>>> def Counting(name, func):
+...     def Wrapper(*args):
+...         calls.append(name)
+...         return func(*args)
+...     return Wrapper
+... 
+>>> for name in ['system.listMethods', 'EstWaitTime', 'Submit']:
+...     server.funcs[name] = Counting(name, server.funcs[name])
+... 
+>>> scheduler = Scheduler.Scheduler([(server.Host(), server.Port())])
+>>> for i in range(3):
+...     handle = scheduler.SubmitTaskToBestServer(Tasks.BasicTask('t%i' % i))
+... 
+>>> calls
+['system.listMethods', 'EstWaitTime', 'Submit', 'EstWaitTime', 'Submit', 'EstWaitTime', 'Submit']
+>>> scheduler.ForgetMethods(server.Host(), server.Port()); calls[:] = []
+>>> handle = scheduler.SubmitTaskToBestServer(Tasks.BasicTask('t3'))
+>>> calls
+['system.listMethods', 'EstWaitTime', 'Submit']
+>>> scheduler.Connection(server.Host(), server.Port()).Terminate()
+        """
+
+    @staticmethod
+    def _regr_test_gossip():
+        """Check that with gossip we pick servers without asking for loads.
+
+>>> import Servers, Scheduler, Tasks
+>>> server = Servers.BasicRPCServer(cpus=1, port=0, logRequests=False)
+>>> server.UpdateActives = lambda: None # keep everything queued
+>>> server.serve_forever_as_thread(daemon=True); time.sleep(0.2)
+Entering service loop forever or until killed...
+>>> calls = []
+>>> def Counting(name, func):
+...     def Wrapper(*args):
+...         calls.append(name)
+...         return func(*args)
+...     return Wrapper
+... 
+>>> for name in ['EstWaitTime', 'Submit']:
+...     server.funcs[name] = Counting(name, server.funcs[name])
+... 
+>>> key = (server.Host(), server.Port())
+>>> scheduler = Scheduler.Scheduler([key], gossip=True)
+>>> for i in range(50):
+...     if (scheduler._loads.Cpus(key)): break
+...     time.sleep(0.1)
+... 
+>>> for i in range(3):
+...     handle = scheduler.SubmitTaskToBestServer(Tasks.BasicTask(
+...         't%i' % i, priority=0, estRunTime=10))
+... 
+>>> calls
+['Submit', 'Submit', 'Submit']
+>>> scheduler._loads.EstWaitTime(key, 0, 60)
+30.0
+>>> scheduler.Connection(server.Host(), server.Port()).Terminate()
+>>> scheduler.__del__()
+        """
+
+    @staticmethod
+    def _regr_test_load_listener():
+        """Check that the load listener ignores datagrams it should not trust.
+
+>>> import Scheduler, json, cPickle
+>>> here, elsewhere = (socket.gethostname(), 1), ('192.0.2.1', 1)
+>>> table = Scheduler._LoadTable()
+>>> listener = Scheduler._LoadListener(table, [here, elsewhere])
+>>> listener.start()
+>>> sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+>>> summary = {'host' : 'h', 'port' : 1, 'cpus' : 4, 'freeSlots' : 4,
+...            'queuedWork' : [], 'running' : [], 'time' : time.time()}
+>>> for (tag, encode) in [(here, cPickle.dumps), (elsewhere, json.dumps),
+...                       (here, json.dumps)]:
+...     summary['tag'] = tag
+...     _ignore = sender.sendto(encode(summary), listener.Address())
+...     time.sleep(0.2)
+...     print table.Cpus(here), table.Cpus(elsewhere)
+... 
+None None
+None None
+4 None
+>>> listener.stop.set(); sender.close()
+        """
+
+    @staticmethod
+    def _regr_test_health():
+        """Check that we stop contacting servers which keep failing.
+
+>>> import Servers, Scheduler, Tasks
+>>> server = Servers.BasicRPCServer(cpus=1, port=0, logRequests=False)
+>>> server.UpdateActives = lambda: None # keep everything queued
+>>> server.serve_forever_as_thread(daemon=True); time.sleep(0.2)
+Entering service loop forever or until killed...
+>>> deadSocket = socket.socket(); deadSocket.bind(('', 0))
+>>> deadKey = (socket.gethostname(), deadSocket.getsockname()[1])
+>>> deadSocket.close() # so connecting is refused
+>>> scheduler = Scheduler.Scheduler([(server.Host(), server.Port()), deadKey])
+>>> for i in range(4):
+...     handle = scheduler.SubmitTaskToBestServer(Tasks.BasicTask('t%i' % i))
+... 
+>>> info = scheduler.HostHealthInfo()
+>>> info[deadKey]['state'], info[deadKey]['failures']
+('down', 3)
+>>> info[(server.Host(), server.Port())]['state']
+'up'
+>>> print scheduler.ShowQueue(*deadKey)
+None
+>>> scheduler.Connection(server.Host(), server.Port()).Terminate()
+>>> scheduler.__del__()
+        """
+
+    @staticmethod
+    def _regr_test_submit_elsewhere():
+        """Check that SubmitTaskElsewhere skips the servers we give it.
+
+>>> import Servers, Scheduler, Tasks
+>>> servers = [Servers.BasicRPCServer(cpus=1, port=0, logRequests=False)
+...            for i in range(2)]
+>>> for server in servers:
+...     server.UpdateActives = lambda: None # keep everything queued
+...     server.serve_forever_as_thread(daemon=True); time.sleep(0.2)
+... 
+Entering service loop forever or until killed...
+Entering service loop forever or until killed...
+>>> keys = [(server.Host(), server.Port()) for server in servers]
+>>> scheduler = Scheduler.Scheduler(keys)
+>>> for i in range(3):
+...     handle = scheduler.SubmitTaskElsewhere(Tasks.BasicTask('t%i' % i),
+...                                            [keys[1]])
+...     print (handle.host, handle.port) == keys[0]
+... 
+True
+True
+True
+>>> print scheduler.SubmitTaskElsewhere(Tasks.BasicTask('t3'), keys)
+None
+>>> for key in keys:
+...     scheduler.Connection(*key).Terminate()
+... 
+>>> scheduler.__del__()
+        """
 
     def ShowQueue(self, host, port, timeout=3):
         """Show queue for server at given host, port.
+
+        Returns None if the server is marked down or can not be reached.
         """
+        if (not self._health.Available((host, port))):
+            logging.info('Not contacting %s:%s since it is down' % (
+                str(host), str(port)))
+            return None
         try:
-            oldtimeout = socket.getdefaulttimeout()
-            socket.setdefaulttimeout(timeout) # set timeout in case server dead
             logging.debug('Contacting %s:%s...' % (host, port))
-            return self.Connection(host, port).ShowQueue()
+            # use timeout in case server dead
+            result = self.Connection(host, port, timeout).ShowQueue()
+            self._health.Success((host, port))
+            return result
         except Exception, e:
             logging.info('Timeout: Unable to contact %s:%s because %s' % (
                 str(host),str(port),str(e)))
-        finally:
-            socket.setdefaulttimeout(oldtimeout)
+            self._health.Failure((host, port), e)
 
     def CleanOldTasks(self, host, port):
         """Call CleanOldTasks for server at given host, port.
         """
         return self.Connection(host, port).CleanOldTasks()
+
+class _HostProber(threading.Thread):
+    """Thread which asks one server for its estimated wait time on request.
+
+    Each prober has its own connection to its server so that the socket
+    timeout for probing does not affect anything else and so the
+    connection is kept alive between probes. Requests are tuples of the
+    form (priority, methods, timeout, replies, freeSlots) where methods
+    is the set of RPC names for the server or None if we need to ask for
+    them and freeSlots says whether we want the number of free slots.
+    The reply put on the replies queue is (key, result) where result is
+    either an exception or (estWaitTime, methods, fetched, slots) with
+    fetched True if we had to ask for methods and slots the number of
+    free slots (or None if not wanted or not known). Results are also
+    recorded in the given _HostHealth even if nobody waits for the
+    reply any more. Requests waiting at the same time with the same
+    priority and freeSlots are all answered by one probe. Putting None
+    on self.requests stops the thread.
+    """
+
+    def __init__(self, key, health):
+        threading.Thread.__init__(self, name='Prober-%s:%s' % key)
+        self.setDaemon(True)
+        self.key = key
+        self.health = health
+        self.requests = Queue.Queue()
+        self.busySince = None # time we started on outstanding requests
+        self._lock = threading.Lock()
+        self.transport = PicklingXMLRPC.KeepAliveTransport()
+        self.connection = PicklingXMLRPC.PicklingServerProxy(
+            'http://%s:%i' % key, transport=self.transport)
+
+    def Ask(self, request, stuckAfter):
+        """Queue request unless we have been busy for over stuckAfter seconds.
+
+        Returns True if request was queued and False otherwise.
+        """
+        self._lock.acquire()
+        try:
+            if (self.busySince is None):
+                self.busySince = time.time()
+            elif (time.time() - self.busySince > stuckAfter):
+                return False
+            self.requests.put(request)
+            return True
+        finally:
+            self._lock.release()
+
+    def run(self):
+        "Answer requests until we get None."
+
+        while True:
+            requests = [self.requests.get()]
+            try:
+                while True:
+                    requests.append(self.requests.get_nowait())
+            except Queue.Empty:
+                pass
+            if (None in requests):
+                break
+            answered = {} # (priority, freeSlots) -> result
+            for (priority, methods, timeout, replies, freeSlots) in requests:
+                if ((priority, freeSlots) not in answered):
+                    try:
+                        answered[(priority, freeSlots)] = self.Probe(
+                            priority, methods, timeout, freeSlots)
+                        self.health.Success(self.key)
+                    except Exception, e:
+                        answered[(priority, freeSlots)] = e
+                        self.health.Failure(self.key, e)
+                replies.put((self.key, answered[(priority, freeSlots)]))
+            self._lock.acquire()
+            try:
+                if (self.requests.empty()):
+                    self.busySince = None
+                else:
+                    self.busySince = time.time()
+            finally:
+                self._lock.release()
+
+    def Probe(self, priority, methods, timeout, freeSlots=False):
+        """Return (estWaitTime, methods, fetched, slots) for our server.
+
+        If freeSlots is True and the server has LoadSummary, we get the
+        wait and free slots from one LoadSummary call.
+        """
+        self.transport.timeout = timeout
+        fetched = methods is None
+        if (fetched):
+            methods = set(pickle.loads(self.connection.system.listMethods()))
+        if (freeSlots and 'LoadSummary' in methods):
+            summary = self.connection.LoadSummary()
+            work = sum([w for (p, w) in summary['queuedWork'] if p >= priority])
+            return (BasicRPCServer.EstWaitFromLoad(
+                summary['running'], work, summary['cpus']), methods,
+                    fetched, summary['freeSlots'])
+        # maintain backward compatibility,
+        # old servers have CPULoad instead of EstWaitTime
+        estWaitTime = None
+        if 'EstWaitTime' in methods:
+            estWaitTime = self.connection.EstWaitTime(priority)
+        elif 'CPULoad' in methods:
+            estWaitTime = self.connection.CPULoad()
+        if estWaitTime is None:
+            raise Exception(
+                'tried EstWaitTime and CPULoad with no useful result')
+        return (estWaitTime, methods, fetched, None)
+
+class _HostHealth:
+    """Health of each server used to skip servers which keep failing.
+
+    A server is 'up' until it fails failureThreshold times in a row. It
+    is then 'down' and Available returns False for it. A background
+    thread retries each down server once it has been down for backoff
+    seconds (state is 'retrying' during the retry). Each failed retry
+    doubles the backoff up to backoffMax. Any success puts the server
+    back up.
+
+>>> health = _HostHealth(failureThreshold=2, backoff=0.2, backoffMax=1)
+>>> key = (socket.gethostname(), 1)
+>>> health.Failure(key, 'oops'); health.Available(key)
+True
+>>> health.Failure(key, 'oops'); health.Available(key)
+False
+>>> health.Info()[key]['state'], health.Info()[key]['failures']
+('down', 2)
+>>> time.sleep(2); info = health.Info()[key] # retried and failed
+>>> info['state'], info['failures'] > 2, info['retryIn'] <= 1
+('down', True, True)
+>>> health.Success(key); health.Available(key)
+True
+>>> health.Stop()
+    """
+
+    def __init__(self, failureThreshold=3, backoff=5, backoffMax=600,
+                 timeout=5):
+        self.failureThreshold = failureThreshold
+        self.backoff = backoff
+        self.backoffMax = backoffMax
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._hosts = {} # (host, port) -> dictionary of info
+        self._retrier = None
+
+    def _Entry(self, key):
+        "Return info for key (creating it if necessary); must hold lock."
+
+        return self._hosts.setdefault(key, {
+            'state' : 'up', 'failures' : 0, 'lastError' : None,
+            'lastOk' : None, 'retryAt' : None, 'backoff' : None})
+
+    def Available(self, key):
+        "Return True unless server at key is down."
+
+        entry = self._hosts.get(key, None)
+        return entry is None or entry['state'] == 'up'
+
+    def Success(self, key):
+        "Note that a call to server at key worked."
+
+        self._lock.acquire()
+        try:
+            self._Entry(key).update(state='up', failures=0, retryAt=None,
+                                    backoff=None, lastOk=time.time())
+        finally:
+            self._lock.release()
+
+    def Failure(self, key, error):
+        "Note that a call to server at key failed with given error."
+
+        self._lock.acquire()
+        try:
+            entry = self._Entry(key)
+            entry['failures'] += 1
+            entry['lastError'] = str(error)
+            if (entry['state'] == 'retrying' or (
+                entry['state'] == 'up' and
+                entry['failures'] >= self.failureThreshold)):
+                if (entry['backoff'] is None):
+                    entry['backoff'] = self.backoff
+                else:
+                    entry['backoff'] = min(self.backoffMax, 2*entry['backoff'])
+                entry['state'] = 'down'
+                entry['retryAt'] = time.time() + entry['backoff']
+                logging.warning('Marking %s:%s down for %s seconds: %s' % (
+                    key[0], key[1], entry['backoff'], entry['lastError']))
+                if (self._retrier is None):
+                    self._retrier = _HostRetrier(self)
+                    self._retrier.start()
+        finally:
+            self._lock.release()
+
+    def DueForRetry(self):
+        "Return keys for down servers to retry now and mark them retrying."
+
+        now = time.time()
+        self._lock.acquire()
+        try:
+            keys = [k for (k, entry) in self._hosts.items()
+                    if entry['state'] == 'down' and entry['retryAt'] <= now]
+            for k in keys:
+                self._hosts[k]['state'] = 'retrying'
+            return keys
+        finally:
+            self._lock.release()
+
+    def Info(self):
+        "Return info as described in Scheduler.HostHealthInfo."
+
+        now = time.time()
+        self._lock.acquire()
+        try:
+            result = {}
+            for (k, entry) in self._hosts.items():
+                info = dict([(n, entry[n]) for n in [
+                    'state', 'failures', 'lastError', 'lastOk']])
+                info['retryIn'] = None if entry['retryAt'] is None else max(
+                    0, entry['retryAt'] - now)
+                result[k] = info
+            return result
+        finally:
+            self._lock.release()
+
+    def Stop(self):
+        "Stop the background retry thread if there is one."
+
+        if (self._retrier is not None):
+            self._retrier.stop.set()
+
+class _HostRetrier(threading.Thread):
+    """Thread which retries down servers for a _HostHealth.
+    """
+
+    def __init__(self, health, interval=0.5):
+        threading.Thread.__init__(self, name='HostRetrier')
+        self.setDaemon(True)
+        self.health = health
+        self.interval = interval
+        self.stop = threading.Event()
+
+    def run(self):
+        "Retry servers which are due until self.stop is set."
+
+        while (not self.stop.isSet()):
+            for key in self.health.DueForRetry():
+                try:
+                    PicklingXMLRPC.PicklingServerProxy(
+                        'http://%s:%s' % key, timeout=self.health.timeout
+                        ).system.listMethods()
+                    logging.info('Server %s:%s is back up' % key)
+                    self.health.Success(key)
+                except Exception, e:
+                    self.health.Failure(key, e)
+            self.stop.wait(self.interval)
+
+class _LoadTable:
+    """Latest load summary from each server plus work we sent since then.
+
+    Summaries come from BasicRPCServer.LoadSummary. Work we submit is
+    added right away so that a burst of submits does not all go to the
+    server which looked best before the burst. That work is dropped when
+    the next summary from the server arrives since the summary includes
+    it (or will soon, since our submit causes the server to send another
+    summary).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._summaries = {} # (host, port) -> (time received, summary)
+        self._added = {} # (host, port) -> list of (priority, work, slots)
+
+    def Update(self, key, summary):
+        "Record summary for server at key unless we have a newer one."
+
+        self._lock.acquire()
+        try:
+            _received, old = self._summaries.get(key, (None, None))
+            if (old is None or old['time'] <= summary['time']):
+                self._summaries[key] = (time.time(), summary)
+                self._added[key] = []
+        finally:
+            self._lock.release()
+
+    def AddWork(self, key, priority, work, slots=1):
+        "Note that we just gave server at key work using slots at priority."
+
+        self._lock.acquire()
+        try:
+            self._added.setdefault(key, []).append((priority, work, slots))
+        finally:
+            self._lock.release()
+
+    def Cpus(self, key):
+        "Return number of cpus for server at key or None if unknown."
+
+        _received, summary = self._summaries.get(key, (None, None))
+        return None if summary is None else summary['cpus']
+
+    def EstWaitTime(self, key, priority, maxAge):
+        """Estimate wait time for priority on server at key.
+
+        This is the same calculation as BasicRPCServer.EstWaitTime using
+        the latest summary aged by the time since we got it plus the work
+        we added. If we have no summary newer than maxAge seconds, we
+        return None.
+        """
+        now = time.time()
+        self._lock.acquire()
+        try:
+            received, summary = self._summaries.get(key, (None, None))
+            added = list(self._added.get(key, []))
+        finally:
+            self._lock.release()
+        if (summary is None or now - received > maxAge):
+            return None
+        age = now - received
+        running = [(max(0, remaining - slots*age), slots) for (
+            remaining, slots) in summary['running']]
+        work = sum([w for (p, w) in summary['queuedWork'] if p >= priority])
+        work += sum([w for (p, w, _s) in added if p >= priority])
+        return BasicRPCServer.EstWaitFromLoad(running, work, summary['cpus'])
+
+    def FreeSlots(self, key, maxAge):
+        """Estimate number of free task slots on server at key.
+
+        We start from the free slots in the latest summary, add the slots
+        of running tasks which should have finished since then, and take
+        away the slots of tasks we added. If we have no summary newer than
+        maxAge seconds, we return None.
+        """
+        now = time.time()
+        self._lock.acquire()
+        try:
+            received, summary = self._summaries.get(key, (None, None))
+            added = list(self._added.get(key, []))
+        finally:
+            self._lock.release()
+        if (summary is None or now - received > maxAge
+            or 'freeSlots' not in summary):
+            return None
+        age = now - received
+        freeSlots = summary['freeSlots'] + sum([
+            slots for (remaining, slots) in summary['running']
+            if remaining <= slots*age])
+        return freeSlots - sum([s for (_p, _w, s) in added])
+
+def _HostAddresses(host):
+    "Return set of IP addresses for host (empty if it cannot be resolved)."
+
+    try:
+        return set(socket.gethostbyname_ex(host)[2])
+    except socket.error, e:
+        logging.warning('Unable to resolve %s: %s' % (host, str(e)))
+        return set()
+
+def _LocalAddress(address):
+    "Return IP address of our interface used to reach address or None."
+
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        try:
+            probe.connect((address, 9)) # sends nothing for UDP
+            return probe.getsockname()[0]
+        except socket.error:
+            return None
+    finally:
+        probe.close()
+
+def _ParseLoadSummary(data):
+    """Decode load summary sent by BasicRPCServer._GossipLoop.
+
+    Summaries are JSON so decoding one cannot run code. We check that
+    every field we use has the right type and raise ValueError if not.
+    The tag is returned as a (host, port) tuple.
+
+>>> import json, cPickle
+>>> summary = {'host' : 'h', 'port' : 1, 'cpus' : 2, 'freeSlots' : 1,
+...            'queuedWork' : [(0, 10.0)], 'running' : [(5.0, 1)],
+...            'time' : 1e9, 'tag' : ('h', 1)}
+>>> parsed = _ParseLoadSummary(json.dumps(summary))
+>>> parsed == summary, parsed['tag']
+(True, ('h', 1))
+>>> _ParseLoadSummary(cPickle.dumps(summary))
+Traceback (most recent call last):
+...
+ValueError: No JSON object could be decoded
+>>> summary['running'] = [(5.0, 'cpus')]
+>>> _ParseLoadSummary(json.dumps(summary))
+Traceback (most recent call last):
+...
+ValueError: bad running in load summary
+    """
+    def IsNumber(value):
+        "Return True if value is an int, long, or float."
+        return isinstance(value, (int, long, float)) and not isinstance(
+            value, bool)
+
+    def Pairs(value):
+        "Return value as a list of tuples of two numbers or None if not."
+        if (not isinstance(value, list)):
+            return None
+        pairs = [tuple(item) for item in value if isinstance(item, list)
+                 and len(item) == 2 and IsNumber(item[0])
+                 and IsNumber(item[1])]
+        return pairs if len(pairs) == len(value) else None
+
+    summary = json.loads(data)
+    if (not isinstance(summary, dict)):
+        raise ValueError('load summary is not a dictionary')
+    tag = summary.get('tag', None)
+    if (not (isinstance(tag, list) and len(tag) == 2
+             and isinstance(tag[0], basestring)
+             and isinstance(tag[1], (int, long)))):
+        raise ValueError('bad tag in load summary')
+    summary['tag'] = (str(tag[0]), tag[1])
+    summary['host'] = str(summary.get('host', ''))
+    for name in ['port', 'cpus', 'freeSlots', 'time']:
+        if (not IsNumber(summary.get(name, None))):
+            raise ValueError('bad %s in load summary' % name)
+    for name in ['queuedWork', 'running']:
+        summary[name] = Pairs(summary.get(name, None))
+        if (summary[name] is None):
+            raise ValueError('bad %s in load summary' % name)
+    return summary
+
+class _LoadListener(threading.Thread):
+    """Thread which receives load summaries over UDP and puts them in a table.
+
+    Anyone can send us a datagram, so summaries are JSON (see
+    _ParseLoadSummary) and a summary is only used if it came from an
+    address of the server named by its tag. If all servers in keys are
+    reached through the same interface, we only listen on that one.
+    """
+
+    def __init__(self, table, keys):
+        threading.Thread.__init__(self, name='LoadListener')
+        self.setDaemon(True)
+        self.table = table
+        self.stop = threading.Event()
+        self.senders = dict([(k, _HostAddresses(k[0])) for k in keys])
+        interfaces = set([_LocalAddress(a) for addresses in (
+            self.senders.values()) for a in addresses])
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind((interfaces.pop() if (
+            len(interfaces) == 1 and None not in interfaces) else '', 0))
+        self.socket.settimeout(1)
+
+    def Address(self):
+        "Return (host, port) servers should send summaries to."
+
+        host, port = self.socket.getsockname()
+        return (socket.gethostname() if host == '0.0.0.0' else host, port)
+
+    def run(self):
+        "Receive summaries until self.stop is set."
+
+        try:
+            while (not self.stop.isSet()):
+                try:
+                    data, sender = self.socket.recvfrom(65536)
+                except socket.timeout:
+                    continue
+                try:
+                    summary = _ParseLoadSummary(data)
+                    if (sender[0] not in self.senders.get(summary['tag'], ())):
+                        raise ValueError('summary for %s:%s came from %s' % (
+                            summary['tag'] + (sender[0],)))
+                    self.table.Update(summary['tag'], summary)
+                except Exception, e:
+                    logging.debug('Ignoring bad load summary: %s' % str(e))
+        finally:
+            self.socket.close()
+
+class _LoadSubscriber(threading.Thread):
+    """Thread which keeps our load summary subscriptions with servers alive.
+    """
+
+    def __init__(self, keys, address, interval, table, timeout=5):
+        threading.Thread.__init__(self, name='LoadSubscriber')
+        self.setDaemon(True)
+        self.keys = list(keys)
+        self.address = address
+        self.interval = interval
+        self.table = table
+        self.timeout = timeout
+        self.stop = threading.Event()
+
+    def run(self):
+        "Subscribe to each server every self.interval seconds until stopped."
+
+        connections = dict([(k, PicklingXMLRPC.PicklingServerProxy(
+            'http://%s:%i' % k, timeout=self.timeout)) for k in self.keys])
+        while (not self.stop.isSet()):
+            for k in self.keys:
+                try:
+                    self.table.Update(k, connections[k].SubscribeLoad(
+                        self.address[0], self.address[1], k,
+                        3*self.interval))
+                except Exception, e:
+                    logging.debug('Unable to subscribe to %s:%s: %s' % (
+                        k[0], k[1], str(e)))
+            self.stop.wait(self.interval)
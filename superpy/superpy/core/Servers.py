@@ -6,11 +6,261 @@ used to submit tasks to the best server in a group. See docs for the
 Scheduler class for details.
 """
 
-import os, socket, threading, SocketServer, logging, re, time, datetime
-import Tasks, PicklingXMLRPC, SimpleXMLRPCServer, DataStructures
+import os, socket, threading, logging, re, time, datetime, Queue, math
+import select, cPickle, random, tempfile, xmlrpclib, sys, zlib, json
+import Tasks, PicklingXMLRPC, SimpleXMLRPCServer, DataStructures, Process
+import FramedRPC, Blobs
 
-class BasicRPCServer(PicklingXMLRPC.PicklingXMLRPCServer,
-                     SocketServer.ThreadingMixIn):
+class WorkerPoolMixIn:
+    """Mix-in class to handle requests with a fixed pool of worker threads.
+
+    SocketServer.ThreadingMixIn starts a new thread for every request and
+    places no limit on how many requests run at once. This mix-in instead
+    keeps a fixed number of worker threads which pull accepted requests
+    off of a queue while the thread calling handle_request keeps accepting
+    new connections. The number of requests which are accepted but not
+    yet finished is capped by a semaphore. When the cap is reached, the
+    accept loop blocks and new connections wait in the listen backlog.
+
+    Sub-classes must call self._StartWorkers before serving requests and
+    self._StopWorkers when done. If numWorkers is 0, requests are
+    handled one at a time in the thread calling handle_request.
+
+    Handlers may call self.KeepRequest to ask that a persistent (HTTP/1.1
+    keep-alive) connection stay open after a request. Rather than tie up
+    a worker while the client is idle, the connection is parked and
+    self._ServeOnce watches it along with the listening socket. When the
+    client sends its next request, the connection is queued for a
+    worker like a newly accepted one. Parked connections which stay idle
+    for more than keepAliveTimeout seconds are closed.
+
+    Handlers which are about to block for a long time (e.g., waiting for
+    a task to finish) should call self.StartWaiting and, if it returns
+    True, self.DoneWaiting when done. The worker then leaves the pool
+    (a new worker takes its place) and gives back its in-flight slot, so
+    waiting requests never hold up other requests. At most maxWaiters
+    requests wait at once; StartWaiting returns False beyond that and the
+    handler should reply right away instead of blocking.
+    """
+
+    numWorkers = 16
+    maxInFlight = 64
+    maxWaiters = 256
+    keepAliveTimeout = 60
+    # Listen backlog; SocketServer's default of 5 is too small when many
+    # clients connect at once and then keep their connections open.
+    request_queue_size = 128
+
+    def _StartWorkers(self):
+        "Start self.numWorkers threads to process requests."
+
+        self._requests = Queue.Queue()
+        self._inFlight = threading.Semaphore(max(1, self.maxInFlight))
+        self._parkLock = threading.Lock()
+        self._kept = set()
+        self._parked = {}
+        self._stopped = False
+        self._wakeReader, self._wakeWriter = _MakeWakeupPair()
+        self._waiters = threading.Semaphore(max(0, self.maxWaiters))
+        self._workerLock = threading.Lock()
+        self._workerLocal = threading.local()
+        self._workers = []
+        self._numStarted = 0
+        for _i in range(self.numWorkers):
+            self._AddWorker()
+
+    def _AddWorker(self):
+        "Start a thread to process requests and add it to self._workers."
+
+        self._workerLock.acquire()
+        try:
+            worker = threading.Thread(
+                target=self._WorkerLoop,
+                name='RequestWorker-%i' % self._numStarted)
+            self._numStarted += 1
+            worker.setDaemon(True)
+            worker.start()
+            self._workers.append(worker)
+        finally:
+            self._workerLock.release()
+
+    def _StopWorkers(self):
+        "Tell worker threads to exit once they finish pending requests."
+
+        self._workerLock.acquire()
+        try:
+            workers, self._workers = self._workers, []
+        finally:
+            self._workerLock.release()
+        for _worker in workers:
+            self._requests.put(None)
+        self._parkLock.acquire()
+        try:
+            parked, self._parked = self._parked, {}
+            self._stopped = True
+            self._wakeReader.close()
+            self._wakeWriter.close()
+        finally:
+            self._parkLock.release()
+        for request in parked:
+            self._CloseRequest(request)
+
+    def StartWaiting(self):
+        """Called by a handler before it blocks for a long time.
+
+        Returns True if the handler may block, in which case it must call
+        self.DoneWaiting when done, and False if too many handlers are
+        already waiting. See class docs.
+        """
+        waiters = getattr(self, '_waiters', None)
+        if (waiters is None):
+            return True # not serving so nobody else is held up
+        if (not waiters.acquire(False)):
+            logging.warning('Already %i requests waiting; not waiting'
+                            % self.maxWaiters)
+            return False
+        if (getattr(self._workerLocal, 'pooled', False)):
+            self._workerLocal.pooled = False
+            self._inFlight.release()
+            self._workerLock.acquire()
+            try:
+                current = threading.currentThread()
+                if (current in self._workers):
+                    self._workers.remove(current)
+                    replace = True
+                else:
+                    replace = False # we are stopping
+            finally:
+                self._workerLock.release()
+            if (replace):
+                self._AddWorker()
+        return True
+
+    def DoneWaiting(self):
+        "Called by a handler when done waiting if StartWaiting returned True."
+
+        waiters = getattr(self, '_waiters', None)
+        if (waiters is not None):
+            waiters.release()
+
+    def KeepRequest(self, request):
+        "Called by a handler to keep request open after it is handled."
+
+        self._parkLock.acquire()
+        try:
+            self._kept.add(request)
+        finally:
+            self._parkLock.release()
+
+    def _DoneWithRequest(self, request, client_address):
+        "Park request if a handler asked to keep it, otherwise close it."
+
+        self._parkLock.acquire()
+        try:
+            keep = request in self._kept and not self._stopped
+            self._kept.discard(request)
+            if (keep):
+                self._parked[request] = (client_address, time.time())
+                self._wakeWriter.send('x') # so _ServeOnce watches it
+        finally:
+            self._parkLock.release()
+        if (not keep):
+            self._CloseRequest(request)
+
+    def _ServeOnce(self, timeout=None):
+        """Handle a new connection or a parked connection with a request.
+
+        This is what the serving loop calls in place of handle_request.
+        """
+        self._parkLock.acquire()
+        try:
+            parked = self._parked.keys()
+        finally:
+            self._parkLock.release()
+        if (parked):
+            timeout = 1 if timeout is None else min(timeout, 1)
+        try:
+            readable = select.select(
+                [self, self._wakeReader] + parked, [], [], timeout)[0]
+        except (select.error, socket.error), e:
+            logging.debug('Ignoring %s in select; retrying' % str(e))
+            readable = []
+        for item in readable:
+            if (item is self):
+                self._handle_request_noblock()
+            elif (item is self._wakeReader):
+                self._wakeReader.recv(4096)
+            else:
+                self._parkLock.acquire()
+                try:
+                    client_address = self._parked.pop(item, (None,))[0]
+                finally:
+                    self._parkLock.release()
+                self.process_request(item, client_address)
+        self._CloseIdleRequests()
+
+    def _CloseIdleRequests(self):
+        "Close parked connections idle for more than self.keepAliveTimeout."
+
+        cutoff = time.time() - self.keepAliveTimeout
+        self._parkLock.acquire()
+        try:
+            idle = [r for (r, (_a, t)) in self._parked.items() if t < cutoff]
+            for request in idle:
+                del self._parked[request]
+        finally:
+            self._parkLock.release()
+        for request in idle:
+            self._CloseRequest(request)
+
+    def process_request(self, request, client_address):
+        """Queue the request for a worker thread.
+
+        Overrides SocketServer.BaseServer.process_request.
+        """
+        if (not self._workers):
+            return self._ProcessInline(request, client_address)
+        self._inFlight.acquire()
+        self._requests.put((request, client_address))
+
+    def _ProcessInline(self, request, client_address):
+        "Process request in the current thread like BaseServer does."
+
+        try:
+            self.finish_request(request, client_address)
+        except: #pylint:disable-msg=W0702
+            self.handle_error(request, client_address)
+            self._kept.discard(request)
+        self._DoneWithRequest(request, client_address)
+
+    def _CloseRequest(self, request):
+        "Close the request socket (shutdown_request is new in python 2.6)."
+
+        getattr(self, 'shutdown_request', self.close_request)(request)
+
+    def _WorkerLoop(self):
+        "Main loop for worker threads started by self._StartWorkers."
+
+        while True:
+            item = self._requests.get()
+            if (item is None):
+                break
+            request, client_address = item
+            self._workerLocal.pooled = True
+            try:
+                try:
+                    self.finish_request(request, client_address)
+                except: #pylint:disable-msg=W0702
+                    self.handle_error(request, client_address)
+                    self._kept.discard(request)
+            finally:
+                self._DoneWithRequest(request, client_address)
+                if (self._workerLocal.pooled):
+                    self._inFlight.release()
+            if (not self._workerLocal.pooled):
+                break # we waited so another worker took our place
+
+class BasicRPCServer(WorkerPoolMixIn, PicklingXMLRPC.PicklingXMLRPCServer):
     """Class representing server to run remote tasks.
 
     This class represents a server to run superpy tasks. It is not
@@ -23,38 +273,159 @@ class BasicRPCServer(PicklingXMLRPC.PicklingXMLRPCServer,
     # The following list of functions are the ones that we allow to be
     # called via RPC.
     _RPCFunctions = [
-        'Submit','Terminate','RemoveFromQueue','Status', 'CountNumCPUs',
-        'EstWaitTime','ShowQueue', 'CleanFromQueue', 'CleanOldTasks']
+        'Submit','SubmitMany','Terminate','RemoveFromQueue','Status',
+        'WaitForAny','CountNumCPUs','LoadSummary','SubscribeLoad',
+        'NumCPUs','EstWaitTime','ShowQueue', 'CleanFromQueue', 'CleanOldTasks',
+        'SetPriority','LearnedRunTimes','SetPeers','GiveTasks','ConfirmGiven',
+        'ReturnGiven','CompressionStats','SubmitShared','BlobInfo',
+        'FetchResult','FetchResultChunk','ResultInfo']
     defaultPort = 9287
-    def __init__(self,cpus=None,host=None,port=None, *args, **kw):
+    # In peer mode (see SetPeers) we try to take queued tasks from peers
+    # whenever we have free slots and nothing queued, and at least every
+    # stealInterval seconds. Calls to peers time out after peerTimeout.
+    # Tasks given to a peer which does not confirm it took them within
+    # moveLease seconds are queued here again.
+    stealInterval = 5
+    peerTimeout = 30
+    moveLease = 120
+    # Tasks submitted without an estRunTime get the learned mean run time
+    # of their family plus learnedStddevs standard deviations. The
+    # history is saved at most every runTimeSaveInterval seconds.
+    learnedStddevs = 0.5
+    runTimeSaveInterval = 60
+    # Running tasks which have run longer than their estimated run time
+    # are assumed to need overrunFraction of it more rather than nothing.
+    overrunFraction = 0.5
+    # Load summaries are sent to subscribers when load changes (but not
+    # more often than gossipMinInterval) and every gossipHeartbeat seconds.
+    gossipHeartbeat = 5
+    gossipMinInterval = 0.05
+    # Requests (or frames) larger than maxRequestBytes are refused with
+    # HTTP 413 (or by closing the connection). Request bodies larger than
+    # spillRequestBytes are read into a temporary file instead of memory.
+    maxRequestBytes = 1 << 30
+    spillRequestBytes = 64 << 20
+    # Responses of at least compressThreshold bytes are compressed at
+    # compressLevel for clients which accept deflate (0 means never).
+    compressLevel = PicklingXMLRPC.COMPRESS_LEVEL
+    compressThreshold = PicklingXMLRPC.COMPRESS_THRESHOLD
+    # Blobs sent with SubmitShared are kept until they take more than
+    # maxBlobBytes; then the least recently used are forgotten.
+    maxBlobBytes = 256 << 20
+    # Results of finished tasks of at least lazyResultBytes are left out
+    # of handles and kept in a DataStructures.ResultStore which writes
+    # them to files in resultSpillDir (a temporary directory if None)
+    # if they are at least spillResultBytes or if those in memory take
+    # more than maxResultMemory.
+    lazyResultBytes = 1 << 20
+    spillResultBytes = 64 << 20
+    # FetchResultChunk sends at most resultChunkBytes at a time.
+    resultChunkBytes = 8 << 20
+    maxResultMemory = 512 << 20
+    resultSpillDir = None
+    def __init__(self,cpus=None,host=None,port=None,numWorkers=None,
+                 maxInFlight=None,runTimeFile=None,peers=None,
+                 warmChildren=0,*args, **kw):
         """Initializer.
         
         INPUTS:
         
         -- cpus=None:  Optional integer indicating number of CPUs server has.
+                       This is the number of task slots the server fills
+                       at once. If None, we use self.CountNumCPUs().
         
         -- host=None:  String indicating name of host to run on. If this is
                        None, then we lookup name of localhost. 
         
         -- port=None:  Integer port to listen on. If 0, we dynamically generate
                        port num which you can get via self.socket.getsockname()
+
+        -- numWorkers=None:  Optional number of threads used to handle RPC
+                             requests concurrently. If None, we use
+                             WorkerPoolMixIn.numWorkers. A value of 0 means
+                             handle one request at a time.
+
+        -- maxInFlight=None: Optional maximum number of requests which
+                             can be accepted but not yet finished. If None,
+                             we use WorkerPoolMixIn.maxInFlight.
+
+        -- runTimeFile=None: Optional path of file to load and save the
+                             history of task run times in (see
+                             LearnedRunTimes). If None, the history is
+                             not saved.
+
+        -- peers=None:       Optional list of (host, port) pairs for other
+                             servers to share queued tasks with. See
+                             SetPeers.
+
+        -- warmChildren=0:   Number of started child processes to keep
+                             for tasks which spawn one (e.g., instances of
+                             Tasks.ImpersonatingTask). See Process.WarmPool.
+                             If 0, each such task starts a new child.
         
         -- *args, **kw: Additional args to PicklingXMLRPCServer.__init__.
         """
         
         if (None == host): host = socket.gethostname()
         if (None == port): port = self.defaultPort
-        #if (None == cpus): cpus = self.CountNumCPUs()
-        cpus = 1
+        if (None == cpus): cpus = self.CountNumCPUs()
+        if (numWorkers is not None): self.numWorkers = numWorkers
+        if (maxInFlight is not None): self.maxInFlight = maxInFlight
         
         self._quit = False
         self._thread = None
         self._host = host
         self._port = port
         self._cpus = cpus
+        # Items in self._queue have state 'queued', 'running', 'finished',
+        # 'moving' (given to a peer but not yet confirmed; see GiveTasks),
+        # or 'held' (taken from a peer but not yet confirmed; see _StealOnce)
         self._queue = DataStructures.NamedQueue()
-        self._active = DataStructures.NamedQueue()
+        # Unstarted tasks ordered by priority and then submission order
+        self._pending = DataStructures.NamedPriorityQueue()
+        # Estimated work (run time times slots) of tasks in self._pending
+        # by priority so EstWaitTime does not need to look at every task.
+        self._pendingWork = DataStructures.PrioritySums()
+        self._pendingWorkOf = {}
         self._uaSemaphore = threading.Semaphore()
+        self._uaPending = False
+        # Requests are handled by multiple threads so anything that
+        # reads or modifies self._queue or self._pending should hold
+        # self._lock. Do not call UpdateActives while holding self._lock.
+        self._lock = threading.RLock()
+        # Notified (with self._lock held) whenever tasks start or finish.
+        self._changed = threading.Condition(self._lock)
+        # UDP address -> (tag, expiry time) for load summary subscribers
+        self._subscribers = {}
+        # Address of the client whose request this thread is handling
+        self._caller = threading.local()
+        self._loadChanged = threading.Event()
+        self._gossipThread = None
+        self._workers = []
+        # Run times of finished tasks by family (see Tasks.BasicTask.Family)
+        self._runTimeFile = runTimeFile
+        self._runTimes = DataStructures.RuntimeHistory.Load(runTimeFile) if (
+            runTimeFile is not None) else DataStructures.RuntimeHistory()
+        self._runTimesSaved = time.time()
+        self._runTimesDirty = False
+        # Peer mode: tasks we gave to peers are in state 'moving' until
+        # the peer confirms and then we remember where they went.
+        self._peers = None
+        self._moving = {} # name -> (host, port, lease expiry time)
+        self._moved = {} # name -> (host, port, time moved)
+        self._held = {} # (host, port) of peer -> names of tasks held
+        self._stealWake = threading.Event()
+        self._stealThread = None
+        self._warmChildren = warmChildren
+        self._warmPool = None
+        # Connections whose client sent FramedRPC.PREAMBLE and now sends
+        # frames instead of HTTP requests (see NewRequestHandler).
+        self._framedRequests = set()
+        self._compressionStats = PicklingXMLRPC.CompressionStats()
+        self._blobs = Blobs.BlobStore(self.maxBlobBytes)
+        self._results = DataStructures.ResultStore(
+            self.lazyResultBytes, self.spillResultBytes, self.maxResultMemory,
+            self.resultSpillDir)
 
         logging.debug('Starting BasicRPCServer on %s:%i.' % (host,port))
         PicklingXMLRPC.PicklingXMLRPCServer.__init__(
@@ -65,6 +436,95 @@ class BasicRPCServer(PicklingXMLRPC.PicklingXMLRPCServer,
         self.register_introspection_functions()
         for name in self._RPCFunctions:
             self.register_function(getattr(self,name))
+        if (peers is not None):
+            self._peers = [tuple(p) for p in peers]
+
+    def CompressionStats(self):
+        """Return dictionary of counts of bytes and time for compression.
+
+        See PicklingXMLRPC.CompressionStats for what the counts mean.
+        Here, sent means responses and received means requests.
+        """
+        return self._compressionStats.Info()
+
+    def _marshaled_dispatch(self, data, dispatch_method=None, path=None):
+        """Like SimpleXMLRPCDispatcher._marshaled_dispatch but for bodies.
+
+        INPUTS:
+
+        -- data:        XML-RPC request as a string, a bytearray, or a
+                        file-like object positioned at the start of the
+                        request (see NewRequestHandler._ReadBody).
+
+        -- dispatch_method=None, path=None:  As for the base class.
+
+        -------------------------------------------------------
+
+        RETURNS:        Marshalled response.
+
+        -------------------------------------------------------
+
+        PURPOSE:        We feed data to the XML parser in chunks instead
+                        of requiring one string so large requests are
+                        never copied as a whole.
+
+        """
+        _ignore = path
+        try:
+            parser, unmarshaller = xmlrpclib.getparser()
+            expat = getattr(parser, '_parser', None)
+            if (expat is not None):
+                # Get text as byte strings in large pieces instead of as
+                # unicode one line at a time (which takes several times
+                # the memory of a large argument).
+                expat.returns_unicode = 0
+                expat.buffer_size = 1 << 20
+                expat.buffer_text = 1
+            for chunk in _Chunks(data):
+                parser.feed(chunk)
+            parser.close()
+            params, method = unmarshaller.close(), unmarshaller.getmethodname()
+            del parser, unmarshaller
+            if dispatch_method is not None:
+                response = dispatch_method(method, params)
+            else:
+                response = self._dispatch(method, params)
+            del params
+            response = xmlrpclib.dumps((response,), methodresponse=1,
+                allow_none=self.allow_none, encoding=self.encoding)
+        except xmlrpclib.Fault, fault:
+            response = xmlrpclib.dumps(fault, allow_none=self.allow_none,
+                                       encoding=self.encoding)
+        except: #pylint:disable-msg=W0702
+            exc_type, exc_value = sys.exc_info()[:2]
+            response = xmlrpclib.dumps(
+                xmlrpclib.Fault(1, "%s:%s" % (exc_type, exc_value)),
+                encoding=self.encoding, allow_none=self.allow_none)
+        return response
+
+    def finish_request(self, request, client_address):
+        "Note client_address (see _CallerAddress) and handle request."
+
+        self._caller.address = client_address
+        try:
+            PicklingXMLRPC.PicklingXMLRPCServer.finish_request(
+                self, request, client_address)
+        finally:
+            self._caller.address = None
+
+    def _CallerAddress(self):
+        """Return (host, port) of client whose request we are handling.
+
+        This is None if we are not handling a request (e.g., for a
+        method called directly instead of over RPC).
+        """
+        return getattr(self._caller, 'address', None)
+
+    def _CloseRequest(self, request):
+        "Forget whether request was framed and close it."
+
+        self._framedRequests.discard(request)
+        WorkerPoolMixIn._CloseRequest(self, request)
 
     def __del__(self):
         "Shutdown server. Usually called automatically by python."
@@ -88,8 +548,26 @@ class BasicRPCServer(PicklingXMLRPC.PicklingXMLRPCServer,
         call to have the server process requests.
         """
         print 'Entering service loop forever or until killed...'
-        while (not self._quit):
-            self.handle_request()
+        self._StartWorkers()
+        if (self._peers is not None):
+            self._StartStealing()
+        if (self._warmChildren):
+            self._warmPool = Process.WarmPool(self._warmChildren)
+            Process.SetWarmPool(self._warmPool)
+        try:
+            while (not self._quit):
+                self._ServeOnce()
+        finally:
+            self._StopWorkers()
+            self.server_close() # so clients get refused instead of hanging
+            self._loadChanged.set() # so gossip thread notices we quit
+            self._stealWake.set() # so stealing thread notices we quit
+            self._SaveRunTimes(force=True)
+            self._results.Close()
+            if (self._warmPool is not None):
+                if (Process._warmPool is self._warmPool):
+                    Process.SetWarmPool(None)
+                self._warmPool.Stop()
 
     def serve_forever_as_thread(self, daemon=False):
         """Starts a new thread and runs self.serve_forever in that thread.
@@ -128,20 +606,131 @@ class BasicRPCServer(PicklingXMLRPC.PicklingXMLRPCServer,
         PURPOSE:        Submit a task to the server to run.
         
         """
-        assert isinstance(task,Tasks.BasicTask), """
-        Expected instance of Tasks.BasicTask but got %s.
-        """ % str(task)
-        callbacks = [] if callbacks is None else list(callbacks) + [
-            lambda : self.UpdateActives]
-        serverTask = Tasks.ServerSideTask(
-            task,self._host,self._port,emailList,callbacks)
-        self._queue.Push(task.Name(), serverTask)
-        result = serverTask.GetHandle()
+        return self.SubmitMany([task],emailList,callbacks)[0]
+
+    def SubmitShared(self,skeleton,refs,blobs,emailList=None,callbacks=None):
+        """Submit tasks pickled with their large parts as separate blobs.
+        
+        INPUTS:
+        
+        -- skeleton:        Pickle of a list of tasks from Blobs.SplitDumps.
+        
+        -- refs:            List of keys of blobs skeleton refers to.
+        
+        -- blobs:           Dictionary of blobs (as from Blobs.SplitDumps)
+                            which we may not have yet.
+        
+        -- emailList=None, callbacks=None:  As for SubmitMany.
+        
+        -------------------------------------------------------
+        
+        RETURNS:        Pair (handles, missing). If we have all the blobs
+                        the tasks need, handles is the list SubmitMany
+                        would return and missing is empty. Otherwise
+                        handles is None, missing is a list of keys of
+                        blobs to send, and nothing is queued.
+        
+        -------------------------------------------------------
+        
+        PURPOSE:        Lets clients send large state shared by many
+                        tasks (e.g., a config object) only once. Blobs
+                        are kept in a Blobs.BlobStore holding at most
+                        self.maxBlobBytes. Strings loaded from it are
+                        shared by all tasks using them. See
+                        Blobs.SubmitShared for the client side.
+        
+        """
+        for (key, (data, blobRefs)) in blobs.items():
+            self._blobs.Add(key, data, blobRefs)
+        missing = self._blobs.Missing(refs, blobs)
+        if (not missing):
+            try:
+                tasks = Blobs.Loads(skeleton, lambda key : (
+                    blobs[key][0] if key in blobs else self._blobs.Get(key)))
+            except Blobs.MissingBlob, e: # forgotten since we checked
+                missing = [e.args[0]]
+        if (missing):
+            logging.debug('Asking for %i missing blobs' % len(missing))
+            return None, missing
+        return self.SubmitMany(tasks,emailList,callbacks), []
+
+    def BlobInfo(self):
+        "Return dictionary with number and size of blobs for SubmitShared."
+        return self._blobs.Info()
+
+    def SubmitMany(self,tasks,emailList=None,callbacks=None):
+        """Submit a list of tasks to this server at once.
+        
+        INPUTS:
+        
+        -- tasks:           List of instances of subclass of BasicTask.
+        
+        -- emailList=None:  Optional list of strings representing email
+                            addresses to email when each task finishes.
+        
+        -- callbacks=None:  Optional list of Tasks.BasicCallback instances
+                            to call when each task completes.    
+        
+        -------------------------------------------------------
+        
+        RETURNS:        List of handles for the newly submitted tasks in
+                        the same order as tasks.
+        
+        -------------------------------------------------------
+        
+        PURPOSE:        Submit many tasks with a single RPC. Either all
+                        of the tasks are queued or, if any task is not
+                        valid or has the same name as another task, none
+                        of them are.
+        
+        """
+        for task in tasks:
+            assert isinstance(task,Tasks.BasicTask), """
+            Expected instance of Tasks.BasicTask but got %s.
+            """ % str(task)
+        serverTasks = []
+        for task in tasks:
+            taskCallbacks = [] if callbacks is None else list(callbacks) + [
+                lambda : self.UpdateActives]
+            serverTasks.append(Tasks.ServerSideTask(
+                task,self._host,self._port,emailList,taskCallbacks))
+        self._QueueTasks(serverTasks)
+        result = [serverTask.GetHandle() for serverTask in serverTasks]
 
         self.UpdateActives()
         
         return result
 
+    def _QueueTasks(self, serverTasks, state='queued'):
+        """Queue all the given ServerSideTasks or, if any name is taken, none.
+
+        If state is 'held' instead of 'queued', the tasks are put in
+        self._queue but cannot start until _ConfirmHeld releases them.
+        """
+        names = set()
+        for serverTask in serverTasks:
+            name = serverTask.clientTask.Name()
+            if (name in names):
+                raise Exception('Task name %s appears more than once.' % name)
+            names.add(name)
+        self._lock.acquire()
+        try:
+            for name in names:
+                if (name in self._queue):
+                    raise Exception(
+                        "Can't add item %s when item with that name is in "
+                        "queue." % name)
+            for serverTask in serverTasks:
+                name = serverTask.clientTask.Name()
+                serverTask.results = self._results
+                self._UseLearnedRunTime(serverTask.clientTask)
+                self._queue.Push(name, serverTask, state)
+                if (state == 'queued'):
+                    self._AddPending(name, serverTask)
+                self._moved.pop(name, None)
+        finally:
+            self._lock.release()
+
     def RemoveFromQueue(self,handle):
         """Remove a task from the server's queue.
         
@@ -162,6 +751,9 @@ class BasicRPCServer(PicklingXMLRPC.PicklingXMLRPCServer,
         """
         
         name = handle.Name()
+        peer = self._MovedTo(name)
+        if (peer is not None):
+            return self._PeerProxy(peer).RemoveFromQueue(handle)
         task = self._queue[name]
 
         if (task.started.isSet()):
@@ -198,14 +790,29 @@ class BasicRPCServer(PicklingXMLRPC.PicklingXMLRPCServer,
         
         """
         name = handle.Name()
-        task = self._queue.PopItem(name)
-
-        if (task.started.isSet() and not task.finished.isSet()):
-            raise Exception('''
+        peer = self._MovedTo(name)
+        if (peer is not None):
+            result = self._PeerProxy(peer).CleanFromQueue(handle)
+            self._lock.acquire()
+            try:
+                self._moved.pop(name, None)
+            finally:
+                self._lock.release()
+            return result
+        self._lock.acquire()
+        try:
+            task = self._queue[name]
+            if (task.started.isSet() and not task.finished.isSet()):
+                raise Exception('''
             Tried to clean up started but unfinished task %s!
             Use RemoveFromQueue if you want to remove unfinished task.
             ''' % str(name))
-        name = task.clientTask.Name()
+            self._queue.PopItem(name)
+            if (name in self._pending):
+                self._RemovePending(name)
+        finally:
+            self._lock.release()
+        self._results.Remove(name)
         
         self.UpdateActives()
 
@@ -215,17 +822,192 @@ class BasicRPCServer(PicklingXMLRPC.PicklingXMLRPCServer,
         """
         Return the estimated wait time (in seconds) for a task
         with the input priority if it's submitted to this server.
+        Run times are weighted by the number of slots each task uses.
+
+        Work for queued tasks comes from self._pendingWork which is
+        updated as tasks are queued, started, and cleaned. We only look
+        at running tasks individually and there are at most self._cpus
+        of those. See EstWaitFromLoad for how we combine them.
         """
+        self._lock.acquire()
+        try:
+            activeItems = self._queue.ShowItems('running')
+            queuedWork = self._pendingWork.SumAtLeast(priority)
+        finally:
+            self._lock.release()
+        return self.EstWaitFromLoad(self._RemainingWork(activeItems),
+                                    queuedWork, self._cpus)
+
+    @staticmethod
+    def EstWaitFromLoad(running, queuedWork, cpus):
+        """Estimate how long a new task would wait to start on a server.
+        
+        INPUTS:
+        
+        -- running:     List of (remainingWork, slots) pairs for running
+                        tasks as in the result of LoadSummary.
+        
+        -- queuedWork:  Total work (estimated run time times slots) of
+                        queued tasks which would start before the new one.
+        
+        -- cpus:        Number of task slots on the server.
+        
+        -------------------------------------------------------
+        
+        RETURNS:        Estimated wait in seconds.
+        
+        -------------------------------------------------------
+        
+        PURPOSE:        Each slot becomes free when the task running in
+                        it finishes. We treat queued work as if it could
+                        be split over slots as they become free, so the
+                        wait is the time w at which the slot time free
+                        before w, sum(max(0, w - free)), equals
+                        queuedWork. Unlike dividing all work by cpus,
+                        this gives no wait if a slot is free and nothing
+                        is queued however long the running tasks are.
+        
+        """
+        freeTimes = []
+        for (remainingWork, slots) in running:
+            freeTimes.extend([remainingWork / float(slots)] * slots)
+        freeTimes.extend([0] * max(0, cpus - len(freeTimes)))
+        freeTimes.sort()
+        if (not freeTimes or queuedWork <= 0):
+            return freeTimes[0] if freeTimes else queuedWork
+        filled = 0
+        for i in range(len(freeTimes)):
+            if (i + 1 < len(freeTimes)):
+                room = (freeTimes[i+1] - freeTimes[i]) * (i + 1)
+                if (filled + room < queuedWork):
+                    filled += room
+                    continue
+            return freeTimes[i] + (queuedWork - filled) / float(i + 1)
+
+    def _RemainingWork(self, activeItems):
+        "Return list of (remainingWork, slots) for running (name, task) pairs."
+
         now = datetime.datetime.now()
-        runtime = lambda task: task.clientTask.EstRunTime()
-        higherPriority = lambda task: task.clientTask.Priority() >= priority
-        estWaitTime = sum([
-            max(0, runtime(task) - (now - task.starttime).seconds)
-            for _name, task in self._active.ShowItems()])
-        estWaitTime += sum([
-            runtime(task) for _name, task in self._queue.ShowItems()
-            if higherPriority(task) and not task.started.isSet()])
-        return estWaitTime / self._cpus
+        result = []
+        for (_name, task) in activeItems:
+            slots = self._Slots(task)
+            estWork = task.clientTask.EstRunTime()*slots
+            result.append((max(estWork*self.overrunFraction, estWork - slots*(
+                now - task.starttime).seconds), slots))
+        return result
+
+    def LoadSummary(self):
+        """Return a dictionary summarizing the load on this server.
+        
+        -------------------------------------------------------
+        
+        RETURNS:        Dictionary with the following keys:
+        
+           'host', 'port' : Where this server is listening.
+           'cpus'         : Number of task slots.
+           'freeSlots'    : Number of slots not used by running tasks.
+           'queuedWork'   : List of (priority, work) pairs giving the total
+                            work (estimated run time times slots) of
+                            queued tasks at each priority.
+           'running'      : List of (remainingWork, slots) pairs for
+                            running tasks.
+           'time'         : Value of time.time() on the server.
+        
+        -------------------------------------------------------
+        
+        PURPOSE:        These are the inputs to EstWaitTime so a scheduler
+                        holding a recent summary can estimate the wait for
+                        any priority without asking us.
+        
+        """
+        self._lock.acquire()
+        try:
+            activeItems = self._queue.ShowItems('running')
+            queuedWork = self._pendingWork.Items()
+        finally:
+            self._lock.release()
+        running = self._RemainingWork(activeItems)
+        return {'host' : self._host, 'port' : self._port, 'cpus' : self._cpus,
+                'freeSlots' : self._cpus - sum([s for (_r, s) in running]),
+                'queuedWork' : queuedWork, 'running' : running,
+                'time' : time.time()}
+
+    def SubscribeLoad(self, host, port, tag=None, ttl=300):
+        """Ask to be sent load summaries over UDP.
+        
+        INPUTS:
+        
+        -- host, port:   Address of UDP socket to send summaries to.
+                         Over RPC, summaries always go to port on the
+                         address the request came from so nobody can
+                         make us send datagrams to someone else; host is
+                         only used if we are called directly.
+        
+        -- tag=None:     Anything JSON can encode to put in each summary
+                         under the key 'tag' (e.g., the (host, port) name
+                         the subscriber uses for this server).
+        
+        -- ttl=300:      Seconds until subscription expires. Subscribers
+                         should subscribe again before then.
+        
+        -------------------------------------------------------
+        
+        RETURNS:        The current LoadSummary() with 'tag' added.
+        
+        -------------------------------------------------------
+        
+        PURPOSE:        Once subscribed, the result of LoadSummary encoded
+                        as JSON is sent whenever tasks are queued, start, finish,
+                        or are cleaned (at most once per gossipMinInterval)
+                        and at least once every gossipHeartbeat seconds.
+        
+        """
+        caller = self._CallerAddress()
+        if (caller is not None):
+            host = caller[0]
+        json.dumps(tag) # make sure we will be able to send it
+        self._lock.acquire()
+        try:
+            self._subscribers[(host, int(port))] = (tag, time.time() + ttl)
+            if (self._gossipThread is None):
+                self._gossipThread = threading.Thread(
+                    target=self._GossipLoop, name='Gossip')
+                self._gossipThread.setDaemon(True)
+                self._gossipThread.start()
+        finally:
+            self._lock.release()
+        summary = self.LoadSummary()
+        summary['tag'] = tag
+        return summary
+
+    def _GossipLoop(self):
+        "Send load summaries to subscribers on changes and on heartbeats."
+
+        gossipSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            while (not self._quit):
+                self._loadChanged.wait(self.gossipHeartbeat)
+                self._loadChanged.clear()
+                now = time.time()
+                self._lock.acquire()
+                try:
+                    for (address, (_tag, expiry)) in self._subscribers.items():
+                        if (expiry < now):
+                            del self._subscribers[address]
+                    subscribers = self._subscribers.items()
+                finally:
+                    self._lock.release()
+                summary = self.LoadSummary()
+                for (address, (tag, _expiry)) in subscribers:
+                    summary['tag'] = tag
+                    try:
+                        gossipSocket.sendto(json.dumps(summary), address)
+                    except socket.error, e:
+                        logging.debug('Unable to send load to %s:%s: %s' % (
+                            address[0], address[1], str(e)))
+                time.sleep(self.gossipMinInterval) # let changes pile up
+        finally:
+            gossipSocket.close()
 
     def ShowQueue(self,regexp='.*',timeout=0):
         """Show all tasks in the queue.
@@ -234,8 +1016,10 @@ class BasicRPCServer(PicklingXMLRPC.PicklingXMLRPCServer,
         
         -- regexp='.*':    Regular expression for names of tasks to show.
         
-        -- timeout=60:     Timeout in seconds to allow when checking
-                           status of task.
+        -- timeout=0:      Ignored. It is kept so older clients can still
+                           pass it, but we never wait for tasks to finish
+                           (see Status) since waiting for each task in
+                           turn could take len(queue)*timeout seconds.
         
         -------------------------------------------------------
         
@@ -247,14 +1031,19 @@ class BasicRPCServer(PicklingXMLRPC.PicklingXMLRPCServer,
         PURPOSE:        Useful to see what the server is doing.
         
         """
+        _ignore = timeout
         compiledRegexp = re.compile(regexp) if isinstance(
             regexp,(str,unicode)) else regexp
         result = []
-        for n, _t in sorted(self._queue.ShowItems(),key=lambda pair: pair[0]):
+        self._lock.acquire()
+        try:
+            queueItems = self._queue.ShowItems()
+        finally:
+            self._lock.release()
+        for n, _t in sorted(queueItems,key=lambda pair: pair[0]):
             if (compiledRegexp.search(n)):
-                logging.debug('Contacting %s to get queue (timeout=%s' % (
-                    n, timeout))
-                result.append(self.Status(n,timeout=timeout))
+                logging.debug('Contacting %s to get queue' % n)
+                result.append(self.Status(n,timeout=0))
             else:
                 logging.debug('Skipping %s since regexp does not match' % n)
 
@@ -281,66 +1070,230 @@ class BasicRPCServer(PicklingXMLRPC.PicklingXMLRPCServer,
         
         """
         now = datetime.datetime.now()
-        tasksToClean = [(name, task) for (name, task) in self._queue.ShowItems()
-                        if (task.finished.isSet() and (
-            (now - task.endtime ) > datetime.timedelta(seconds=allowedLag)))]
-        for (name, task) in tasksToClean:
-            logging.info('Cleaning finished task %s:\n%s\n' % (name, task))
-            self._queue.PopItem(name)
+        self._lock.acquire()
+        try:
+            self._MarkFinishedTasks()
+            tasksToClean = [
+                (name, task) for (name, task) in self._queue.ShowItems(
+                    'finished') if (task.finished.isSet() and (
+                (now - task.endtime) > datetime.timedelta(seconds=allowedLag)))]
+            for (name, task) in tasksToClean:
+                logging.info('Cleaning finished task %s:\n%s\n' % (name,task))
+                self._queue.PopItem(name)
+                self._results.Remove(name)
+            for (name, (_host, _port, movedAt)) in self._moved.items():
+                if (time.time() - movedAt > allowedLag):
+                    del self._moved[name]
+        finally:
+            self._lock.release()
 
         self.UpdateActives()
         
         return [name for (name, _task) in tasksToClean]
     
-    @staticmethod
-    def _NextTask(pendingItems):
-        """
-        return the earliest task with the highest priority in the pendingItems,
-        which is implicitely sorted by submission time.
+    def SetPriority(self, handle, priority):
+        """Change the priority of a task.
+        
+        INPUTS:
+        
+        -- handle:        Either a string name or a TaskHandle object.
+        
+        -- priority:      New priority for the task.
+        
+        -------------------------------------------------------
+        
+        PURPOSE:        Change the priority of a task. This only affects
+                        when the task starts so it is only useful for
+                        tasks which are still queued.
+        
         """
-        maxPriority = None
-        nextTask = None
-        for name, task in pendingItems:
-            priority = task.clientTask.Priority()
-            if maxPriority is None or maxPriority < priority:
-                maxPriority = priority
-                nextTask = (name, task)
-        return nextTask
+        name = handle if isinstance(handle, (str, unicode)) else handle.Name()
+        peer = self._MovedTo(name)
+        if (peer is not None):
+            return self._PeerProxy(peer).SetPriority(name, priority)
+        self._lock.acquire()
+        try:
+            task = self._queue[name]
+            task.clientTask.priority = priority
+            if (name in self._pending):
+                self._pending.ChangePriority(name, priority)
+                oldPriority, work = self._pendingWorkOf[name]
+                self._pendingWork.Remove(oldPriority, work)
+                self._pendingWork.Add(priority, work)
+                self._pendingWorkOf[name] = (priority, work)
+        finally:
+            self._lock.release()
+        self._loadChanged.set()
 
     def UpdateActives(self):
         """Updates which tasks are active and spawns new tasks if necessary.
+
+        Since requests are handled concurrently, many threads may call
+        this at once. Rather than blocking, a caller which cannot get
+        self._uaSemaphore sets self._uaPending and returns; whichever
+        thread holds the semaphore sees the flag and updates again.
+        This matters since finishing tasks call this from their own
+        thread and a task is not done until its callbacks return.
         """
 
-        try:
+        self._uaPending = True
+        while (self._uaPending):
             logging.info('trying to aquire self._uaSempahore w/o blocking')
             if (not self._uaSemaphore.acquire(blocking=False)):
-                logging.warning('Blocking to aquire self._uaSempahore')
-                self._uaSemaphore.acquire(blocking=True)
-            # First remove any finished or dead items form self._active
-            activeItems = self._active.ShowItems()
-            for (name, item) in activeItems:
-                if (item.finished.isSet() or not item.isAlive()): 
-                    self._active.PopItem(name)
-
-            # Now try to start any pending items if necessary
-            activeItems = self._active.ShowItems()
-            while (len(activeItems) < self._cpus):
-                pendingItems = [
-                    (name, task) for (name, task) in self._queue.ShowItems()
-                    if not task.started.isSet()]
-                if (len(pendingItems) == 0):
-                    break # nothing left to start
-                else:
-                    name, task = self._NextTask(pendingItems)
-                    logging.debug('Starting task %s: %s' % (name, task))
-                    task.callbacks.append(UpdateActivesCallback(self))
-                    task.start()
-                    self._active.Push(name, task)
-                    activeItems = self._active.ShowItems()
+                logging.debug('Holder of self._uaSempahore will update')
+                return
+            try:
+                self._uaPending = False
+                self._lock.acquire()
+                try:
+                    self._StartPendingTasks()
+                    self._changed.notifyAll()
+                finally:
+                    self._lock.release()
+                self._loadChanged.set()
+                self._stealWake.set()
+                self._SaveRunTimes()
+            finally:
+                logging.debug('Releaseing self._uaSempahore')
+                self._uaSemaphore.release()
+
+    def _Slots(self, task):
+        """Return number of slots the given ServerSideTask uses.
+
+        A task asking for more slots than the server has gets all of
+        them so that it can still run eventually.
+        """
+        getSlots = getattr(task.clientTask, 'Slots', None)
+        slots = getSlots() if getSlots is not None else 1
+        return max(1, min(self._cpus, int(slots)))
+
+    def _AddPending(self, name, task):
+        "Add task to self._pending and its work to self._pendingWork."
+
+        priority = task.clientTask.Priority()
+        work = task.clientTask.EstRunTime()*self._Slots(task)
+        self._pending.Push(name, task, priority)
+        self._pendingWork.Add(priority, work)
+        self._pendingWorkOf[name] = (priority, work)
+
+    def _RemovePending(self, name):
+        "Remove task from self._pending and its work from self._pendingWork."
+
+        task = self._pending.Remove(name)
+        self._pendingWork.Remove(*self._pendingWorkOf.pop(name))
+        return task
+
+    def _MarkFinishedTasks(self):
+        "Move running tasks which are finished or dead to 'finished' state."
+
+        for (name, task) in self._queue.ShowItems('running'):
+            if (task.finished.isSet() or not task.isAlive()):
+                self._queue.SetState(name, 'finished')
+                self._RecordRunTime(task)
+
+    def _RecordRunTime(self, task):
+        "Add run time of finished ServerSideTask to self._runTimes."
+
+        if (None in (task.starttime, task.endtime) or isinstance(
+            task.clientTask.result, Exception)
+            or getattr(task, 'stopped', False)):
+            return # only learn from tasks which ran and succeeded
+        family = getattr(task.clientTask, 'Family', None)
+        if (family is None):
+            return # task from old client
+        runTime = task.endtime - task.starttime
+        self._runTimes.Record(family(), runTime.days*86400 + runTime.seconds
+                              + runTime.microseconds/1e6)
+        self._runTimesDirty = True
+
+    def _UseLearnedRunTime(self, task):
+        "Replace default estRunTime of task with learned one if we have it."
+
+        if (getattr(task, 'estRunTimeIsDefault', False)):
+            estimate = self._runTimes.Estimate(
+                task.Family(), self.learnedStddevs)
+            if (estimate is not None):
+                task.estRunTime = estimate
+
+    def _SaveRunTimes(self, force=False):
+        """Save run time history if it changed and it is time to save.
+
+        If force is True, save even if self.runTimeSaveInterval seconds
+        have not passed since the last save.
+        """
+        if (self._runTimeFile is None or not self._runTimesDirty or (
+            not force and time.time() - self._runTimesSaved <
+            self.runTimeSaveInterval)):
+            return
+        self._lock.acquire()
+        try:
+            self._runTimesDirty = False
+            self._runTimesSaved = time.time()
+            try:
+                self._runTimes.Save(self._runTimeFile)
+            except Exception, e:
+                logging.error('Unable to save run times to %s: %s' % (
+                    self._runTimeFile, str(e)))
         finally:
-            logging.debug('Releaseing self._uaSempahore')
-            self._uaSemaphore.release()
-            
+            self._lock.release()
+
+    def LearnedRunTimes(self):
+        """Return what we have learned about how long tasks take to run.
+        
+        -------------------------------------------------------
+        
+        RETURNS:        Dictionary mapping task family (see the Family
+                        method of Tasks.BasicTask) to (count, mean,
+                        stddev) where count is the number of finished
+                        tasks in the family we have seen and mean and
+                        stddev are exponentially weighted statistics of
+                        their run times in seconds.
+        
+        -------------------------------------------------------
+        
+        PURPOSE:        Tasks submitted without an estRunTime get the
+                        mean plus self.learnedStddevs times the stddev
+                        for their family (if known) as estRunTime
+                        instead of the 8 hour default. This makes
+                        EstWaitTime useful even when clients do not know
+                        how long their tasks take.
+        
+        """
+        self._lock.acquire()
+        try:
+            return self._runTimes.Stats()
+        finally:
+            self._lock.release()
+
+    def _StartPendingTasks(self):
+        """Helper for UpdateActives to start tasks while holding locks.
+
+        Tasks are started in priority order as long as the next task
+        fits in the free slots. If the next task needs more slots than
+        are free, we wait for running tasks to finish rather than start
+        lower priority tasks ahead of it.
+        """
+        # First mark any finished or dead running items as finished
+        self._MarkFinishedTasks()
+
+        # Now try to start any pending items if necessary
+        freeSlots = self._cpus - sum([self._Slots(task) for (_name, task)
+                                      in self._queue.IterItems('running')])
+        while (freeSlots > 0):
+            nextTask = self._pending.Peek()
+            if (nextTask is None):
+                break # nothing left to start
+            name, task = nextTask
+            if (self._Slots(task) > freeSlots):
+                logging.debug('Task %s needs %i slots but %i are free' % (
+                    name, self._Slots(task), freeSlots))
+                break
+            logging.debug('Starting task %s: %s' % (name, task))
+            self._RemovePending(name)
+            task.callbacks.append(UpdateActivesCallback(self))
+            task.start()
+            self._queue.SetState(name, 'running')
+            freeSlots -= self._Slots(task)
 
     def Status(self,handle,timeout=0):
         """
@@ -349,10 +1302,11 @@ class BasicRPCServer(PicklingXMLRPC.PicklingXMLRPCServer,
         
 	-- handle:	Either a string name or a TaskHandle object.
         
-	-- timeout=None:	Optional integer timeout to say how many
+	-- timeout=0:	Optional integer timeout to say how many
                                 seconds to wait for task to complete if it
-                                is still running. A timeout of None means
-                                wait until the task is done.
+                                is not finished. A timeout of None means
+                                wait until the task is done while 0 means
+                                return right away.
         
 	-------------------------------------------------------
         
@@ -361,33 +1315,1140 @@ class BasicRPCServer(PicklingXMLRPC.PicklingXMLRPCServer,
         
 	-------------------------------------------------------
         
-	PURPOSE:        Get the status of a remote task.
+	PURPOSE:        Get the status of a remote task. If we gave the
+                        task to a peer (see SetPeers), we ask the peer
+                        so the handle returned has the peer's host and
+                        port. If too many requests are already waiting
+                        (see WorkerPoolMixIn), we return right away
+                        as though timeout were 0.
         
         """
-        _ignore = timeout
-        
         name = handle if isinstance(handle, (str, unicode)) else handle.Name()
-        task = self._queue[name]
+        self._lock.acquire()
+        try:
+            if (name not in self._queue and name in self._moved):
+                peer = self._moved[name][0:2]
+            else:
+                task, peer = self._queue[name], None
+        finally:
+            self._lock.release()
+        waiting = False
+        if (timeout is None or timeout > 0):
+            if (peer is not None or not task.finished.isSet()):
+                waiting = self.StartWaiting()
+        try:
+            if (peer is not None):
+                return self._PeerProxy(peer, timeout).Status(
+                    name, timeout if waiting else 0)
+            if (waiting):
+                task.finished.wait(timeout)
+        finally:
+            if (waiting):
+                self.DoneWaiting()
         handle = task.GetHandle()
 
         return handle
 
-    @staticmethod
-    def CountNumCPUs():
-        """Determine number of cpus on this machine and return it.
+    def FetchResult(self, handle):
+        """Return the result of a task.
+        
+        INPUTS:
+        
+        -- handle:        Either a string name or a TaskHandle object.
+        
+        -------------------------------------------------------
+        
+        RETURNS:        Result of the task (None if it has not finished).
+        
+        -------------------------------------------------------
+        
+        PURPOSE:        Handles leave out results of at least
+                        self.lazyResultBytes. TaskHandle uses this to
+                        fetch such a result when it is needed.
+        
+        """
+        name = handle if isinstance(handle, (str, unicode)) else handle.Name()
+        peer = self._MovedTo(name)
+        if (peer is not None):
+            return self._PeerProxy(peer).FetchResult(name)
+        self._lock.acquire()
+        try:
+            task = self._queue[name]
+        finally:
+            self._lock.release()
+        return task.Result()
+
+    def FetchResultChunk(self, handle, offset, length):
+        """Return part of a large result of a task which was spilled to disk.
+        
+        INPUTS:
+        
+        -- handle:        Either a string name or a TaskHandle object.
+        
+        -- offset:        Offset of first byte to get.
+        
+        -- length:        Maximum number of bytes to get (we send at most
+                          self.resultChunkBytes).
+        
+        -------------------------------------------------------
+        
+        RETURNS:        Tuple (data, isString, size) as for
+                        DataStructures.ResultStore.Read or None if the
+                        result is not in a file (use FetchResult then).
+        
+        -------------------------------------------------------
+        
+        PURPOSE:        TaskHandle uses this to fetch a spilled result a
+                        piece at a time so we never hold all of it in
+                        memory.
+        
+        """
+        name = handle if isinstance(handle, (str, unicode)) else handle.Name()
+        peer = self._MovedTo(name)
+        if (peer is not None):
+            return self._PeerProxy(peer).FetchResultChunk(name, offset, length)
+        self._lock.acquire()
+        try:
+            task = self._queue[name]
+        finally:
+            self._lock.release()
+        return task.ReadResult(offset, min(length, self.resultChunkBytes))
+
+    def ResultInfo(self):
+        "Return dictionary with numbers and sizes of large results we hold."
+        return self._results.Info()
+
+    def WaitForAny(self, names, timeout=0):
+        """Wait until at least one of the named tasks finishes.
+        
+        INPUTS:
+        
+        -- names:        List of string names of tasks to wait for.
+        
+        -- timeout=0:    Maximum seconds to wait. A timeout of None means
+                         wait until some task finishes.
+        
+        -------------------------------------------------------
+        
+        RETURNS:        List of TaskInfo.TaskHandle objects for the named
+                        tasks which are finished or which we gave to a
+                        peer (see SetPeers). The handles for the latter
+                        have the peer's host and port. This is empty if
+                        no named task finished before the timeout or if
+                        too many requests are already waiting (see
+                        WorkerPoolMixIn).
+        
+        -------------------------------------------------------
+        
+        PURPOSE:        Lets a client wait on many tasks with one request
+                        and hear about a finished task as soon as the
+                        server notices instead of polling Status.
+        
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        waiting = False
+        self._lock.acquire()
+        try:
+            while True:
+                moved = [name for name in names if (
+                    name not in self._queue and name in self._moved)]
+                tasks = [self._queue[name] for name in names
+                         if name not in moved]
+                finished = [task for task in tasks if task.finished.isSet()]
+                if (finished or moved):
+                    break
+                if (not waiting):
+                    waiting = self.StartWaiting()
+                    if (not waiting):
+                        break
+                if (deadline is None):
+                    self._changed.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if (remaining <= 0):
+                        break
+                    self._changed.wait(remaining)
+        finally:
+            self._lock.release()
+            if (waiting):
+                self.DoneWaiting()
+
+        return [task.GetHandle() for task in finished] + [
+            self.Status(name) for name in moved]
+
+    def SetPeers(self, peers):
+        """Turn on peer mode and set which servers are our peers.
+        
+        INPUTS:
+        
+        -- peers:        List of (host, port) pairs for other servers.
+        
+        -------------------------------------------------------
+        
+        PURPOSE:        In peer mode, whenever we have free slots and no
+                        queued tasks we ask peers to give us some of the
+                        tasks they have queued (see GiveTasks). We also
+                        give queued tasks to peers which ask. Tasks are
+                        taken from the end of the queue (lowest priority
+                        and latest submitted) since those would wait the
+                        longest. The server which gave a task away keeps
+                        forwarding requests about it (e.g., Status) to
+                        the server which took it so handles keep working.
+                        A task only moves once both servers agree (see
+                        GiveTasks and _StealOnce) so failed calls or
+                        peers never lose a task or run it twice.
+        
+        """
+        self._peers = [tuple(p) for p in peers]
+        self._StartStealing()
+
+    def GiveTasks(self, maxTasks, host, port):
+        """Give up to half of our queued tasks to peer at host, port.
+        
+        INPUTS:
+        
+        -- maxTasks:     Maximum number of tasks to give.
+        
+        -- host, port:   Address of the peer asking.
+        
+        -------------------------------------------------------
+        
+        RETURNS:        List of (task, emailList, callbacks) tuples for
+                        tasks taken from the end of our queue. These are
+                        not queued here any more but we keep them until
+                        the peer calls ConfirmGiven or ReturnGiven. If
+                        neither happens within self.moveLease seconds,
+                        we queue them here again and refuse to confirm.
+        
+        -------------------------------------------------------
+        
+        PURPOSE:        First half of moving tasks to a peer; see SetPeers.
+        
+        """
+        given = []
+        self._ExpireMoving()
+        self._lock.acquire()
+        try:
+            if (self._peers is None):
+                return [] # not in peer mode
+            count = min(maxTasks, (len(self._pending) + 1) / 2)
+            expiry = time.time() + self.moveLease
+            for (name, task) in self._pending.Tail(count):
+                self._RemovePending(name)
+                self._queue.SetState(name, 'moving')
+                self._moving[name] = (host, port, expiry)
+                given.append((task.clientTask, task.emailList, [
+                    c for c in task.callbacks if isinstance(
+                        c, Tasks.BasicCallback) and not isinstance(
+                        c, UpdateActivesCallback)]))
+        finally:
+            self._lock.release()
+        if (given):
+            logging.info('Giving %i tasks to %s:%s' % (len(given), host, port))
+            self._loadChanged.set()
+        return given
+
+    def ConfirmGiven(self, names, host, port):
+        """Note that the named tasks we gave are now queued at host, port.
+
+        Returns the list of names the peer may run. These are the tasks
+        we gave to host, port whose lease has not expired, plus any we
+        already confirmed for it (so the peer can safely call again if
+        it did not get our answer). The peer must drop the others since
+        we queued them here again.
+        """
+        confirmed = []
+        now = time.time()
+        self._lock.acquire()
+        try:
+            for name in names:
+                if (name in self._queue and
+                    self._queue.State(name) == 'moving'):
+                    peerHost, peerPort, expiry = self._moving.get(
+                        name, (None, None, 0))
+                    if ((peerHost, peerPort) == (host, port) and now <= expiry):
+                        self._queue.PopItem(name)
+                        del self._moving[name]
+                        self._moved[name] = (host, port, now)
+                        confirmed.append(name)
+                elif (name not in self._queue and
+                      self._moved.get(name, (None, None))[0:2] == (host, port)):
+                    confirmed.append(name)
+            self._changed.notifyAll()
+        finally:
+            self._lock.release()
+        return confirmed
+
+    def ReturnGiven(self, names):
+        """Queue the named tasks we gave to a peer here again.
+        """
+        self._lock.acquire()
+        try:
+            for name in names:
+                if (name in self._queue and
+                    self._queue.State(name) == 'moving'):
+                    self._Requeue(name)
+        finally:
+            self._lock.release()
+        self.UpdateActives()
+
+    def _Requeue(self, name):
+        "Queue named task in state 'moving' here again (with self._lock held)."
+
+        del self._moving[name]
+        self._queue.SetState(name, 'queued')
+        self._AddPending(name, self._queue[name])
+
+    def _ExpireMoving(self):
+        "Queue tasks here again if the peer we gave them to did not confirm."
+
+        now = time.time()
+        self._lock.acquire()
+        try:
+            expired = [name for (name, (_host, _port, expiry)) in (
+                self._moving.items()) if expiry < now]
+            for name in expired:
+                if (name not in self._queue or
+                    self._queue.State(name) != 'moving'):
+                    del self._moving[name] # removed while moving
+                    continue
+                peer = self._moving[name][0:2]
+                logging.warning('Queueing %s again since %s:%s did not take it'
+                                % ((name,) + peer))
+                self._Requeue(name)
+        finally:
+            self._lock.release()
+        if (expired):
+            self.UpdateActives()
+
+    def _MovedTo(self, name):
+        "Return (host, port) of peer we gave named task to or None."
+
+        self._lock.acquire()
+        try:
+            if (name not in self._queue and name in self._moved):
+                return self._moved[name][0:2]
+            return None
+        finally:
+            self._lock.release()
+
+    def _PeerProxy(self, peer, timeout=0):
+        """Return proxy for peer allowing timeout seconds more than usual.
+
+        A timeout of None means wait forever.
+        """
+        return PicklingXMLRPC.PicklingServerProxy(
+            'http://%s:%i' % tuple(peer), timeout=None if timeout is None
+            else self.peerTimeout + timeout)
+
+    def _StartStealing(self):
+        "Start thread to take tasks from peers if not already started."
+
+        self._lock.acquire()
+        try:
+            if (self._stealThread is None):
+                self._stealThread = threading.Thread(
+                    target=self._StealLoop, name='Stealing')
+                self._stealThread.setDaemon(True)
+                self._stealThread.start()
+        finally:
+            self._lock.release()
+
+    def _StealLoop(self):
+        "Take tasks from peers when we have nothing to do until we quit."
+
+        while (not self._quit):
+            self._stealWake.wait(self.stealInterval)
+            self._stealWake.clear()
+            if (self._quit):
+                break
+            try:
+                self._ExpireMoving()
+                for peer in self._held.keys():
+                    self._ConfirmHeld(peer)
+                while (self._StealOnce()):
+                    pass
+            except Exception, e:
+                logging.warning('Error while taking tasks from peers: %s' % e)
+
+    def _StealOnce(self):
+        """Ask peers for tasks if we have free slots and nothing queued.
+
+        Returns number of tasks we took.
+
+        Tasks we get from GiveTasks are held (queued but not allowed to
+        start) until the peer answers ConfirmGiven so a task never runs
+        both here and at the peer. If we cannot reach the peer to
+        confirm, the tasks stay held and _StealLoop asks again later;
+        we do not take more tasks until then.
+        """
+        self._lock.acquire()
+        try:
+            freeSlots = self._cpus - sum([self._Slots(task) for (_name, task)
+                                          in self._queue.IterItems('running')])
+            if (freeSlots <= 0 or len(self._pending) or self._held):
+                return 0
+        finally:
+            self._lock.release()
+        peers = list(self._peers or [])
+        random.shuffle(peers)
+        for peer in peers:
+            proxy = self._PeerProxy(peer)
+            try:
+                given = proxy.GiveTasks(freeSlots, self._host, self._port)
+            except Exception, e:
+                logging.debug('Unable to get tasks from %s:%s: %s' % (
+                    peer[0], peer[1], str(e)))
+                continue
+            if (not given):
+                continue
+            names = [task.Name() for (task, _emailList, _callbacks) in given]
+            try:
+                self._QueueTasks([Tasks.ServerSideTask(
+                    task, self._host, self._port, emailList, callbacks)
+                                  for (task, emailList, callbacks) in given],
+                                 'held')
+            except Exception, e:
+                logging.warning('Returning tasks to %s:%s since %s' % (
+                    peer[0], peer[1], str(e)))
+                proxy.ReturnGiven(names) # else they return when lease ends
+                continue
+            self._lock.acquire()
+            try:
+                self._held[peer] = names
+            finally:
+                self._lock.release()
+            return self._ConfirmHeld(peer)
+        return 0
+
+    def _ConfirmHeld(self, peer):
+        """Ask peer to confirm giving us the tasks we hold from it.
+
+        Tasks the peer confirms are released so they can start and the
+        rest are dropped. If the peer cannot be reached, we keep holding
+        the tasks and return 0. Otherwise we return the number of tasks
+        released.
+        """
+        names = self._held.get(peer, [])
+        try:
+            confirmed = self._PeerProxy(peer).ConfirmGiven(
+                names, self._host, self._port)
+        except Exception, e:
+            logging.warning('Unable to confirm taking %i tasks from %s:%s: %s'
+                            % (len(names), peer[0], peer[1], str(e)))
+            return 0
+        if (confirmed is None):
+            confirmed = names # old peer which does not say
+        confirmed = set(confirmed)
+        released, dropped = 0, 0
+        self._lock.acquire()
+        try:
+            del self._held[peer]
+            for name in names:
+                if (name not in self._queue or
+                    self._queue.State(name) != 'held'):
+                    continue
+                if (name in confirmed):
+                    self._queue.SetState(name, 'queued')
+                    self._AddPending(name, self._queue[name])
+                    released += 1
+                else:
+                    self._queue.PopItem(name)
+                    dropped += 1
+        finally:
+            self._lock.release()
+        if (dropped):
+            logging.warning('Dropped %i tasks %s:%s gave us too late' % (
+                dropped, peer[0], peer[1]))
+        logging.info('Took %i tasks from %s:%s' % (released, peer[0], peer[1]))
+        self.UpdateActives()
+        return released
+
+    def NumCPUs(self):
+        "Return number of task slots (CPUs) this server runs tasks on."
+        return self._cpus
+
+    @classmethod
+    def CountNumCPUs(cls):
+        """Determine number of cpus usable on this machine and return it.
+
+        We take the smallest of the number of online CPUs, the number of
+        CPUs in our process affinity mask, and the CPU quota for our
+        cgroup (on LINUX). Any of those we cannot determine are ignored.
+        If we cannot determine any of them, we say 1 cpu.
         """
 
+        counts = [c for c in [cls._CountOnlineCPUs(),
+                              cls._CountAffinityCPUs(),
+                              cls._CountCgroupCPUs()] if c]
+        if (counts): return min(counts)
+        else: return 1 # couldn't figure it out so just say 1 cpu
+
+    @staticmethod
+    def _CountOnlineCPUs():
+        "Return number of online cpus or None if we cannot tell."
+
         cpus = os.environ.get("NUMBER_OF_PROCESSORS",None)
         if (None != cpus): return int(cpus)
-        elif (hasattr(os, 'sysconf')): # Check if system supports sysconf
-            cpus = getattr(os, 'sysconf_names').get("SC_NPROCESSORS_ONLN")
-            if (isinstance(cpus, int) and cpus > 0): return cpus
-        else: # Maybe the machine is a Mac...
+        if ('SC_NPROCESSORS_ONLN' in getattr(os, 'sysconf_names', {})):
             try:
-                cpus = int(os.popen2("sysctl -n hw.ncpu")[1].read())
-                return int(cpus)
-            except Exception, _e:
-                return 1 # couldn't figure it out so just say 1 cpu
+                cpus = os.sysconf('SC_NPROCESSORS_ONLN')
+                if (isinstance(cpus, (int, long)) and cpus > 0): return cpus
+            except (OSError, ValueError), e:
+                logging.debug('Unable to use sysconf: %s' % str(e))
+        try: # Maybe the machine is a Mac...
+            cpus = int(os.popen("sysctl -n hw.ncpu 2>/dev/null").read())
+            if (cpus > 0): return cpus
+        except Exception, _e:
+            pass
+        return None
+
+    @staticmethod
+    def _CountAffinityCPUs(statusFile='/proc/self/status'):
+        "Return number of cpus in our affinity mask or None if unknown."
+
+        if (hasattr(os, 'sched_getaffinity')):
+            return len(getattr(os, 'sched_getaffinity')(0)) or None
+        try:
+            lines = open(statusFile).read().splitlines()
+        except (IOError, OSError):
+            return None
+        for line in lines:
+            if (line.startswith('Cpus_allowed_list:')):
+                return _CountCPUList(line.split(':', 1)[1]) or None
+        return None
+
+    @staticmethod
+    def _CountCgroupCPUs(cgroupRoot='/sys/fs/cgroup',
+                         procCgroup='/proc/self/cgroup'):
+        """Return cpus allowed by cgroup CPU quota or None if no quota.
+
+        We find our own cgroup from procCgroup and check it and every
+        cgroup above it up to cgroupRoot (e.g., a systemd slice holding
+        our service), taking the smallest quota. Both cgroup v2 (cpu.max)
+        and cgroup v1 (cpu.cfs_quota_us and cpu.cfs_period_us) are
+        checked. A fractional quota is rounded up since a task can still
+        use part of a CPU.
+
+>>> import os, shutil, tempfile, Servers
+>>> root = tempfile.mkdtemp()
+>>> def Write(path, *lines):
+...     if (not os.path.isdir(os.path.dirname(path))):
+...         os.makedirs(os.path.dirname(path))
+...     outFile = open(path, 'w')
+...     for line in lines:
+...         print >> outFile, line
+...     outFile.close()
+...
+>>> Write(os.path.join(root, 'self'), '0::/work.slice/job.service')
+>>> Write(os.path.join(root, 'v2', 'work.slice', 'cpu.max'), '250000 100000')
+>>> Write(os.path.join(root, 'v2', 'work.slice', 'job.service', 'cpu.max'),
+...       'max 100000')
+>>> Servers.BasicRPCServer._CountCgroupCPUs(
+...     os.path.join(root, 'v2'), os.path.join(root, 'self'))
+3
+>>> Write(os.path.join(root, 'self'), '4:cpu,cpuacct:/a/b', '1:memory:/c')
+>>> for (path, quota) in [('', -1), ('a', 800000), ('a/b', 150000)]:
+...     for (name, value) in [('quota', quota), ('period', 100000)]:
+...         Write(os.path.join(root, 'v1', 'cpu,cpuacct', path,
+...                            'cpu.cfs_%s_us' % name), str(value))
+...
+>>> Servers.BasicRPCServer._CountCgroupCPUs(
+...     os.path.join(root, 'v1'), os.path.join(root, 'self'))
+2
+>>> print Servers.BasicRPCServer._CountCgroupCPUs(
+...     os.path.join(root, 'none'), os.path.join(root, 'none'))
+None
+>>> shutil.rmtree(root)
+        """
+
+        paths = {} # controller ('' for cgroup v2) -> path of our cgroup
+        try:
+            for line in open(procCgroup).read().splitlines():
+                fields = line.split(':', 2)
+                if (len(fields) == 3):
+                    for controller in fields[1].split(','):
+                        paths[controller] = fields[2]
+        except (IOError, OSError):
+            pass
+        limits = []
+        for directory in _CgroupDirs(cgroupRoot, paths.get('', '/')):
+            try:
+                fields = open(os.path.join(
+                    directory, 'cpu.max')).read().split()
+                if (fields[0] != 'max'):
+                    limits.append((int(fields[0]), int(fields[1])))
+            except (IOError, OSError, IndexError, ValueError):
+                pass
+        for subDir in ['cpu', 'cpu,cpuacct', 'cpuacct,cpu']:
+            base = os.path.join(cgroupRoot, subDir)
+            if (not os.path.isdir(base)):
+                continue
+            for directory in _CgroupDirs(base, paths.get('cpu', '/')):
+                try:
+                    limits.append((int(open(os.path.join(
+                        directory, 'cpu.cfs_quota_us')).read()), int(open(
+                            os.path.join(directory,
+                                         'cpu.cfs_period_us')).read())))
+                except (IOError, OSError, ValueError):
+                    pass
+            break
+        cpus = [int(math.ceil(float(quota) / period))
+                for (quota, period) in limits if quota > 0 and period > 0]
+        if (not cpus):
+            return None
+        return max(1, min(cpus))
+
+    @staticmethod
+    def _regr_test_slots():
+        """Check that tasks are packed against free slots.
+
+>>> import threading, time, Servers, Tasks
+>>> class BlockingTask(Tasks.BasicTask):
+...     release = threading.Event()
+...     def Run(self):
+...         self.release.wait()
+... 
+>>> server = Servers.BasicRPCServer(cpus=3, port=0)
+>>> handles = [server.Submit(BlockingTask(name, slots=slots)) for
+...            (name, slots) in [('a', 2), ('b', 2), ('c', 1)]]
+>>> [name for (name, _task) in server._queue.ShowItems('running')]
+['a']
+>>> BlockingTask.release.set(); time.sleep(1)
+>>> [h.Name() for h in handles if server.Status(h).finished]
+['a', 'b', 'c']
+>>> server.EstWaitTime(0)
+0
+>>> server.server_close()
+        """
+
+    @staticmethod
+    def _regr_test_est_wait_time():
+        """Check that queued work matches a brute force sum over the queue.
+
+>>> import threading, Servers, Tasks
+>>> class BlockingTask(Tasks.BasicTask):
+...     release = threading.Event()
+...     def Run(self):
+...         self.release.wait()
+... 
+>>> def BruteForce(server, priority):
+...     return sum([t.clientTask.EstRunTime()*server._Slots(t) for (_n, t)
+...                 in server._queue.ShowItems('queued')
+...                 if t.clientTask.Priority() >= priority])
+... 
+>>> def Check(server):
+...     return [server._pendingWork.SumAtLeast(p) == BruteForce(server, p)
+...             for p in [-2000, -1000, 0, 3, 5, 10]]
+... 
+>>> server = Servers.BasicRPCServer(cpus=2, port=0)
+>>> handles = [server.Submit(BlockingTask(
+...     'task%i' % i, priority=[-1000, 3, 5][i % 3], estRunTime=10*i,
+...     slots=1 + i % 2)) for i in range(12)]
+>>> Check(server)
+[True, True, True, True, True, True]
+>>> server.SetPriority('task7', 10)
+>>> server.RemoveFromQueue(handles[4])
+0
+>>> Check(server)
+[True, True, True, True, True, True]
+>>> BlockingTask.release.set(); time.sleep(1)
+>>> Check(server), server.EstWaitTime(-2000)
+([True, True, True, True, True, True], 0)
+>>> server.server_close()
+>>> Servers.BasicRPCServer.EstWaitFromLoad([(40, 2)], 0, 4)
+0
+>>> Servers.BasicRPCServer.EstWaitFromLoad([(40, 2)], 10, 4)
+5.0
+>>> Servers.BasicRPCServer.EstWaitFromLoad([(40, 2), (30, 1)], 35, 4)
+25.0
+        """
+
+    @staticmethod
+    def _regr_test_submit_many():
+        """Check that SubmitMany queues all tasks or none of them.
+
+>>> import Servers, Tasks
+>>> server = Servers.BasicRPCServer(cpus=1, port=0)
+>>> server.UpdateActives = lambda: None # keep everything queued
+>>> handles = server.SubmitMany([Tasks.BasicTask('t%i' % i, priority=i,
+...                              estRunTime=5) for i in range(3)])
+>>> [h.Name() for h in handles]
+['t0', 't1', 't2']
+>>> server.SubmitMany([Tasks.BasicTask('t3'), Tasks.BasicTask('t0')])
+Traceback (most recent call last):
+...
+Exception: Can't add item t0 when item with that name is in queue.
+>>> server.SubmitMany([Tasks.BasicTask('t4'), Tasks.BasicTask('t4')])
+Traceback (most recent call last):
+...
+Exception: Task name t4 appears more than once.
+>>> [name for (name, _task) in server._queue.ShowItems()]
+['t0', 't1', 't2']
+>>> server.EstWaitTime(1)
+10.0
+>>> summary = server.LoadSummary()
+>>> summary['queuedWork'], summary['running'], summary['freeSlots']
+([(0, 5), (1, 5), (2, 5)], [], 1)
+>>> server.server_close()
+        """
+
+    @staticmethod
+    def _regr_test_wait():
+        """Check that Status and WaitForAny block until tasks finish.
+
+>>> import threading, time, Servers, Tasks
+>>> class BlockingTask(Tasks.BasicTask):
+...     release = threading.Event()
+...     def Run(self):
+...         self.release.wait()
+... 
+>>> server = Servers.BasicRPCServer(cpus=2, port=0)
+>>> handles = [server.Submit(BlockingTask(n)) for n in ['a', 'b']]
+>>> server.WaitForAny(['a', 'b'], 0.2)
+[]
+>>> server.Status('a', 0.2).finished
+False
+>>> start = time.time() # ShowQueue does not wait for each task
+>>> [h.finished for h in server.ShowQueue('.*', 30)], time.time() - start < 5
+([False, False], True)
+>>> threading.Timer(0.5, BlockingTask.release.set).start()
+>>> start = time.time()
+>>> sorted([h.Name() for h in server.WaitForAny(['a', 'b'], 30)])
+['a', 'b']
+>>> server.Status('b', 30).finished, time.time() - start < 5
+(True, True)
+>>> server.server_close()
+        """
+
+    @staticmethod
+    def _regr_test_waiters():
+        """Check that waiting requests do not tie up the worker pool.
+
+>>> import threading, time, Servers, Tasks, PicklingXMLRPC
+>>> class BlockingTask(Tasks.BasicTask):
+...     release = threading.Event()
+...     def Run(self):
+...         self.release.wait()
+... 
+>>> server = Servers.BasicRPCServer(cpus=1, port=0, logRequests=False)
+>>> server.numWorkers, server.maxWaiters = 2, 3
+>>> server.serve_forever_as_thread(daemon=True); time.sleep(0.2)
+Entering service loop forever or until killed...
+>>> url = 'http://%s:%i' % (server.Host(), server.Port())
+>>> handle = server.Submit(BlockingTask('a'))
+>>> replies = []
+>>> def Wait():
+...     start = time.time()
+...     names = [h.Name() for h in PicklingXMLRPC.PicklingServerProxy(
+...         url).WaitForAny(['a'], 30)]
+...     replies.append((names, time.time() - start < 5))
+... 
+>>> threads = [threading.Thread(target=Wait) for _i in range(4)]
+>>> for t in threads: t.start()
+... 
+>>> time.sleep(1); replies
+[([], True)]
+>>> start = time.time()
+>>> PicklingXMLRPC.PicklingServerProxy(url).EstWaitTime(0) > 0
+True
+>>> time.time() - start < 5, len(server._workers)
+(True, 2)
+>>> BlockingTask.release.set()
+>>> for t in threads: t.join()
+... 
+>>> sorted(replies)
+[([], True), (['a'], True), (['a'], True), (['a'], True)]
+>>> PicklingXMLRPC.PicklingServerProxy(url).Terminate()
+        """
+
+    @staticmethod
+    def _regr_test_keep_alive():
+        """Check that a proxy reuses one connection and the server parks it.
+
+>>> import time, Servers, PicklingXMLRPC
+>>> server = Servers.BasicRPCServer(cpus=1, port=0, logRequests=False)
+>>> server.serve_forever_as_thread(daemon=True); time.sleep(0.2)
+Entering service loop forever or until killed...
+>>> connection = PicklingXMLRPC.PicklingServerProxy(
+...     'http://%s:%i' % (server.Host(), server.Port()))
+>>> socks = set()
+>>> for i in range(5):
+...     connection.EstWaitTime(0) >= 0
+...     socks.add(id(connection._ServerProxy__transport._local.connection[1].sock))
+... 
+True
+True
+True
+True
+True
+>>> len(socks)
+1
+>>> time.sleep(0.2); len(server._parked)
+1
+>>> connection.Terminate()
+        """
+
+    @staticmethod
+    def _regr_test_framed():
+        """Check that framed and XML-RPC clients can share a server.
+
+>>> import time, threading, Servers, PicklingXMLRPC, FramedRPC
+>>> server = Servers.BasicRPCServer(cpus=1, port=0, logRequests=False)
+>>> server.serve_forever_as_thread(daemon=True); time.sleep(0.2)
+Entering service loop forever or until killed...
+>>> framed = FramedRPC.FramedServerProxy(FramedRPC.TCPAddress(
+...     server.Host(), server.Port()))
+>>> connection = PicklingXMLRPC.PicklingServerProxy(
+...     'http://%s:%i' % (server.Host(), server.Port()))
+>>> framed.EstWaitTime(0), connection.EstWaitTime(0), framed.EstWaitTime(0)
+(0, 0, 0)
+>>> framed._fallback is None, len(server._framedRequests)
+(True, 1)
+>>> try:
+...     framed.NoSuchMethod()
+... except Exception, e:
+...     print 'is not supported' in str(e)
+... 
+True
+>>> framed.close(); time.sleep(0.2); len(server._framedRequests)
+0
+>>> old = PicklingXMLRPC.PicklingXMLRPCServer(('localhost', 0),
+...                                           logRequests=False)
+>>> old.register_function(lambda x: x * 2, 'Double')
+>>> thread = threading.Thread(target=lambda : [
+...     old.handle_request() for _i in range(2)]); thread.start()
+>>> framed = FramedRPC.FramedServerProxy(FramedRPC.TCPAddress(
+...     *old.socket.getsockname()))
+>>> framed.Double(21), framed._fallback is not None
+(42, True)
+>>> thread.join(); old.server_close(); connection.Terminate()
+        """
+
+    @staticmethod
+    def _regr_test_large_requests():
+        """Check that large requests are spilled to disk or refused.
+
+>>> import time, socket, xmlrpclib, Servers, PicklingXMLRPC, FramedRPC
+>>> server = Servers.BasicRPCServer(cpus=1, port=0, logRequests=False)
+>>> server.maxRequestBytes, server.spillRequestBytes = 1000000, 100000
+>>> server.register_function(len, 'Len')
+>>> bodies = []
+>>> def Dispatch(data, *args):
+...     bodies.append(getattr(data, '__class__', type(data)).__name__)
+...     return Servers.BasicRPCServer._marshaled_dispatch(server, data, *args)
+... 
+>>> server._marshaled_dispatch = Dispatch
+>>> server.serve_forever_as_thread(daemon=True); time.sleep(0.2)
+Entering service loop forever or until killed...
+>>> connection = PicklingXMLRPC.PicklingServerProxy(
+...     'http://%s:%i' % (server.Host(), server.Port()), compressLevel=0)
+>>> connection.Len('x' * 50000), connection.Len('x' * 500000), bodies
+(50000, 500000, ['bytearray', 'file'])
+>>> try:
+...     connection.Len('x' * 2000000)
+... except xmlrpclib.ProtocolError, e:
+...     print e.errcode
+... 
+413
+>>> squeezed = PicklingXMLRPC.PicklingServerProxy(
+...     'http://%s:%i' % (server.Host(), server.Port()))
+>>> squeezed.Len('x'), squeezed.Len('x' * 500000), bodies[-1]
+(1, 500000, 'InflatingReader')
+>>> try:
+...     squeezed.Len('x' * 2000000)
+... except xmlrpclib.Fault, e:
+...     print 'decompresses to more than 1000000 bytes' in str(e)
+... 
+True
+>>> framed = FramedRPC.FramedServerProxy(FramedRPC.TCPAddress(
+...     server.Host(), server.Port()))
+>>> framed.Len('x' * 500000)
+500000
+>>> try:
+...     framed.Len('x' * 2000000)
+... except (EOFError, socket.error), e: # server closes connection
+...     print 'closed'
+... 
+closed
+>>> connection.Len('x'), connection.Terminate()
+(1, None)
+        """
+
+    @staticmethod
+    def _regr_test_compression():
+        """Check that large requests and responses are compressed.
+
+>>> import time, Servers, PicklingXMLRPC
+>>> server = Servers.BasicRPCServer(cpus=1, port=0, logRequests=False)
+>>> server.compressThreshold = 1000
+>>> server.register_function(lambda words : dict(
+...     [(w, len(w)) for w in words]), 'CountWords')
+>>> server.serve_forever_as_thread(daemon=True); time.sleep(0.2)
+Entering service loop forever or until killed...
+>>> connection = PicklingXMLRPC.PicklingServerProxy(
+...     'http://%s:%i' % (server.Host(), server.Port()),
+...     compressThreshold=1000)
+>>> words = ['word%i' % i for i in range(2000)]
+>>> [len(connection.CountWords(words)) for _i in range(2)]
+[2000, 2000]
+>>> client, served = connection.compressionStats.Info(), server.CompressionStats()
+>>> client['compressed'], client['skipped'], served['compressed']
+(1, 1, 2)
+>>> client['sentWireBytes'] < 0.75 * client['sentBytes'] # 1st not compressed
+True
+>>> client['receivedWireBytes'] < client['receivedBytes'] / 2
+True
+>>> served['receivedWireBytes'] == client['sentWireBytes']
+True
+>>> connection.Terminate()
+        """
+
+    @staticmethod
+    def _regr_test_shared_submit():
+        """Check that blobs shared by tasks are only sent once.
+
+>>> import time, Servers, PicklingXMLRPC, Tasks, Blobs
+>>> server = Servers.BasicRPCServer(cpus=1, port=0, logRequests=False)
+>>> server.UpdateActives = lambda: None # keep everything queued
+>>> sent = []
+>>> def Counting(skeleton, refs, blobs, *args):
+...     sent.append(len(blobs))
+...     return server.SubmitShared(skeleton, refs, blobs, *args)
+...
+>>> server.funcs['SubmitShared'] = Counting
+>>> server.serve_forever_as_thread(daemon=True); time.sleep(0.2)
+Entering service loop forever or until killed...
+>>> connection = PicklingXMLRPC.PicklingServerProxy(
+...     'http://%s:%i' % (server.Host(), server.Port()))
+>>> config = {'ignore' : ['file%i' % i for i in range(20000)]}
+>>> tasks = [Tasks.BasicTask('t%i' % i) for i in range(4)]
+>>> for task in tasks: task.config = config
+...
+>>> [h.Name() for h in Blobs.SubmitShared(connection, tasks[0:2])], sent
+(['t0', 't1'], [0, 1])
+>>> sent[:] = []
+>>> [h.Name() for h in Blobs.SubmitShared(connection, tasks[2:])], sent
+(['t2', 't3'], [0])
+>>> queued = [server._queue[t.Name()].clientTask for t in tasks]
+>>> queued[3].config == config, queued[2].config is queued[3].config
+(True, True)
+>>> queued[1].config is queued[2].config # loaded separately
+False
+>>> server.BlobInfo()['blobs']
+1
+>>> print Blobs.SubmitShared(connection, [Tasks.BasicTask('small')])
+None
+>>> server._blobs = Blobs.BlobStore(0) # blobs sent with a call still work
+>>> tasks[0].name = 't4'; sent[:] = []
+>>> [h.Name() for h in Blobs.SubmitShared(connection, tasks[0:1])], sent
+(['t4'], [0, 1])
+>>> server.BlobInfo()['blobs']
+0
+>>> connection.Terminate()
+        """
+
+    @staticmethod
+    def _regr_test_large_results():
+        """Check that large results are spilled and fetched when needed.
+
+>>> import time, Servers, PicklingXMLRPC, Tasks, DataStructures
+>>> class BigTask(Tasks.BasicTask):
+...     def __init__(self, name, size):
+...         Tasks.BasicTask.__init__(self, name)
+...         self.size = size
+...     def Run(self):
+...         self.result = 'x' * self.size
+...
+>>> server = Servers.BasicRPCServer(cpus=1, port=0, logRequests=False)
+>>> server._results = DataStructures.ResultStore(
+...     minBytes=1000, spillBytes=100000, maxMemoryBytes=150000)
+>>> server.serve_forever_as_thread(daemon=True); time.sleep(0.2)
+Entering service loop forever or until killed...
+>>> sizes = [('small', 10), ('medium', 80000), ('big', 200000),
+...          ('other', 80000)]
+>>> for (name, size) in sizes:
+...     handle = server.Submit(BigTask(name, size))
+...
+>>> connection = PicklingXMLRPC.PicklingServerProxy(
+...     'http://%s:%i' % (server.Host(), server.Port()))
+>>> handles = [connection.Status(name, 30) for (name, _size) in sizes]
+>>> [(h.Name(), h.finished, h.resultSize) for h in handles]
+[('small', True, None), ('medium', True, 80000), ('big', True, 200000), ('other', True, 80000)]
+>>> handles[0].result, 'result' in handles[1].__dict__
+('xxxxxxxxxx', False)
+>>> '<80000 bytes on server>' in str(handles[1])
+True
+>>> len(handles[1].result), 'result' in handles[1].__dict__
+(80000, True)
+>>> handles[2].StatusInfo()['result'] == 'x' * 200000
+True
+>>> chunk = connection.FetchResultChunk('big', 199990, 1 << 20)
+>>> chunk, connection.FetchResultChunk('other', 0, 10)
+(('xxxxxxxxxx', True, 200000), None)
+>>> handles[2].resultChunkBytes = 30000 # fetched in 7 pieces
+>>> handles[2].FetchResult() == 'x' * 200000
+True
+>>> sorted(server.ResultInfo().items()) # medium spilled to make room
+[('memory', 1), ('memoryBytes', 80000), ('spilled', 2), ('spilledBytes', 280000)]
+>>> connection.CleanFromQueue(handles[2])
+0
+>>> server.ResultInfo()['spilled']
+1
+>>> handles[3].UpdatedHandle().result == 'x' * 80000
+True
+>>> handles[3].result
+Traceback (most recent call last):
+Exception: This object has become stale.
+>>> connection.Terminate()
+        """
+
+    @staticmethod
+    def _regr_test_learned_run_time():
+        """Check that we learn run times and use them as estimates.
+
+>>> import os, tempfile, time, Servers, Tasks
+>>> class NapTask(Tasks.BasicTask):
+...     def Run(self):
+...         time.sleep(0.2)
+... 
+>>> class LongTask(Tasks.BasicTask):
+...     def Run(self):
+...         while (not getattr(self, 'halt', False)):
+...             time.sleep(0.05)
+...     def Stop(self):
+...         self.halt = True
+... 
+>>> runTimeFile = tempfile.mktemp()
+>>> server = Servers.BasicRPCServer(cpus=2, port=0, runTimeFile=runTimeFile)
+>>> server.Submit(NapTask('nap_1')).estRunTime
+28800
+>>> [h.Name() for h in server.WaitForAny(['nap_1'], 30)]
+['nap_1']
+>>> count, mean, stddev = server.LearnedRunTimes()['NapTask:nap']
+>>> count, 0.15 < mean < 1, stddev
+(1, True, 0.0)
+>>> handle = server.Submit(LongTask('long_1')); time.sleep(0.3)
+>>> server._queue['long_1'].Stop() # as RemoveFromQueue would
+>>> [h.Name() for h in server.WaitForAny(['long_1'], 30)]
+['long_1']
+>>> server.UpdateActives()
+>>> sorted(server.LearnedRunTimes().keys()) # stopped tasks are not learned
+['NapTask:nap']
+>>> server.UpdateActives = lambda: None # keep everything else queued
+>>> server.Submit(NapTask('nap_2')).estRunTime == mean
+True
+>>> server.Submit(NapTask('nap_3', estRunTime=7)).estRunTime
+7
+>>> server._SaveRunTimes(force=True)
+>>> server2 = Servers.BasicRPCServer(cpus=2, port=0, runTimeFile=runTimeFile)
+>>> server2.LearnedRunTimes().keys()
+['NapTask:nap']
+>>> os.remove(runTimeFile); server.server_close(); server2.server_close()
+        """
+
+    @staticmethod
+    def _regr_test_work_stealing():
+        """Check that an idle server takes queued tasks from a busy peer.
+
+>>> import os, time, Servers, Tasks
+>>> script = Tasks.ImportPyTask.MakeSimpleScript('''
+... import time
+... def Go():
+...     time.sleep(0.2)
+...     return 'napped'
+... ''')
+>>> victim = Servers.BasicRPCServer(cpus=1, port=0, logRequests=False)
+>>> victim.UpdateActives = lambda: None # keep everything queued
+>>> handles = victim.SubmitMany([Tasks.ImportPyTask(script, 'nap_%i' % i)
+...                              for i in range(4)])
+>>> victim.GiveTasks(2, 'elsewhere', 0) # not in peer mode yet
+[]
+>>> victim.SetPeers([])
+>>> [task.Name() for (task, _e, _c) in victim.GiveTasks(5, 'elsewhere', 0)]
+['nap_2', 'nap_3']
+>>> [h.Name() for h in victim.ShowQueue()]
+['nap_0', 'nap_1', 'nap_2', 'nap_3']
+>>> victim.Status('nap_3').started, victim.EstWaitTime(-1000)
+(False, 57600.0)
+>>> victim.ReturnGiven(['nap_2', 'nap_3'])
+>>> victim.EstWaitTime(-1000)
+115200.0
+>>> victim.serve_forever_as_thread(daemon=True); time.sleep(0.2)
+Entering service loop forever or until killed...
+>>> thief = Servers.BasicRPCServer(cpus=2, port=0, logRequests=False,
+...     peers=[(victim.Host(), victim.Port())])
+>>> thief.stealInterval = 0.1
+>>> thief.serve_forever_as_thread(daemon=True); time.sleep(0.2)
+Entering service loop forever or until killed...
+>>> handle = victim.WaitForAny(['nap_3'], 30)[0]
+>>> handle.Name(), handle.port == thief.Port()
+('nap_3', True)
+>>> for i in range(100):
+...     if (len(victim._moved) == 4): break
+...     time.sleep(0.1)
+... 
+>>> victim.ShowQueue(), sorted(victim._moved)
+([], ['nap_0', 'nap_1', 'nap_2', 'nap_3'])
+>>> [h.Name() for h in thief.WaitForAny(['nap_0'], 30)]
+['nap_0']
+>>> handle = victim.Status('nap_0')
+>>> handle.finished, handle.result, handle.port == thief.Port()
+(True, 'imported modName, did Go, got napped, done', True)
+>>> victim.Terminate(); thief.Terminate(); os.remove(script)
+        """
+
+    @staticmethod
+    def _regr_test_move_lease():
+        """Check that tasks are neither lost nor run twice when moves fail.
+
+>>> import time, Servers, Tasks
+>>> victim = Servers.BasicRPCServer(cpus=1, port=0, logRequests=False)
+>>> victim.UpdateActives = lambda: None # keep everything queued
+>>> handles = victim.SubmitMany([Tasks.BasicTask('nap_%i' % i)
+...                              for i in range(4)])
+>>> victim.SetPeers([]); victim.moveLease = 0
+>>> [task.Name() for (task, _e, _c) in victim.GiveTasks(1, 'lost', 0)]
+['nap_3']
+>>> time.sleep(0.1); victim._ExpireMoving() # lost never confirmed
+>>> victim.ConfirmGiven(['nap_3'], 'lost', 0), victim.EstWaitTime(-1000)
+([], 115200.0)
+>>> victim.moveLease = 60
+>>> [task.Name() for (task, _e, _c) in victim.GiveTasks(1, 'slow', 0)]
+['nap_3']
+>>> victim.ConfirmGiven(['nap_3'], 'other', 0)
+[]
+>>> victim.ConfirmGiven(['nap_3'], 'slow', 0)
+['nap_3']
+>>> victim.ConfirmGiven(['nap_3'], 'slow', 0) # asking again is fine
+['nap_3']
+
+If the thief cannot confirm, it holds the tasks without running them
+and asks again later.
+
+>>> victim.serve_forever_as_thread(daemon=True); time.sleep(0.2)
+Entering service loop forever or until killed...
+>>> confirm = victim.funcs['ConfirmGiven']
+>>> def Unreachable(*args):
+...     raise Exception('unreachable')
+... 
+>>> victim.funcs['ConfirmGiven'] = Unreachable
+>>> thief = Servers.BasicRPCServer(cpus=1, port=0, logRequests=False)
+>>> thief.UpdateActives = lambda: None # so we can check what was started
+>>> thief._peers = [(victim.Host(), victim.Port())]
+>>> thief._StealOnce(), thief._StealOnce()
+(0, 0)
+>>> [(n, thief._queue.State(n)) for (n, _t) in thief._queue.ShowItems()]
+[('nap_2', 'held')]
+>>> len(thief._pending), victim._queue.State('nap_2')
+(0, 'moving')
+>>> victim.funcs['ConfirmGiven'] = confirm
+>>> thief._ConfirmHeld((victim.Host(), victim.Port()))
+1
+>>> thief._queue.State('nap_2'), len(thief._pending), 'nap_2' in victim._queue
+('queued', 1, False)
+>>> victim.Terminate(); thief.server_close()
+        """
 
     def Host(self):
         "Return name of host server is running on."
@@ -397,6 +2458,79 @@ class BasicRPCServer(PicklingXMLRPC.PicklingXMLRPCServer,
         "Return port server is running on."
         return self._port
 
+def _CountCPUList(cpuList):
+    """Count cpus in a LINUX cpu list string such as '0-3,8,10-11'.
+
+>>> import Servers
+>>> Servers._CountCPUList('0-3,8,10-11')
+7
+>>> Servers._CountCPUList('')
+0
+    """
+    count = 0
+    for item in cpuList.strip().split(','):
+        if ('-' in item):
+            low, high = item.split('-')
+            count += int(high) - int(low) + 1
+        elif (item.strip()):
+            count += 1
+    return count
+
+def _CgroupDirs(base, path):
+    """Return directories for cgroup at path under base and those above it.
+
+    The directory for path comes first and base itself comes last. We
+    only return directories which exist.
+
+>>> import Servers
+>>> Servers._CgroupDirs('/', '/tmp/../tmp') in (['/tmp', '/'], ['/'])
+True
+    """
+    parts = [part for part in path.split('/') if part and part != '.']
+    if ('..' in parts):
+        parts = [] # a path outside our namespace so we only know base
+    return [directory for directory in [
+        os.path.join(base, *parts[:i]) for i in range(len(parts), -1, -1)]
+            if os.path.isdir(directory)]
+
+def _Chunks(data, chunkSize=1 << 20):
+    """Yield pieces of data no larger than chunkSize without copying it.
+
+    INPUTS:
+
+    -- data:        String, bytearray, or file to read from.
+
+    -- chunkSize=1MB:  Maximum size of each piece.
+
+    """
+    if (hasattr(data, 'read')):
+        while True:
+            chunk = data.read(chunkSize)
+            if (not chunk):
+                break
+            yield chunk
+    else:
+        for start in range(0, len(data), chunkSize):
+            yield buffer(data, start, chunkSize)
+
+def _MakeWakeupPair():
+    """Return a pair of connected sockets used to wake up select.
+
+    We use socket.socketpair where available and a loopback TCP
+    connection otherwise (e.g., on Windows).
+    """
+    if (hasattr(socket, 'socketpair')):
+        return socket.socketpair()
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        writer = socket.create_connection(listener.getsockname())
+        reader = listener.accept()[0]
+    finally:
+        listener.close()
+    return reader, writer
+
 class UpdateActivesCallback(Tasks.BasicCallback):
     """Callback to update active tasks in server.
 
@@ -430,7 +2564,72 @@ class NewRequestHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
     
     python.org bug report:
     http://mail.python.org/pipermail/python-bugs-list/2007-May/038493.html
+
+    We also speak HTTP/1.1 so clients can keep their connection open
+    between requests. Each call to handle serves one request and then,
+    if the connection should stay open, asks the server to keep it
+    (see WorkerPoolMixIn) instead of waiting here for the next request.
+    This assumes clients wait for each response before sending another
+    request (as xmlrpclib does) so nothing is left in our read buffer.
+
+    Request bodies are read into one preallocated buffer (or a temporary
+    file if larger than server.spillRequestBytes) which the server
+    parses in pieces (see BasicRPCServer._marshaled_dispatch). Requests
+    larger than server.maxRequestBytes get a 413 error.
+
+    Request bodies may be compressed (Content-Encoding deflate or gzip)
+    and we compress large responses for clients which accept deflate.
+    Every response says Accept-Encoding: deflate so clients know they
+    may compress requests (see PicklingXMLRPC.KeepAliveTransport).
+
+    Clients may instead start a connection with FramedRPC.PREAMBLE
+    (see FramedRPC.FramedServerProxy) and then send binary pickles in
+    length-prefixed frames. We peek at the first byte of each new
+    connection to decide which protocol it speaks and the server
+    remembers connections which asked for frames.
     """
+
+    protocol_version = 'HTTP/1.1'
+
+    def handle(self):
+        "Handle a single request and keep the connection if appropriate."
+
+        framed = getattr(self.server, '_framedRequests', None)
+        if (framed is not None and (self.request in framed or (
+            self.request.recv(1, socket.MSG_PEEK) == FramedRPC.PREAMBLE[0]))):
+            return self._HandleFramed(framed)
+        self.close_connection = 1
+        self.handle_one_request()
+        keepRequest = getattr(self.server, 'KeepRequest', None)
+        if (not self.close_connection and keepRequest is not None):
+            keepRequest(self.request)
+
+    def _HandleFramed(self, framed):
+        "Accept FramedRPC.PREAMBLE or handle one frame for a framed client."
+
+        if (self.request not in framed):
+            if (not FramedRPC.AcceptPreamble(self.request)):
+                return # connection gets closed
+            framed.add(self.request)
+        else:
+            try:
+                data = FramedRPC.RecvFrame(self.request, getattr(
+                    self.server, 'maxRequestBytes', None))
+            except FramedRPC.FrameTooLarge, e:
+                logging.warning('Closing connection: %s' % str(e))
+                return
+            if (data is None):
+                return # client closed connection
+            try:
+                method, params = cPickle.loads(data)
+            except Exception, e:
+                result = self.server._ErrorResult(e, None, data[:2048])
+            else:
+                result = self.server.DispatchUnpickled(method, params)
+            FramedRPC.SendFrame(self.request, cPickle.dumps(
+                result, cPickle.HIGHEST_PROTOCOL))
+        self.server.KeepRequest(self.request)
+
     def do_POST(self):
         """Handles the HTTP POST request.
 
@@ -442,47 +2641,113 @@ class NewRequestHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
             self.report_404()
             return
 
+        stats = getattr(self.server, '_compressionStats', None)
         try:
-            # Get arguments by reading body of request.
-            # We read this in chunks to avoid straining
-            # socket.read(); around the 10 or 15Mb mark, some platforms
-            # begin to have problems (bug #792570).
-            
-            
-            #MODIFICATION:
-            #max_chunk_size = 10*1024*1024
-            max_chunk_size = 2*1024*1024 
-            
-            
-            size_remaining = int(self.headers["content-length"])
-            L = []
-            while size_remaining:
-                chunk_size = min(size_remaining, max_chunk_size)
-                L.append(self.rfile.read(chunk_size))
-                size_remaining -= len(L[-1])
-            data = ''.join(L)
+            size = int(self.headers["content-length"])
+            maxBytes = getattr(self.server, 'maxRequestBytes', None)
+            if (maxBytes is not None and size > maxBytes):
+                logging.warning('Refusing request of %i bytes' % size)
+                self._Refuse(413)
+                return
+            encoding = self.headers.get('content-encoding', 'identity')
+            if (encoding not in self._wbits):
+                logging.warning('Refusing request with encoding %s' % encoding)
+                self._Refuse(415)
+                return
+            data = self._ReadBody(size)
+            if (self._wbits[encoding] is not None):
+                data = PicklingXMLRPC.InflatingReader(
+                    _Chunks(data), self._wbits[encoding], maxBytes, stats)
+            elif (stats is not None):
+                stats.Add(receivedBytes=size, receivedWireBytes=size)
 
             # In previous versions of SimpleXMLRPCServer, _dispatch
             # could be overridden in this class, instead of in
             # SimpleXMLRPCDispatcher. To maintain backwards compatibility,
             # check to see if a subclass implements _dispatch and dispatch
             # using that method if present.
-            response = self.server._marshaled_dispatch(#pylint:disable-msg=W0212
+            try:
+                response = self.server._marshaled_dispatch(#pylint:disable-msg=W0212
                     data, getattr(self, '_dispatch', None)
-                )
+                    )
+            finally:
+                if (hasattr(data, 'close')):
+                    data.close()
+                del data
+            compressed = False
+            if ('deflate' in self.headers.get('accept-encoding', '')):
+                response, compressed = PicklingXMLRPC.Compress(
+                    response, getattr(self.server, 'compressLevel', 0),
+                    getattr(self.server, 'compressThreshold', 0), stats)
+            elif (stats is not None):
+                stats.Add(sentBytes=len(response), skipped=1,
+                          sentWireBytes=len(response))
         except: # This should only happen if the module is buggy
             # internal error, report as HTTP server error
             self.send_response(500)#pylint:disable-msg=W0702
+            self.send_header("Content-length", "0")
             self.end_headers()
+            self.close_connection = 1
         else:
             # got a valid XML RPC response
             self.send_response(200)
             self.send_header("Content-type", "text/xml")
             self.send_header("Content-length", str(len(response)))
+            self.send_header("Accept-Encoding", "deflate")
+            if (compressed):
+                self.send_header("Content-Encoding", "deflate")
             self.end_headers()
             self.wfile.write(response)
-
-            # shut down the connection
             self.wfile.flush()
-            self.connection.shutdown(1)
+
+    # Content-Encoding values we accept -> wbits for zlib.decompressobj
+    _wbits = {'identity' : None, 'deflate' : zlib.MAX_WBITS,
+              'gzip' : 16 + zlib.MAX_WBITS}
+
+    def _Refuse(self, code):
+        "Send error response with given code and close the connection."
+
+        self.send_response(code)
+        self.send_header("Content-length", "0")
+        self.end_headers()
+        self.close_connection = 1
+
+    def _ReadBody(self, size):
+        """Read request body of the given size.
+
+        RETURNS:        A bytearray holding the body or, if size is more
+                        than server.spillRequestBytes, a temporary file
+                        holding the body positioned at its start.
+        """
+        # Get arguments by reading body of request.
+        # We read this in chunks to avoid straining
+        # socket.read(); around the 10 or 15Mb mark, some platforms
+        # begin to have problems (bug #792570).
+        
+        
+        #MODIFICATION:
+        #max_chunk_size = 10*1024*1024
+        max_chunk_size = 2*1024*1024 
+        
+        
+        spill = getattr(self.server, 'spillRequestBytes', None)
+        if (spill is not None and size > spill):
+            body = tempfile.TemporaryFile(prefix='superpy_request_')
+        else:
+            body = bytearray(size)
+        size_remaining = size
+        while size_remaining:
+            chunk_size = min(size_remaining, max_chunk_size)
+            chunk = self.rfile.read(chunk_size)
+            if (not chunk):
+                raise EOFError('Request ended %i bytes early' % size_remaining)
+            if (isinstance(body, bytearray)):
+                start = size - size_remaining
+                body[start:start + len(chunk)] = chunk
+            else:
+                body.write(chunk)
+            size_remaining -= len(chunk)
+        if (not isinstance(body, bytearray)):
+            body.seek(0)
+        return body
     
@@ -1,7 +1,7 @@
 """Module containing various classes to provide information about tasks.
 """
 
-import socket, xmlrpclib, logging, time, datetime, threading, copy
+import socket, xmlrpclib, logging, time, datetime, threading, copy, cPickle
 import PicklingXMLRPC
 
 class GenericProcessHandle:
@@ -247,11 +247,17 @@ class StaticHandle(GenericProcessHandle):
 
 class TaskHandle(GenericProcessHandle):
     """Handle representing information about a running task.
+
+    Servers leave large results out of handles and give resultSize
+    instead. Then the result is fetched from the server (see
+    FetchResult) the first time the result attribute is used.
     """
 
+    resultChunkBytes = 8 << 20
+
     def __init__(self,name,started,finished,alive,host,port,result,
                  starttime,endtime,user='unknown',taskRepr='',pids=None,
-                 tokens=None,priority=None,estRunTime=None):
+                 tokens=None,priority=None,estRunTime=None,resultSize=None):
         GenericProcessHandle.__init__(self)
         if (tokens is None): tokens = []
         self.name = name
@@ -260,7 +266,9 @@ class TaskHandle(GenericProcessHandle):
         self.alive = alive
         self.host = host
         self.port = port
-        self.result = result
+        self.resultSize = resultSize
+        if (resultSize is None):
+            self.result = result
         self.starttime = starttime
         self.endtime = endtime
         self.user = user
@@ -280,6 +288,58 @@ class TaskHandle(GenericProcessHandle):
         "Return name."
         return str(self.name)
 
+    def __getattr__(self, name):
+        "Fetch result from server the first time it is used."
+
+        if (name != 'result' or self.__dict__.get('resultSize') is None):
+            raise AttributeError(name)
+        if (self.__dict__.get('_stale')): self._Invalid()
+        self.result = self.FetchResult()
+        return self.result
+
+    def FetchResult(self, timeout=None):
+        """Ask the server for the result of the task and return it.
+
+        Usually you would just use the result attribute which calls this
+        if the server left the result out of the handle. If the server
+        wrote the result to a file, we fetch it resultChunkBytes at a
+        time so the server need not load all of it into memory.
+        """
+        connection = PicklingXMLRPC.PicklingServerProxy(
+            'http://%s:%i' % (self.host, self.port), timeout=(
+                PicklingXMLRPC.DEFAULT_TIMEOUT if timeout is None else timeout))
+        tokens = getattr(self,'_tokens',[])
+        if (not tokens):
+            chunks = self._FetchChunks(connection)
+            if (chunks is not None):
+                return chunks
+        return connection.FetchResult(*(tokens + [self.name]))
+
+    def _FetchChunks(self, connection):
+        """Return result fetched with FetchResultChunk or None if we can not.
+
+        Returns None if the result is not in a file on the server or the
+        server does not have FetchResultChunk.
+        """
+        chunks, offset = [], 0
+        while True:
+            try:
+                reply = connection.FetchResultChunk(
+                    self.name, offset, self.resultChunkBytes)
+            except xmlrpclib.Fault, e: # e.g., older server
+                logging.debug('Fetching whole result since %s' % str(e))
+                return None
+            if (reply is None):
+                return None
+            data, isString, size = reply
+            chunks.append(data)
+            offset += len(data)
+            if (offset >= size or not data):
+                break
+        data = ''.join(chunks)
+        del chunks
+        return data if isString else cPickle.loads(data)
+
     def Pretty(self):
         "Uses __str__ to show pretty version"
         return str(self)
@@ -313,24 +373,24 @@ class TaskHandle(GenericProcessHandle):
                         Generally, serverTimeout should be less than
                         timeout since you want to give the server a
                         chance to timeout and report that timeout back
-                        to the client. If serverTimeout is None, we
-                        try to set it to something reasonable and less
-                        than timeout.
+                        to the client. The server waits up to
+                        serverTimeout seconds for the task to finish
+                        before replying. If serverTimeout is None, we
+                        use 0 so the server replies right away.
         """
         result, exc = None, None
         connString = 'http://%s:%i' % (self.host,self.port)
-        oldtimeout = socket.getdefaulttimeout()        
         if (timeout is None):
             timeout = 60*10
         if (serverTimeout is None):
-            serverTimeout = max(1, timeout-4)
+            serverTimeout = 0
 
         args = getattr(self,'_tokens',[]) + [self.name,serverTimeout]
         for _attempt in range(numAttempts):
             try:
-                socket.setdefaulttimeout(timeout)
                 logging.debug('Connecting to %s' % connString)
-                connection = PicklingXMLRPC.PicklingServerProxy(connString)
+                connection = PicklingXMLRPC.PicklingServerProxy(
+                    connString, timeout=timeout)
                 result = connection.Status(*args)
                 break
             except xmlrpclib.ProtocolError, exc:
@@ -342,8 +402,6 @@ class TaskHandle(GenericProcessHandle):
                     'Exception updating status with server %s:\n%s\n'
                     % (connString, str(exc)))
                 raise
-            finally:
-                socket.setdefaulttimeout(oldtimeout)
             time.sleep(1) #Pause for a second before trying again
 
         for name in self.__dict__.keys():
@@ -355,6 +413,47 @@ class TaskHandle(GenericProcessHandle):
         self._stale = True
         return result
 
+    def WaitForUpdatedHandle(self, waitInSeconds=10, pollTime=3, *args, **kw):
+        """Wait for a period of time for task to finish.
+        
+        INPUTS:
+        
+        -- waitInSeconds=10:   Max time to wait before returning.
+        
+        -- pollTime=3:         How often to update handle if the server
+                               does not wait for us.
+        
+        -- *args, **kw:        Additional args for self.UpdatedHandle.
+        
+        -------------------------------------------------------
+        
+        RETURNS:        The latest updated handle.
+        
+        -------------------------------------------------------
+        
+        PURPOSE:        Like GenericProcessHandle.WaitForUpdatedHandle
+                        but we ask the server to wait for the task to
+                        finish so we find out as soon as it does instead
+                        of at the next poll. Older servers which ignore
+                        the timeout for Status get polled every pollTime.
+        
+        """
+        handle = self
+        deadline = time.time() + waitInSeconds
+        remaining = waitInSeconds
+        while (remaining > 0):
+            callStart = time.time()
+            kw['serverTimeout'] = remaining
+            kw['timeout'] = max(kw.get('timeout') or 0, remaining + 30)
+            handle = handle.UpdatedHandle(*args, **kw)
+            if (handle.StatusInfo()['mode'] == 'finished'):
+                return handle
+            remaining = deadline - time.time()
+            if (time.time() - callStart < min(pollTime, remaining)):
+                time.sleep(min(pollTime, remaining)) # server did not wait
+                remaining = deadline - time.time()
+        return handle
+
     def Kill(self):
         "Kill task"
         connString = 'http://%s:%i' % (self.host,self.port)
@@ -376,8 +475,11 @@ class TaskHandle(GenericProcessHandle):
 
     def __str__(self):
         if (self._stale): self._Invalid()
+        values = dict(self.__dict__)
+        if ('result' not in values): # show size instead of fetching
+            values['result'] = '<%s bytes on server>' % self.resultSize
         result = self.__class__.__name__ + '(\n' + ',\n'.join(
-            ['    %s=%s'%(item,repr(getattr(self,item,'unknown')))
+            ['    %s=%s'%(item,repr(values.get(item,'unknown')))
              for item in ['name','started','finished','alive','host','port',
                           'result','starttime','endtime','user',
                           'taskRepr', 'pids', 'priority', 'estRunTime']])+')\n'
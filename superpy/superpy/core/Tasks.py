@@ -1,8 +1,8 @@
 """Module providing various tasks to be excuted remotely.
 """
 
-import os, threading, logging, sys, imp, stat, time
-import tempfile, smtplib, datetime
+import os, threading, logging, sys, imp, stat, re, signal
+import tempfile, smtplib, datetime, copy
 from email import MIMEMultipart, MIMENonMultipart, Encoders
 from email.mime.text import MIMEText
 
@@ -35,6 +35,13 @@ class ServerSideTask(threading.Thread):
         self.semaphore = None
         self.starttime = None
         self.endtime = None        
+        # True if Stop or Kill cut the task short so its run time says
+        # nothing about how long such tasks take.
+        self.stopped = False
+        # If results is a DataStructures.ResultStore, a large result is
+        # moved there when we finish and resultSize is set to its size.
+        self.results = None
+        self.resultSize = None
 
         
         threading.Thread.__init__(self,*threadInitArgs,**threadInitKW)
@@ -49,15 +56,14 @@ class ServerSideTask(threading.Thread):
         assert None != self.clientTask.Name(), 'Task must have a name!.'
 
         secsToWaitForCleanup = 5
-        while (self.started.isSet() and self.finished.isSet()
-               and self.isAlive() and secsToWaitForCleanup):
+        if (self.started.isSet() and self.finished.isSet()
+            and self.isAlive() and threading.currentThread() is not self):
             # Task in a weird state where it is technically finished
             # but still alive. This can happen if cleanups after
             # task finishes have not completed. So we wait a little
             # while for cleanups to finish.
             logging.debug('waiting for cleanup...')
-            time.sleep(.1)
-            secsToWaitForCleanup -= .1
+            self.join(secsToWaitForCleanup)
         if (self.started.isSet() and self.finished.isSet()
             and self.isAlive()):
             raise Exception('Task %s finsihed but still alive; cleanups fail'
@@ -68,7 +74,8 @@ class ServerSideTask(threading.Thread):
             self.starttime,self.endtime,self.clientTask.user,
             taskRepr=repr(self.clientTask),pids=self.clientTask.GetPids(),
             priority=self.clientTask.Priority(),
-            estRunTime=self.clientTask.EstRunTime())
+            estRunTime=self.clientTask.EstRunTime(),
+            resultSize=self.resultSize)
 
         return result
 
@@ -120,13 +127,52 @@ class ServerSideTask(threading.Thread):
             logging.warning('Called Finish on %s multiple times.' %
                             self.clientTask.Name())
         else:
-            self.finished.set()
+            self._StoreResult()
+            # set endtime first so anyone who sees finished sees endtime
             self.endtime = datetime.datetime.now()
+            self.finished.set()
             logging.debug('Executing callbacks for %s.'%self.clientTask.Name())
             for item in self.callbacks:
                 logging.debug('Doing callback %s' % str(item))
                 item()
 
+    def _StoreResult(self):
+        """Move result of client task to self.results if that takes it.
+
+        Handles for the task then leave out the result and give its size
+        instead so clients fetch it only when they need it (see
+        TaskInfo.TaskHandle). Exceptions are always kept.
+        """
+        result = self.clientTask.result
+        if (self.results is None or result is None
+            or isinstance(result, Exception)):
+            return
+        try:
+            self.resultSize = self.results.Put(self.clientTask.Name(), result)
+        except Exception, e:
+            logging.warning('Keeping result of %s in memory since %s' % (
+                self.clientTask.Name(), str(e)))
+            return
+        if (self.resultSize is not None):
+            self.clientTask.result = None
+
+    def Result(self):
+        "Return result of client task (from self.results if it is there)."
+
+        if (self.resultSize is None):
+            return self.clientTask.result
+        return self.results.Get(self.clientTask.Name())
+
+    def ReadResult(self, offset, length):
+        """Return part of result of client task if it was spilled to a file.
+
+        Returns what DataStructures.ResultStore.Read does or None if the
+        result is not in a file.
+        """
+        if (self.resultSize is None):
+            return None
+        return self.results.Read(self.clientTask.Name(), offset, length)
+
     def ReleaseSemaphore(self):
         "Release sempahore if we have it acquired."
         if (None != self.semaphore):
@@ -135,11 +181,15 @@ class ServerSideTask(threading.Thread):
 
     def Stop(self):
         "Ask task to stop."
+        if (not self.finished.isSet()):
+            self.stopped = True
         self.clientTask.Stop()
         self.Finish()
 
     def Kill(self):
         "Kill client task immiedately."
+        if (not self.finished.isSet()):
+            self.stopped = True
         self.clientTask.Kill()
         self.Finish()
 
@@ -282,9 +332,10 @@ class BasicTask:
 
     # The parameters property controls what _MakeRepr shows.
     # sub-classes may add to this
-    parameters = ['name','priority', 'estRunTime', 'user'] 
+    parameters = ['name','priority', 'estRunTime', 'user', 'slots'] 
 
-    def __init__(self, name, priority = None, estRunTime = None, user=None):
+    def __init__(self, name, priority = None, estRunTime = None, user=None,
+                 slots=1):
         if (user is None):
             user = os.getenv('USER',os.getenv('USERNAME','unknown'))        
         self.name = name
@@ -292,10 +343,13 @@ class BasicTask:
         if self.priority is None:
             self.priority = self._DefaultPriority()
         self.estRunTime = estRunTime
+        # Servers replace a default estRunTime with a learned one.
+        self.estRunTimeIsDefault = self.estRunTime is None
         if self.estRunTime is None:
             self.estRunTime = self._DefaultEstRunTime()
         self.result = None
         self.user = user
+        self.slots = slots
 
     def GetPids(self):
         """Return list of process id for task.
@@ -329,6 +383,24 @@ class BasicTask:
         """
         return getattr(self, 'estRunTime', self._DefaultEstRunTime())
 
+    def Family(self):
+        """
+        return a string naming the family of similar tasks this task is
+        in. Servers learn how long tasks in each family take to run and
+        use that as the estimated run time for tasks in the family which
+        were not given one. By default, the family is the class name and
+        the task name without trailing digits or punctuation.
+        """
+        return '%s:%s' % (self.__class__.__name__,
+                          re.sub(r'[\W\d_]+$', '', str(self.Name())))
+
+    def Slots(self):
+        """
+        return the integer number of CPU slots the task uses on a server.
+        A server only starts the task when that many of its slots are free.
+        """
+        return getattr(self, 'slots', 1)
+
     def Stop(self):
         "Stop running the task"
 
@@ -373,7 +445,7 @@ class BasicTask:
             win32process.TerminateProcess(handle, -1)
             win32api.CloseHandle(handle)
         elif hasattr(os, 'kill'):
-            os.kill(pid, signals.SIGABRT)
+            os.kill(pid, signal.SIGABRT)
         else:
             raise Exception('Do not know how to kill on os.name=%s' % (
                 str(os.name)))
@@ -574,6 +646,23 @@ class ImpersonatingTask(BasicTask):
            ''' % self.mode)
                 self.mode = 'subprocess'
 
+    def SplitForSharing(self, minBytes=None):
+        """Return copy of self with large parts of a wrapped target split out.
+
+        Blobs.SubmitShared calls this so tasks made with wrapTask=True
+        can share large state in their targets (see
+        Process.PickledTaskWrapper.SplitForSharing).
+        """
+        split = getattr(self.targetTask, 'SplitForSharing', None)
+        if (split is None):
+            return self
+        target = split(minBytes)
+        if (target is self.targetTask):
+            return self
+        result = copy.copy(self)
+        result.targetTask = target
+        return result
+
 
     def GetPids(self):
         "Return pid for local task and remote task."
@@ -17,6 +17,13 @@ def SpawnServer(targetPort=None, daemon=False, **kw):
     
     -- pythonPath=None:        Optional string to use for PYTHONPATH.
 
+    -- **kw:                   Passed to Servers.BasicRPCServer (e.g.,
+                               cpus=4 to run at most 4 tasks at once or
+                               runTimeFile='runtimes.pickle' to keep
+                               learned task run times across restarts or
+                               warmChildren=2 to keep 2 started child
+                               processes for tasks to use).
+
     """
     server = Servers.BasicRPCServer(port = targetPort, **kw)
     
@@ -31,8 +38,14 @@ def SpawnServer(targetPort=None, daemon=False, **kw):
 
 if __name__ == '__main__':
     
-    # allow caller to pass one port
+    # allow caller to pass a port and optionally the number of cpus to use
+    # a file to keep learned task run times in, and the number of warm
+    # child processes to keep
     args = sys.argv[1:]
     port = int(args[0]) if len(args) > 0 else None
+    cpus = int(args[1]) if len(args) > 1 else None
+    runTimeFile = args[2] if len(args) > 2 else None
+    warmChildren = int(args[3]) if len(args) > 3 else 0
 
-    SpawnServer(port)
+    SpawnServer(port, cpus=cpus, runTimeFile=runTimeFile,
+                warmChildren=warmChildren)
@@ -3,7 +3,15 @@
 
 import unittest, socket, time, logging, threading, re, os
 
-from superpy.core import Tasks, Servers, PicklingXMLRPC, Process
+from superpy.core import Tasks, Servers, PicklingXMLRPC, Process, Scheduler
+
+class _QuickTask(Tasks.BasicTask):
+    "Task which just returns its name; useful for testing lots of tasks."
+
+    def Run(self):
+        "Return our name."
+        self.result = self.name
+        return self.result
 
 class BasicTest(unittest.TestCase):
     """Basic test case.
@@ -23,6 +31,7 @@ HI
 Entering service loop forever or until killed...
 Entering service loop forever or until killed...
 hello
+Entering service loop forever or until killed...
 Entering service loop forever or until killed...
     """
 
@@ -43,7 +52,7 @@ Entering service loop forever or until killed...
         self.server = Servers.BasicRPCServer(cpus=1,port=port)
         self.server.serve_forever_as_thread()
         logging.debug('Starting server on port %i' % port)
-        self.scheduler = Servers.Scheduler(
+        self.scheduler = Scheduler.Scheduler(
             [(socket.gethostname(),self.server._port)])
 
         #FIXME: Ideally tests should work with the following as True.
@@ -56,19 +65,15 @@ Entering service loop forever or until killed...
         
         logging.debug('Terminating server')
         self.server.Terminate()
-        oldtimeout = socket.getdefaulttimeout()
-        socket.setdefaulttimeout(5)        
         try: #poke the server to make sure it processes stuff
             connection = PicklingXMLRPC.PicklingServerProxy(
                 'http://%s:%i' % (getattr(self.server,'_host'),
-                                  getattr(self.server,'_port')))
+                                  getattr(self.server,'_port')), timeout=5)
             connection.system.listMethods()
         except Exception, e:
             #Not a big deal
             logging.error('Unable to contact server: %s; it probably shutdown'
                           % str(e))
-        finally:
-            socket.setdefaulttimeout(oldtimeout)
 
         time.sleep(1) # give everything time to shutdown
         self.assertEqual(False,getattr(self.server,'_thread').isAlive())
@@ -171,6 +176,34 @@ def Go():
         self.assertEqual(connection.ShowQueue(),[]) #Make sure queue is empty
         time.sleep(3) # wait for cleanups to finish before tear down
 
+    def testManyThreads(self):
+        "Make sure many threads can share one scheduler."
+
+        host, port = self.scheduler.hosts.keys()[0]
+        errors, results = [], []
+        def Worker(i):
+            "Submit a task, poll it, and look at the queue."
+            try:
+                handle = self.scheduler.SubmitTaskToBestServer(
+                    _QuickTask('quick_%i' % i, estRunTime=1))
+                # use a different timeout in each thread
+                self.failIf(self.scheduler.ShowQueue(
+                    host, port, timeout=5 + i) is None)
+                handle = handle.WaitForUpdatedHandle(60, pollTime=0.2)
+                results.append(handle.result)
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=Worker, args=(i,))
+                   for i in range(32)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(120)
+        self.assertEqual([], errors)
+        self.assertEqual(sorted(['quick_%i' % i for i in range(32)]),
+                         sorted(results))
+        self.assertEqual(None, socket.getdefaulttimeout())
+
 
 if __name__ == '__main__':
     import doctest; doctest.testmod()
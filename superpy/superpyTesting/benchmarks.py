@@ -0,0 +1,1318 @@
+"""Benchmarks for various parts of superpy.
+
+Each Bench* function in this module sets up whatever local servers it
+needs, runs a workload, prints a small table of results, and returns
+the raw numbers as a list of dictionaries. The benchmarks are not part
+of the unit tests since they take a while to run. You can run them from
+an interactive session or from the command line via
+
+  python benchmarks.py [<BenchName> ...]
+
+where running with no arguments runs every benchmark in this module.
+"""
+
+import sys, os, time, threading, logging, socket, random, xmlrpclib, pickle
+import heapq
+
+from superpy.core import Servers, Tasks, PicklingXMLRPC, DataStructures
+from superpy.core import Scheduler, TaskInfo, Manager, Process
+from superpy.core import FramedRPC
+
+class _NoOpTask(Tasks.BasicTask):
+    "Task which does nothing; useful for measuring server overhead."
+
+    def Run(self):
+        "Return None right away."
+        self.result = None
+        return self.result
+
+def _StartServer(**kw):
+    "Start a BasicRPCServer on a dynamic port in a daemon thread."
+
+    server = Servers.BasicRPCServer(port=0, logRequests=False, **kw)
+    server.serve_forever_as_thread(daemon=True)
+    return server
+
+def _StopServer(server):
+    "Ask server to terminate, poke it so it notices, and wait for it."
+
+    server.Terminate()
+    try:
+        _Connect(server, timeout=5).system.listMethods()
+    except Exception, e:
+        logging.debug('Ignoring %s while stopping server' % str(e))
+    if (server._thread is not None):
+        server._thread.join(10)
+
+def _Connect(server, timeout=PicklingXMLRPC.DEFAULT_TIMEOUT):
+    "Return a PicklingServerProxy connected to the given server."
+
+    return PicklingXMLRPC.PicklingServerProxy(
+        'http://%s:%i' % (server.Host(), server.Port()), timeout=timeout)
+
+def _RunClients(numClients, callsPerClient, makeClient):
+    """Run client threads and return aggregate calls per second.
+
+    INPUTS:
+
+    -- numClients:        Number of client threads to run at once.
+
+    -- callsPerClient:    Number of calls each client makes.
+
+    -- makeClient:        Callable which takes a client number and
+                          returns a callable taking a call number.
+                          Each client calls its callable callsPerClient
+                          times.
+
+    -------------------------------------------------------
+
+    RETURNS:        Calls per second over all clients.
+
+    """
+    clients = [makeClient(i) for i in range(numClients)]
+    errors = []
+    start = threading.Event()
+    def Worker(client):
+        "Make the calls for one client."
+        start.wait()
+        try:
+            for callNum in range(callsPerClient):
+                client(callNum)
+        except Exception, e:
+            errors.append(e)
+    threads = [threading.Thread(target=Worker, args=(c,)) for c in clients]
+    for t in threads:
+        t.start()
+    startTime = time.time()
+    start.set()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - startTime
+    if (errors):
+        raise Exception('Got %i client errors; first was %s' % (
+            len(errors), str(errors[0])))
+    return numClients * callsPerClient / max(elapsed, 1e-6)
+
+def _ShowTable(title, columns, rows):
+    "Print rows (list of dicts) as a table with the given columns."
+
+    print '\n%s\n%s' % (title, '=' * len(title))
+    print ' '.join(['%14s' % c for c in columns])
+    for row in rows:
+        print ' '.join([('%14.2f' if isinstance(row[c], float) else '%14s')
+                        % row[c] for c in columns])
+
+def BenchRPCThroughput(clientCounts=(1, 64), callsPerClient=20,
+                       workerCounts=(0, 16)):
+    """Measure Status and Submit throughput for various client counts.
+
+    INPUTS:
+
+    -- clientCounts=(1, 64):  Sequence of numbers of concurrent clients.
+
+    -- callsPerClient=20:     Number of calls each client makes.
+
+    -- workerCounts=(0, 16):  Sequence of numWorkers values to give the
+                              server. A value of 0 means requests are
+                              handled one at a time which is how servers
+                              worked before the worker pool existed.
+
+    -------------------------------------------------------
+
+    RETURNS:        List of dictionaries with one entry per combination
+                    of RPC, numWorkers, and clients.
+
+    """
+    rows = []
+    for numWorkers in workerCounts:
+        server = _StartServer(cpus=1, numWorkers=numWorkers)
+        try:
+            target = _Connect(server).Submit(_NoOpTask('statusTarget'))
+            for numClients in clientCounts:
+                def MakeStatusClient(_clientNum):
+                    "Make client which calls Status."
+                    connection = _Connect(server)
+                    return lambda _callNum: connection.Status(target, 0)
+                def MakeSubmitClient(clientNum):
+                    "Make client which calls Submit."
+                    connection = _Connect(server)
+                    prefix = 'bench_%i_%i_%i' % (
+                        numWorkers, numClients, clientNum)
+                    return lambda callNum: connection.Submit(
+                        _NoOpTask('%s_%i' % (prefix, callNum)))
+                for (rpc, makeClient) in [('Status', MakeStatusClient),
+                                          ('Submit', MakeSubmitClient)]:
+                    rate = _RunClients(numClients, callsPerClient, makeClient)
+                    rows.append({'rpc' : rpc, 'numWorkers' : numWorkers,
+                                 'clients' : numClients, 'callsPerSec' : rate})
+        finally:
+            _StopServer(server)
+    _ShowTable('RPC throughput', ['rpc', 'numWorkers', 'clients',
+                                  'callsPerSec'], rows)
+    return rows
+
+class _ListNamedQueue:
+    """Copy of the list based DataStructures.NamedQueue used as a baseline.
+    """
+
+    def __init__(self):
+        self._itemList = []
+        self._itemDict = {}
+
+    def Push(self, name, item):
+        "Push item onto end of queue."
+        if (name in self._itemDict):
+            raise Exception('Duplicate name %s' % name)
+        self._itemList.append(name)
+        self._itemDict[name] = item
+
+    def PopItem(self, name):
+        "Remove named item with a linear search through the list."
+        item = self._itemDict.pop(name)
+        self._itemList.pop(self._itemList.index(name))
+        return item
+
+    def __getitem__(self, name):
+        return self._itemDict[name]
+
+    def ShowItems(self):
+        "Return list of (name, item) pairs."
+        return [(name, self._itemDict[name]) for name in self._itemList]
+
+def BenchNamedQueue(numItems=100000, numPops=5000, numScans=20):
+    """Time DataStructures.NamedQueue operations against the old version.
+
+    INPUTS:
+
+    -- numItems=100000:  Number of items to push into the queue.
+
+    -- numPops=5000:     Number of items to pop in random order.
+
+    -- numScans=20:      Number of times to look at all items in one state
+                         (for the old version this means all items).
+
+    -------------------------------------------------------
+
+    RETURNS:        List of dictionaries with microseconds per operation
+                    for each implementation.
+
+    """
+    names = ['task_%i' % i for i in range(numItems)]
+    toPop = random.Random(0).sample(names, numPops)
+    rows = []
+    for (label, queueClass) in [('list', _ListNamedQueue),
+                                ('linked', DataStructures.NamedQueue)]:
+        queue = queueClass()
+        times = {}
+        start = time.time()
+        for name in names:
+            queue.Push(name, name)
+        times['push'] = (time.time() - start) / numItems
+        start = time.time()
+        for name in names:
+            queue[name]
+        times['lookup'] = (time.time() - start) / numItems
+        if (hasattr(queue, 'SetState')):
+            for name in names[-100:]:
+                queue.SetState(name, 'running')
+            scan = lambda: sum([1 for _pair in queue.IterItems('running')])
+        else: # old version had to look at everything and filter
+            scan = lambda: sum([1 for _pair in queue.ShowItems()])
+        start = time.time()
+        for _i in range(numScans):
+            scan()
+        times['scan'] = (time.time() - start) / numScans
+        start = time.time()
+        for name in toPop:
+            queue.PopItem(name)
+        times['pop'] = (time.time() - start) / numPops
+        row = dict([(k, v*1e6) for (k, v) in times.items()])
+        row['impl'] = label
+        rows.append(row)
+    _ShowTable('NamedQueue with %i items (usec per op)' % numItems,
+               ['impl', 'push', 'lookup', 'pop', 'scan'], rows)
+    return rows
+
+def BenchEstWaitTime(queueLengths=(100, 10000), numCalls=200):
+    """Time EstWaitTime on a server with many queued tasks.
+
+    INPUTS:
+
+    -- queueLengths=(100, 10000):  Sequence of numbers of tasks to queue.
+
+    -- numCalls=200:               Number of EstWaitTime calls to time.
+
+    -------------------------------------------------------
+
+    RETURNS:        List of dictionaries with microseconds per call for
+                    each queue length.
+
+    """
+    rows = []
+    for numTasks in queueLengths:
+        server = Servers.BasicRPCServer(cpus=1, port=0, logRequests=False)
+        try:
+            server.UpdateActives = lambda: None # keep everything queued
+            for i in range(numTasks):
+                server.Submit(_NoOpTask('est_%i' % i, priority=i % 7,
+                                        estRunTime=1 + i % 13))
+            start = time.time()
+            for i in range(numCalls):
+                server.EstWaitTime(i % 9)
+            elapsed = time.time() - start
+        finally:
+            server.server_close()
+        rows.append({'queued' : numTasks,
+                     'usecPerCall' : elapsed * 1e6 / numCalls})
+    _ShowTable('EstWaitTime', ['queued', 'usecPerCall'], rows)
+    return rows
+
+def BenchSubmitMany(numTasks=500, numServers=3):
+    """Compare submitting tasks one at a time against SubmitMany.
+
+    INPUTS:
+
+    -- numTasks=500:    Number of tasks to submit with each method.
+
+    -- numServers=3:    Number of local servers to spread tasks over.
+
+    -------------------------------------------------------
+
+    RETURNS:        List of dictionaries with tasks per second for each
+                    submission method.
+
+    """
+    servers = [_StartServer(cpus=2) for _i in range(numServers)]
+    rows = []
+    try:
+        scheduler = Scheduler.Scheduler([(s.Host(), s.Port()) for s in servers])
+        for (label, submit) in [
+            ('loop', lambda tasks: [scheduler.SubmitTaskToBestServer(t)
+                                    for t in tasks]),
+            ('SubmitMany', scheduler.SubmitManyToBestServers)]:
+            tasks = [_NoOpTask('%s_%i' % (label, i), estRunTime=1)
+                     for i in range(numTasks)]
+            start = time.time()
+            handles = submit(tasks)
+            elapsed = time.time() - start
+            assert len(handles) == numTasks
+            rows.append({'method' : label,
+                         'tasksPerSec' : numTasks / max(elapsed, 1e-6)})
+    finally:
+        for server in servers:
+            _StopServer(server)
+    _ShowTable('Submitting %i tasks to %i servers' % (numTasks, numServers),
+               ['method', 'tasksPerSec'], rows)
+    return rows
+
+class _SleepTask(Tasks.BasicTask):
+    "Task which sleeps and then returns the time it finished."
+
+    def __init__(self, name, sleepTime, *args, **kw):
+        Tasks.BasicTask.__init__(self, name, *args, **kw)
+        self.sleepTime = sleepTime
+
+    def Run(self):
+        "Sleep for self.sleepTime seconds and return time.time()."
+        time.sleep(self.sleepTime)
+        self.result = time.time()
+        return self.result
+
+def BenchWaitLatency(numTasks=4, sleepTime=1.0):
+    """Measure time from a task finishing to a client noticing.
+
+    INPUTS:
+
+    -- numTasks=4:      Number of tasks to wait for with each method.
+
+    -- sleepTime=1.0:   Seconds each task sleeps before finishing.
+
+    -------------------------------------------------------
+
+    RETURNS:        List of dictionaries with average notice latency in
+                    milliseconds for polling, for a blocking
+                    WaitForUpdatedHandle, and for Manager.WaitForTasks.
+
+    """
+    server = _StartServer(cpus=numTasks)
+    rows = []
+    try:
+        connection = _Connect(server)
+        poll = lambda handle: TaskInfo.GenericProcessHandle.\
+            WaitForUpdatedHandle(handle, 60)
+        block = lambda handle: handle.WaitForUpdatedHandle(60)
+        for (label, wait) in [('poll', poll), ('block', block)]:
+            latencies = []
+            for i in range(numTasks):
+                handle = connection.Submit(_SleepTask(
+                    '%s_%i' % (label, i), sleepTime))
+                handle = wait(handle)
+                latencies.append(time.time() - handle.result)
+            rows.append({'method' : label, 'latencyMs' : 1000.0 * sum(
+                latencies) / len(latencies)})
+        handles = [(connection.Submit(_SleepTask(
+            'manager_%i' % i, sleepTime*(i+1))), None) for i in range(numTasks)]
+        latencies = []
+        while (handles):
+            finished, handles = Manager.WaitForTasks(handles, untilFinished=1)
+            now = time.time()
+            latencies.extend([now - h.result for (h, _e) in finished])
+        rows.append({'method' : 'WaitForTasks', 'latencyMs' : 1000.0 * sum(
+            latencies) / len(latencies)})
+    finally:
+        _StopServer(server)
+    _ShowTable('Latency from task finishing to client noticing',
+               ['method', 'latencyMs'], rows)
+    return rows
+
+class _OneShotTransport(xmlrpclib.Transport):
+    "Transport which opens a new connection for every request."
+
+    def request(self, *args, **kw):
+        "Make the request and then close the connection."
+        try:
+            return xmlrpclib.Transport.request(self, *args, **kw)
+        finally:
+            self.close()
+
+def BenchKeepAlive(clientCounts=(1, 16), callsPerClient=200):
+    """Compare Status calls per second with and without keep-alive.
+
+    INPUTS:
+
+    -- clientCounts=(1, 16):  Sequence of numbers of concurrent clients.
+
+    -- callsPerClient=200:    Number of calls each client makes.
+
+    -------------------------------------------------------
+
+    RETURNS:        List of dictionaries with calls per second for each
+                    transport and number of clients.
+
+    """
+    server = _StartServer(cpus=1)
+    rows = []
+    try:
+        url = 'http://%s:%i' % (server.Host(), server.Port())
+        target = _Connect(server).Submit(_NoOpTask('statusTarget'))
+        for numClients in clientCounts:
+            for (label, makeTransport) in [
+                ('new connection', _OneShotTransport),
+                ('keep-alive', PicklingXMLRPC.KeepAliveTransport)]:
+                def MakeClient(_clientNum):
+                    "Make client which calls Status."
+                    connection = PicklingXMLRPC.PicklingServerProxy(
+                        url, transport=makeTransport())
+                    return lambda _callNum: connection.Status(target, 0)
+                rate = _RunClients(numClients, callsPerClient, MakeClient)
+                rows.append({'transport' : label, 'clients' : numClients,
+                             'callsPerSec' : rate})
+    finally:
+        _StopServer(server)
+    _ShowTable('Status calls with and without keep-alive',
+               ['transport', 'clients', 'callsPerSec'], rows)
+    return rows
+
+class _SequentialScheduler(Scheduler.Scheduler):
+    "Scheduler which probes servers one at a time like it used to."
+
+    def _EstWaitTimes(self, priority, newtimeout=None, deadline=None,
+                      keys=None, freeSlots=False):
+        "Ask each server for its wait time in turn with a timeout for each."
+        _ignore = deadline, freeSlots
+        if (newtimeout is None): newtimeout = self.probeTimeout
+        estWaitTimes = []
+        for k in (self.hosts if keys is None else keys):
+            v = self.hosts[k]
+            connection = self.Connection(k[0], k[1], newtimeout)
+            try:
+                methods = set(pickle.loads(connection.system.listMethods()))
+                estWaitTimes.append((k, v, connection.EstWaitTime(priority),
+                                     methods))
+            except Exception, e:
+                logging.debug('Skipping %s because %s' % (str(k), str(e)))
+        return estWaitTimes
+
+def _MakeFakeCluster(numGood, numSlow, numDead, slowTime):
+    """Start local servers and return (hostList, servers, deadSockets).
+
+    Good servers answer right away, slow servers take slowTime seconds to
+    answer EstWaitTime, and dead hosts accept connections but never
+    answer. Tasks submitted to the servers are kept queued.
+    """
+    servers, deadSockets = [], []
+    for i in range(numGood + numSlow):
+        server = _StartServer(cpus=1)
+        server.UpdateActives = lambda: None
+        if (i >= numGood):
+            def SlowEstWaitTime(priority, func=server.EstWaitTime):
+                "Sleep before answering."
+                time.sleep(slowTime)
+                return func(priority)
+            server.funcs['EstWaitTime'] = SlowEstWaitTime
+        servers.append(server)
+    for _i in range(numDead):
+        deadSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        deadSocket.bind(('', 0))
+        deadSocket.listen(50)
+        deadSockets.append(deadSocket)
+    hostList = [(s.Host(), s.Port()) for s in servers] + [
+        (socket.gethostname(), d.getsockname()[1]) for d in deadSockets]
+    return hostList, servers, deadSockets
+
+def BenchProbing(numGood=3, numSlow=2, numDead=2, slowTime=1.0,
+                 probeTimeout=2, numSubmits=4):
+    """Time submits to a cluster with slow and dead hosts.
+
+    INPUTS:
+
+    -- numGood=3:       Number of servers which answer right away.
+
+    -- numSlow=2:       Number of servers which take slowTime to answer.
+
+    -- numDead=2:       Number of hosts which never answer.
+
+    -- slowTime=1.0:    Seconds slow servers take to answer.
+
+    -- probeTimeout=2:  Timeout in seconds for contacting one server.
+
+    -- numSubmits=4:    Number of tasks to submit with each scheduler.
+
+    -------------------------------------------------------
+
+    RETURNS:        List of dictionaries with seconds per submit for
+                    sequential and parallel probing.
+
+    """
+    hostList, servers, deadSockets = _MakeFakeCluster(
+        numGood, numSlow, numDead, slowTime)
+    rows = []
+    try:
+        for (label, schedulerClass) in [('sequential', _SequentialScheduler),
+                                        ('parallel', Scheduler.Scheduler)]:
+            scheduler = schedulerClass(hostList)
+            scheduler.probeTimeout = probeTimeout
+            start = time.time()
+            for i in range(numSubmits):
+                scheduler.SubmitTaskToBestServer(_NoOpTask(
+                    '%s_%i' % (label, i), estRunTime=1))
+            rows.append({'probing' : label,
+                         'secsPerSubmit' : (time.time() - start) / numSubmits})
+    finally:
+        for server in servers:
+            _StopServer(server)
+        for deadSocket in deadSockets:
+            deadSocket.close()
+    _ShowTable('Submits with %i good, %i slow, and %i dead hosts' % (
+        numGood, numSlow, numDead), ['probing', 'secsPerSubmit'], rows)
+    return rows
+
+def BenchGossip(numGood=3, numSlow=2, slowTime=0.2, numSubmits=30):
+    """Compare probing for loads against load gossip when submitting.
+
+    INPUTS:
+
+    -- numGood=3:       Number of servers which answer right away.
+
+    -- numSlow=2:       Number of servers which take slowTime to answer
+                        EstWaitTime.
+
+    -- slowTime=0.2:    Seconds slow servers take to answer.
+
+    -- numSubmits=30:   Number of tasks to submit in a burst with each
+                        scheduler.
+
+    -------------------------------------------------------
+
+    RETURNS:        List of dictionaries with seconds per submit and the
+                    largest and smallest number of tasks any server got
+                    for probing and for gossip.
+
+    """
+    hostList, servers, deadSockets = _MakeFakeCluster(
+        numGood, numSlow, 0, slowTime)
+    rows = []
+    try:
+        for (label, gossip) in [('probing', False), ('gossip', True)]:
+            scheduler = Scheduler.Scheduler(hostList, gossip=gossip)
+            for _i in range(100):
+                if (not gossip or len(scheduler._GossipEstWaitTimes(0)) ==
+                    len(hostList)):
+                    break
+                time.sleep(0.1)
+            start = time.time()
+            counts = dict([(k[1], 0) for k in hostList])
+            for i in range(numSubmits):
+                handle = scheduler.SubmitTaskToBestServer(_NoOpTask(
+                    '%s_%i' % (label, i), estRunTime=1))
+                counts[handle.port] += 1
+            rows.append({'method' : label,
+                         'secsPerSubmit' : (time.time() - start) / numSubmits,
+                         'maxPerServer' : max(counts.values()),
+                         'minPerServer' : min(counts.values())})
+            scheduler.__del__()
+    finally:
+        for server in servers:
+            _StopServer(server)
+    _ShowTable('Burst of %i submits to %i good and %i slow servers' % (
+        numSubmits, numGood, numSlow), ['method', 'secsPerSubmit',
+                                        'maxPerServer', 'minPerServer'], rows)
+    return rows
+
+def _SimulatePlacement(policy, numTasks, cpus, numSubmitters, rng):
+    """Simulate placing tasks on servers and return (makespan, imbalance).
+
+    Tasks are submitted in rounds of numSubmitters tasks where every task
+    in a round sees the loads as of the start of the round (like that
+    many clients probing at the same time). All tasks are queued at time
+    0 so a server has a free slot for each of its cpus beyond the number
+    of tasks it has been given, and the makespan is the largest total work per cpu of any server and
+    the imbalance is the makespan divided by the makespan of a perfect
+    split.
+    """
+    keys = range(len(cpus))
+    work = [0.0] * len(cpus)
+    counts = [0] * len(cpus)
+    totalWork = 0.0
+    for start in range(0, numTasks, numSubmitters):
+        snapshot = [(k, None, work[k] / cpus[k], None,
+                     max(0, cpus[k] - counts[k])) for k in keys]
+        for _i in range(min(numSubmitters, numTasks - start)):
+            candidates = policy.Candidates(keys)
+            entries = sorted([snapshot[k] for k in candidates],
+                             key=lambda entry: entry[2])
+            k = policy.Choose(entries, None)[0]
+            runTime = rng.expovariate(1.0/600)
+            work[k] += runTime
+            counts[k] += 1
+            totalWork += runTime
+    makespan = max([work[k] / cpus[k] for k in keys])
+    return makespan, makespan / (totalWork / sum(cpus))
+
+def BenchPlacement(taskCounts=(1000, 100000), numServers=50,
+                   numSubmitters=20, seed=1):
+    """Simulate placement policies on a cluster of servers.
+
+    INPUTS:
+
+    -- taskCounts=(1000, 100000):  Numbers of tasks to simulate.
+
+    -- numServers=50:              Number of simulated servers. Each has
+                                   1, 2, 4, or 8 cpus.
+
+    -- numSubmitters=20:           Number of tasks placed with the same
+                                   (stale) view of the loads.
+
+    -- seed=1:                     Seed for random numbers.
+
+    -------------------------------------------------------
+
+    RETURNS:        List of dictionaries with makespan in hours and
+                    imbalance (makespan over that of a perfect split)
+                    for each policy and number of tasks.
+
+    """
+    policies = [('ExactMin', lambda: Scheduler.ExactMinPolicy()),
+                ('PowerOfTwo', lambda: Scheduler.PowerOfTwoPolicy(seed)),
+                ('WeightedRandom', lambda: Scheduler.WeightedRandomPolicy(seed)),
+                ('RoundRobin', lambda: Scheduler.RoundRobinPolicy())]
+    cpus = [random.Random(seed + i).choice([1, 2, 4, 8])
+            for i in range(numServers)]
+    rows = []
+    for numTasks in taskCounts:
+        for (label, makePolicy) in policies:
+            makespan, imbalance = _SimulatePlacement(
+                makePolicy(), numTasks, cpus, numSubmitters,
+                random.Random(seed))
+            rows.append({'tasks' : numTasks, 'policy' : label,
+                         'makespanHours' : makespan / 3600,
+                         'imbalance' : imbalance})
+    _ShowTable('Placing tasks on %i servers with %i submitters at once' % (
+        numServers, numSubmitters), ['tasks', 'policy', 'makespanHours',
+                                     'imbalance'], rows)
+    return rows
+
+def _MakeTrace(numTasks, capacity, load, rng):
+    """Return list of (arrival, family, runTime) for a synthetic workload.
+
+    Tasks come from a few families with very different typical run times
+    and arrive at random so the cluster (with capacity cpus in total) is
+    busy for about load of the time.
+    """
+    families = [('BasicTask:short', 30), ('BasicTask:medium', 300),
+                ('BasicTask:long', 3000)]
+    meanRunTime = sum([typical for (_f, typical) in families]) / float(
+        len(families))
+    arrival, trace = 0.0, []
+    for _i in range(numTasks):
+        arrival += rng.expovariate(capacity * load / meanRunTime)
+        family, typical = rng.choice(families)
+        trace.append((arrival, family, typical * rng.lognormvariate(0, 0.3)))
+    return trace
+
+def _ReplayTrace(trace, numServers, cpus, learn):
+    """Replay trace on simulated servers and return mean and max wait.
+
+    Each task goes to the server with the smallest estimated wait as
+    computed by BasicRPCServer.EstWaitTime. Estimated run times are the
+    8 hour default or, if learn is True, what a RuntimeHistory learned
+    from finished tasks (as BasicRPCServer does). Servers start queued
+    tasks in order as slots become free.
+    """
+    server = Servers.BasicRPCServer
+    default = Tasks.BasicTask._DefaultEstRunTime()
+    history = DataStructures.RuntimeHistory()
+    slots = [[0.0] * cpus for _s in range(numServers)]
+    assigned = [[] for _s in range(numServers)] # (start, end, estRunTime)
+    finished = [] # heap of (end, family, runTime) not yet learned from
+    policy = Scheduler.ExactMinPolicy()
+    waits = []
+    for (arrival, family, runTime) in trace:
+        while (finished and finished[0][0] <= arrival):
+            _end, doneFamily, doneRunTime = heapq.heappop(finished)
+            if (learn):
+                history.Record(doneFamily, doneRunTime)
+        estimate = history.Estimate(family, server.learnedStddevs) if (
+            learn) else None
+        if (estimate is None):
+            estimate = default
+        entries = []
+        for s in range(numServers):
+            assigned[s] = [a for a in assigned[s] if a[1] > arrival]
+            running = [(max(estRunTime*server.overrunFraction,
+                            estRunTime - (arrival - start)), 1)
+                       for (start, _end, estRunTime) in assigned[s]
+                       if start <= arrival]
+            queuedWork = sum([estRunTime for (start, _end, estRunTime)
+                              in assigned[s] if start > arrival])
+            entries.append((s, None, server.EstWaitFromLoad(
+                running, queuedWork, cpus), None))
+        s = policy.Choose(entries, None)[0]
+        slot = min(range(cpus), key=lambda i: slots[s][i])
+        start = max(arrival, slots[s][slot])
+        slots[s][slot] = start + runTime
+        assigned[s].append((start, start + runTime, estimate))
+        heapq.heappush(finished, (start + runTime, family, runTime))
+        waits.append(start - arrival)
+    return sum(waits) / len(waits), max(waits)
+
+def BenchLearnedRunTimes(numTasks=3000, numServers=10, cpus=4,
+                         loads=(0.8, 0.95), seed=1):
+    """Replay a workload with default and with learned run time estimates.
+
+    INPUTS:
+
+    -- numTasks=3000:   Number of tasks in the replayed workload.
+
+    -- numServers=10:   Number of simulated servers.
+
+    -- cpus=4:          Number of cpus on each server.
+
+    -- loads=(0.8, 0.95):  Fractions of cluster capacity the workload uses.
+
+    -- seed=1:          Seed for random numbers.
+
+    -------------------------------------------------------
+
+    RETURNS:        List of dictionaries with mean and max seconds tasks
+                    waited to start for each load and way of estimating
+                    run time.
+
+    """
+    rows = []
+    for load in loads:
+        trace = _MakeTrace(numTasks, numServers*cpus, load,
+                           random.Random(seed))
+        for (label, learn) in [('default', False), ('learned', True)]:
+            meanWait, maxWait = _ReplayTrace(trace, numServers, cpus, learn)
+            rows.append({'load' : load, 'estimates' : label,
+                         'meanWait' : meanWait, 'maxWait' : maxWait})
+    _ShowTable('Replaying %i tasks on %i servers with %i cpus' % (
+        numTasks, numServers, cpus), ['load', 'estimates', 'meanWait',
+                                      'maxWait'], rows)
+    return rows
+
+def BenchWorkStealing(numServers=4, cpus=2, numTasks=32, sleepTime=0.5,
+                      stealInterval=0.2):
+    """Measure makespan when every task is submitted to the same server.
+
+    INPUTS:
+
+    -- numServers=4:    Number of local servers.
+
+    -- cpus=2:          Number of cpus on each server.
+
+    -- numTasks=32:     Number of tasks submitted to the first server.
+
+    -- sleepTime=0.5:   Seconds each task sleeps.
+
+    -- stealInterval=0.2:  Value of stealInterval for servers in peer mode.
+
+    -------------------------------------------------------
+
+    RETURNS:        List of dictionaries with seconds from submitting to
+                    the last task finishing with and without peer mode.
+
+    """
+    rows = []
+    for (label, peerMode) in [('alone', False), ('peers', True)]:
+        servers = [_StartServer(cpus=cpus) for i in range(numServers)]
+        try:
+            if (peerMode):
+                for server in servers:
+                    server.stealInterval = stealInterval
+                    server.SetPeers([(s.Host(), s.Port()) for s in servers
+                                     if s is not server])
+            start = time.time()
+            handles = _Connect(servers[0]).SubmitMany([_SleepTask(
+                'task_%i' % i, sleepTime) for i in range(numTasks)])
+            handles = [h.WaitForUpdatedHandle(600) for h in handles]
+            assert all([h.finished for h in handles])
+            ports = set([h.port for h in handles])
+            rows.append({'mode' : label, 'servers' : len(ports),
+                         'makespan' : time.time() - start})
+        finally:
+            for server in servers:
+                _StopServer(server)
+    _ShowTable('Running %i tasks submitted to one of %i servers' % (
+        numTasks, numServers), ['mode', 'servers', 'makespan'], rows)
+    return rows
+
+def BenchWarmPool(numTasks=20, warmChildren=2):
+    """Measure latency of tasks which spawn a child with and without a pool.
+
+    INPUTS:
+
+    -- numTasks=20:     Number of tasks to run one after the other.
+
+    -- warmChildren=2:  Size of Process.WarmPool for the warm server.
+
+    -------------------------------------------------------
+
+    RETURNS:        List of dictionaries with average milliseconds from
+                    submitting an ImpersonatingTask which does almost
+                    nothing to getting its result with and without
+                    warm children.
+
+    """
+    rows = []
+    for (label, children) in [('cold', 0), ('warm', warmChildren)]:
+        server = _StartServer(cpus=1, warmChildren=children)
+        try:
+            connection = _Connect(server)
+            time.sleep(1) # let the pool start its children
+            latencies = []
+            for i in range(numTasks):
+                start = time.time()
+                handle = connection.Submit(Tasks.ImpersonatingTask(
+                    Process._ExampleForTest(), os.getcwd(),
+                    name='%s_%i' % (label, i)))
+                handle = handle.WaitForUpdatedHandle(60)
+                assert handle.result == 42, handle.result
+                latencies.append(time.time() - start)
+            rows.append({'children' : label, 'latencyMs' : 1000.0 * sum(
+                latencies) / len(latencies)})
+        finally:
+            _StopServer(server)
+    _ShowTable('Running %i tasks which spawn a child' % numTasks,
+               ['children', 'latencyMs'], rows)
+    return rows
+
+_PicklingProxy = PicklingXMLRPC.PicklingServerProxy
+
+class _CountingProxy(_PicklingProxy):
+    "Server proxy which counts the calls made through any instance."
+
+    calls = 0
+
+    def __getattr__(self, name):
+        _CountingProxy.calls += 1
+        return _PicklingProxy.__getattr__(self, name)
+
+def _ChattySpawn(process, target, fileInfo):
+    "Run target in a child using one request per setup step."
+
+    childProc, token, peer = process._StartChild(fileInfo, 'subprocess', None)
+    connection = PicklingXMLRPC.PicklingServerProxy(
+        'http://%s:%i' % (peer.host, peer.port), timeout=None)
+    if (len(fileInfo.prependPaths)):
+        connection.PrependSysPath(token, fileInfo.prependPaths)
+    if (len(fileInfo.appendPaths)):
+        connection.ExtendSysPath(token, fileInfo.appendPaths)
+    connection.SetCWD(token, fileInfo.workingDir)
+    connection.SetEnv(token, [('SUPERPY_BENCH', '1')])
+    result = connection.ProcessObject(token, target)
+    connection.Die(token)
+    childProc.wait()
+    return result
+
+def BenchBootstrap(numTasks=20):
+    """Measure requests and latency to set up a child and run a target.
+
+    INPUTS:
+
+    -- numTasks=20:     Number of children to spawn one after the other.
+
+    -------------------------------------------------------
+
+    RETURNS:        List of dictionaries with the requests made to each
+                    child after it connects back and the average
+                    milliseconds per spawned task when each setup step
+                    is a separate request versus using Bootstrap.
+
+    """
+    fileInfo = Process.RemoteFileInfo(None, None, None, prependPaths=[
+        os.getcwd()], workingDir=os.getcwd())
+    process = Process.RemoteProcess()
+    process.PrepareServer()
+    spawners = [
+        ('chatty', lambda t: _ChattySpawn(process, t, fileInfo)),
+        ('bootstrap', lambda t: process.SpawnTask(
+            t, fileInfo, env={'SUPERPY_BENCH' : '1'}))]
+    rows = []
+    for (label, spawn) in spawners:
+        PicklingXMLRPC.PicklingServerProxy = _CountingProxy
+        _CountingProxy.calls = 0
+        try:
+            start = time.time()
+            for i in range(numTasks):
+                assert spawn(Process._ExampleForTest()) == 42
+            elapsed = time.time() - start
+        finally:
+            PicklingXMLRPC.PicklingServerProxy = _PicklingProxy
+        rows.append({'setup' : label, 'rpcsPerTask' : float(
+            _CountingProxy.calls) / numTasks, 'latencyMs' : (
+                1000.0 * elapsed / numTasks)})
+    _ShowTable('Spawning %i children to run a trivial target' % numTasks,
+               ['setup', 'rpcsPerTask', 'latencyMs'], rows)
+    return rows
+
+def BenchChildTransport(sizes=(1024, 1024*1024, 100*1024*1024),
+                        totalBytes=200*1024*1024):
+    """Measure throughput talking to a child over each transport.
+
+    INPUTS:
+
+    -- sizes=(1KB, 1MB, 100MB):  Sizes in bytes of the string sent to the
+                                 child and returned as the result.
+
+    -- totalBytes=200MB:         Send about this many bytes for each
+                                 size (but at least one call and at most
+                                 1000 calls).
+
+    -------------------------------------------------------
+
+    RETURNS:        List of dictionaries with milliseconds per call and
+                    MB/s (counting both directions) for a child started
+                    by a RemoteProcess using TCP XML-RPC versus FramedRPC
+                    over Unix domain sockets.
+
+    """
+    fileInfo = Process.RemoteFileInfo(None, None, None, prependPaths=[])
+    rows = []
+    for transport in ['tcp', 'unix']:
+        process = Process.RemoteProcess(transport)
+        process.PrepareServer()
+        childProc, token, peer = process._StartChild(
+            fileInfo, 'subprocess', None)
+        connection = Process.MakeProxy(peer.host, peer.port, None)
+        try:
+            for size in sizes:
+                data = 'x' * size
+                calls = max(1, min(1000, totalBytes // size))
+                start = time.time()
+                for _i in range(calls):
+                    result = connection.ProcessObject(
+                        token, Process._ExampleForTest(func=str, args=(data,)))
+                    assert len(result) == size
+                elapsed = time.time() - start
+                rows.append({'transport' : transport, 'bytes' : size,
+                             'msPerCall' : 1000.0 * elapsed / calls,
+                             'MBPerSec' : 2.0 * size * calls / elapsed / 2**20})
+                del data, result
+        finally:
+            connection.Die(token)
+            childProc.wait()
+    _ShowTable('Sending strings to a child and back',
+               ['transport', 'bytes', 'msPerCall', 'MBPerSec'], rows)
+    return rows
+
+def BenchFramedTransport(sizes=(1024, 1024*1024, 100*1024*1024),
+                         totalBytes=200*1024*1024, maxXMLRPCBytes=16*1024*1024):
+    """Measure throughput of XML-RPC and frames to the same server.
+
+    INPUTS:
+
+    -- sizes=(1KB, 1MB, 100MB):  Sizes in bytes of the random string sent
+                                 to the server and echoed back.
+
+    -- totalBytes=200MB:         Send about this many bytes for each
+                                 size (but at least one call and at most
+                                 1000 calls).
+
+    -- maxXMLRPCBytes=16MB:      Skip XML-RPC for larger sizes. Echoing
+                                 100MB of random bytes over XML-RPC
+                                 needs more than 5GB of memory.
+
+    -------------------------------------------------------
+
+    RETURNS:        List of dictionaries with milliseconds per call and
+                    MB/s (counting both directions) for PicklingServerProxy
+                    and FramedRPC.FramedServerProxy talking to one
+                    BasicRPCServer.
+
+    """
+    server = _StartServer(cpus=1)
+    server.register_function(lambda data: data, 'Echo')
+    rows = []
+    try:
+        proxies = [('xml-rpc', _Connect(server, None)), (
+            'framed', FramedRPC.FramedServerProxy(FramedRPC.TCPAddress(
+                server.Host(), server.Port()), None))]
+        for size in sizes:
+            data = os.urandom(size)
+            calls = max(1, min(1000, totalBytes // size))
+            for (label, connection) in proxies:
+                if (label == 'xml-rpc' and size > maxXMLRPCBytes):
+                    rows.append({'transport' : label, 'bytes' : size,
+                                 'msPerCall' : 'skipped',
+                                 'MBPerSec' : 'skipped'})
+                    continue
+                start = time.time()
+                for _i in range(calls):
+                    assert len(connection.Echo(data)) == size
+                elapsed = time.time() - start
+                rows.append({'transport' : label, 'bytes' : size,
+                             'msPerCall' : 1000.0 * elapsed / calls,
+                             'MBPerSec' : 2.0 * size * calls / elapsed / 2**20})
+            del data
+    finally:
+        _StopServer(server)
+    _ShowTable('Echoing random strings through a BasicRPCServer',
+               ['transport', 'bytes', 'msPerCall', 'MBPerSec'], rows)
+    return rows
+
+_MEMORY_SERVER_SCRIPT = """
+import sys, resource, SimpleXMLRPCServer
+from superpy.core import Servers
+if (sys.argv[1] == 'joined'): # read and parse bodies as one string
+    Servers.NewRequestHandler.do_POST = (
+        SimpleXMLRPCServer.SimpleXMLRPCRequestHandler.__dict__['do_POST'])
+    Servers.BasicRPCServer._marshaled_dispatch = (
+        SimpleXMLRPCServer.SimpleXMLRPCDispatcher.__dict__[
+            '_marshaled_dispatch'])
+server = Servers.BasicRPCServer(cpus=1, port=0, logRequests=False)
+server.register_function(len, 'Len')
+server.register_function(lambda : resource.getrusage(
+    resource.RUSAGE_SELF).ru_maxrss, 'PeakRSS')
+print server.Port()
+sys.stdout.flush()
+server.serve_forever()
+"""
+
+def BenchRequestMemory(sizes=(1 << 20, 32 << 20, 256 << 20)):
+    """Measure peak server memory while handling one large request.
+
+    INPUTS:
+
+    -- sizes=(1MB, 32MB, 256MB):  Sizes in bytes of the string argument.
+
+    -------------------------------------------------------
+
+    RETURNS:        List of dictionaries with the growth in peak RSS of
+                    a fresh server process (which only runs on Linux
+                    style systems with the resource module) handling one
+                    request when the body is joined into one string and
+                    parsed (as SimpleXMLRPCServer does) versus read into
+                    one buffer or spilled to a file and parsed in pieces.
+
+    """
+    import subprocess
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([os.path.dirname(os.path.dirname(
+        os.path.dirname(os.path.abspath(Servers.__file__))))] + [
+            p for p in [env.get('PYTHONPATH')] if p])
+    rows = []
+    for size in sizes:
+        data = os.urandom(size * 3 // 4).encode('base64')[:size]
+        for mode in ['joined', 'streamed']:
+            proc = subprocess.Popen(
+                [sys.executable, '-c', _MEMORY_SERVER_SCRIPT, mode],
+                stdout=subprocess.PIPE, env=env)
+            try:
+                connection = PicklingXMLRPC.PicklingServerProxy(
+                    'http://localhost:%i' % int(proc.stdout.readline()), None)
+                before = connection.PeakRSS()
+                start = time.time()
+                assert connection.Len(data) == size
+                elapsed = time.time() - start
+                rows.append({'body' : mode, 'bytes' : size, 'seconds' :
+                             elapsed, 'peakRSSGrowthMB' : (
+                                 connection.PeakRSS() - before) / 1024.0})
+            finally:
+                proc.terminate()
+                proc.wait()
+        del data
+    _ShowTable('Peak server RSS growth for one request',
+               ['body', 'bytes', 'seconds', 'peakRSSGrowthMB'], rows)
+    return rows
+
+_RESULT_SERVER_SCRIPT = """
+import sys, resource, ctypes
+from superpy.core import Servers, Tasks
+class BigResultTask(Tasks.BasicTask):
+    def __init__(self, name, size):
+        Tasks.BasicTask.__init__(self, name)
+        self.size = size
+    def Run(self):
+        self.result = 'x' * self.size
+def Fill(numTasks, size):
+    names = ['big%i' % i for i in range(numTasks)]
+    for name in names:
+        server.Submit(BigResultTask(name, size))
+    for name in names:
+        server.Status(name, None)
+    return names
+if (sys.argv[1] == 'in handles'): # keep every result in its handle
+    Servers.BasicRPCServer.lazyResultBytes = sys.maxint
+else:
+    Servers.BasicRPCServer.maxResultMemory = int(sys.argv[2])
+server = Servers.BasicRPCServer(cpus=2, port=0, logRequests=False)
+server.register_function(Fill, 'Fill')
+def RSS():
+    try: # give freed memory back to the system first if we can
+        ctypes.CDLL('libc.so.6').malloc_trim(0)
+    except Exception:
+        pass
+    return int(open('/proc/self/statm').read().split()[1]) * (
+        resource.getpagesize())
+server.register_function(RSS, 'RSS')
+print server.Port()
+sys.stdout.flush()
+server.serve_forever()
+"""
+
+def BenchLargeResults(numTasks=20, resultBytes=16 << 20,
+                      maxResultMemory=64 << 20):
+    """Measure server memory and status time for tasks with large results.
+
+    INPUTS:
+
+    -- numTasks=20:             Number of tasks to run.
+
+    -- resultBytes=16MB:        Size of the string each task returns.
+
+    -- maxResultMemory=64MB:    Memory budget for results when they are
+                                spilled to disk.
+
+    -------------------------------------------------------
+
+    RETURNS:        List of dictionaries with the growth in resident
+                    memory of a fresh server process (only on systems
+                    with /proc) after running the tasks and giving freed
+                    memory back to the system if possible, milliseconds
+                    per Status call, and milliseconds to get one result
+                    when results are kept in handles versus left out of
+                    handles and spilled past maxResultMemory.
+
+    """
+    import subprocess
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([os.path.dirname(os.path.dirname(
+        os.path.dirname(os.path.abspath(Servers.__file__))))] + [
+            p for p in [env.get('PYTHONPATH')] if p])
+    rows = []
+    for mode in ['in handles', 'spilled']:
+        proc = subprocess.Popen(
+            [sys.executable, '-c', _RESULT_SERVER_SCRIPT, mode,
+             str(maxResultMemory)], stdout=subprocess.PIPE, env=env)
+        try:
+            connection = PicklingXMLRPC.PicklingServerProxy(
+                'http://localhost:%i' % int(proc.stdout.readline()), None)
+            before = connection.RSS()
+            names = connection.Fill(numTasks, resultBytes)
+            growth = connection.RSS() - before
+            start = time.time()
+            handles = [connection.Status(name) for name in names]
+            statusTime = (time.time() - start) / numTasks
+            start = time.time()
+            assert len(handles[0].result) == resultBytes
+            resultTime = time.time() - start
+            del handles
+            rows.append({'results' : mode, 'rssGrowthMB' : growth / 1048576.0,
+                         'statusMs' : 1000.0 * statusTime,
+                         'resultMs' : 1000.0 * resultTime})
+            connection.Terminate() # so server removes its spill directory
+            try:
+                connection.RSS()
+            except Exception, e:
+                logging.debug('Ignoring %s while stopping server' % str(e))
+            for _i in range(50):
+                if (proc.poll() is not None):
+                    break
+                time.sleep(0.1)
+        finally:
+            if (proc.poll() is None):
+                proc.terminate()
+            proc.wait()
+    _ShowTable('Server memory for %i results of %i MB' % (
+        numTasks, resultBytes >> 20), ['results', 'rssGrowthMB', 'statusMs',
+                                       'resultMs'], rows)
+    return rows
+
+def BenchCompression(numWords=200000, randomBytes=4 << 20, calls=5,
+                     levels=(0, 1, 6), linkMbps=10):
+    """Measure bytes on the wire and time with and without compression.
+
+    INPUTS:
+
+    -- numWords=200000:    Number of entries in word count results.
+
+    -- randomBytes=4MB:    Size of random (incompressible) strings echoed.
+
+    -- calls=5:            Number of calls for each payload and level.
+
+    -- levels=(0, 1, 6):   Compression levels for client and server.
+
+    -- linkMbps=10:        Speed of slow link to estimate transfer time for.
+
+    -------------------------------------------------------
+
+    RETURNS:        List of dictionaries with bytes per call before and
+                    after compression (both directions), milliseconds
+                    per call on localhost, zlib milliseconds per call
+                    (client and server), and the time per call to send
+                    the bytes on the wire over a linkMbps link.
+
+    """
+    payloads = [
+        ('word counts', 'WordCounts', numWords),
+        ('random', 'Echo', os.urandom(randomBytes))]
+    rows = []
+    for level in levels:
+        server = _StartServer(cpus=1)
+        server.compressLevel = level
+        server.register_function(lambda data: data, 'Echo')
+        server.register_function(lambda n: dict([
+            ('word%i' % i, i % 97) for i in range(n)]), 'WordCounts')
+        try:
+            for (label, method, arg) in payloads:
+                connection = PicklingXMLRPC.PicklingServerProxy(
+                    'http://%s:%i' % (server.Host(), server.Port()), None,
+                    compressLevel=level)
+                connection.EstWaitTime(0) # learn whether server inflates
+                before = connection.compressionStats.Info()
+                served = server.CompressionStats()
+                start = time.time()
+                for _i in range(calls):
+                    getattr(connection, method)(arg)
+                elapsed = time.time() - start
+                after = connection.compressionStats.Info()
+                servedAfter = server.CompressionStats()
+                diff = lambda names : sum([
+                    after[n] - before[n] for n in names]) / float(calls)
+                serverDiff = lambda names : sum([
+                    servedAfter[n] - served[n] for n in names]) / float(calls)
+                wire = diff(['sentWireBytes', 'receivedWireBytes'])
+                rows.append({
+                    'payload' : label, 'level' : level,
+                    'rawKB' : diff(['sentBytes', 'receivedBytes']) / 1024,
+                    'wireKB' : wire / 1024,
+                    'msPerCall' : 1000.0 * elapsed / calls,
+                    'zlibMs' : 1000.0 * (diff([
+                        'compressSeconds', 'decompressSeconds']) + serverDiff([
+                            'compressSeconds', 'decompressSeconds'])),
+                    'linkMs' : 1000.0 * wire * 8 / (linkMbps * 1e6)})
+        finally:
+            _StopServer(server)
+    _ShowTable('Compressing requests and responses (link at %s Mbit/s)' % (
+        linkMbps), ['payload', 'level', 'rawKB', 'wireKB', 'msPerCall',
+                    'zlibMs', 'linkMs'], rows)
+    return rows
+
+class _ConfigElement(Manager.GenericElement):
+    "Element holding a (shared) config with a long ignore list."
+
+    def __init__(self, name, config):
+        Manager.GenericElement.__init__(self)
+        self.name = name
+        self.config = config
+
+    def Name(self):
+        "Return name of element."
+        return self.name
+
+    def Run(self):
+        "Return length of ignore list."
+        return len(self.config['ignore'])
+
+def BenchSharedState(numTasks=50, numIgnored=100000):
+    """Measure submitting tasks which share a large config object.
+
+    INPUTS:
+
+    -- numTasks=50:         Number of tasks to submit one at a time.
+
+    -- numIgnored=100000:   Length of ignore list in the shared config.
+
+    -------------------------------------------------------
+
+    RETURNS:        List of dictionaries with KB per task sent before
+                    and after compression, milliseconds per submit, and
+                    KB of blobs the server keeps, when sending whole
+                    tasks and when sending shared parts as blobs.
+
+    -------------------------------------------------------
+
+    PURPOSE:        Tasks are made as Manager.SimpleElementProcessor
+                    makes them (i.e., ImpersonatingTasks wrapping their
+                    element as a pickle) and kept queued on the server.
+
+    """
+    config = {'ignore' : ['/some/path/to/ignore/file%i.txt' % i
+                          for i in range(numIgnored)]}
+    rows = []
+    for (label, minBlobBytes) in [
+        ('whole tasks', None), ('blobs', Scheduler.Scheduler.minBlobBytes)]:
+        server = _StartServer(cpus=1)
+        server.UpdateActives = lambda: None # keep everything queued
+        try:
+            scheduler = Scheduler.Scheduler([(server.Host(), server.Port())])
+            scheduler.minBlobBytes = minBlobBytes
+            connection = scheduler.Connection(server.Host(), server.Port())
+            tasks = [Tasks.ImpersonatingTask(
+                _ConfigElement('e%i' % i, config), workingDir=os.getcwd(),
+                wrapTask=True, name='%s_%i' % (label, i))
+                     for i in range(numTasks)]
+            before = connection.compressionStats.Info()
+            start = time.time()
+            for task in tasks:
+                scheduler.SubmitTaskToBestServer(task)
+            elapsed = time.time() - start
+            after = connection.compressionStats.Info()
+            rows.append({
+                'method' : label,
+                'rawKBPerTask' : (after['sentBytes'] - before[
+                    'sentBytes']) / 1024.0 / numTasks,
+                'wireKBPerTask' : (after['sentWireBytes'] - before[
+                    'sentWireBytes']) / 1024.0 / numTasks,
+                'msPerTask' : 1000.0 * elapsed / numTasks,
+                'blobKB' : server.BlobInfo()['bytes'] / 1024.0})
+        finally:
+            _StopServer(server)
+    _ShowTable('Submitting %i tasks sharing a config ignoring %i files' % (
+        numTasks, numIgnored), ['method', 'rawKBPerTask', 'wireKBPerTask',
+                                'msPerTask', 'blobKB'], rows)
+    return rows
+
+def _Main(names):
+    "Run the benchmarks with the given names (or all if names is empty)."
+
+    logging.getLogger('').setLevel(logging.WARNING)
+    if (not names):
+        names = sorted([n for n in globals() if n.startswith('Bench')])
+    for name in names:
+        globals()[name]()
+
+if __name__ == '__main__':
+    _Main(sys.argv[1:])
@@ -6,7 +6,8 @@ here and automatically suck in the other doctests from the source.
 
 import unittest, doctest
 import superpy
-from superpy.core import Process, DataStructures
+from superpy.core import Process, DataStructures, Servers, Scheduler
+from superpy.core import FramedRPC, Blobs
 import _test
 
 def MakeMainSuperpyDoctest():
@@ -18,7 +19,8 @@ def MakeMainSuperpyDoctest():
     """
     suite = unittest.TestSuite()
 
-    for t in [DataStructures, superpy, Process, _test]:
+    for t in [DataStructures, Servers, Scheduler, superpy, Process,
+              FramedRPC, Blobs, _test]:
         testCase = doctest.DocTestSuite(t)
         suite.addTest(testCase)
 